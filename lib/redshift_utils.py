@@ -1,48 +1,77 @@
+'''Functions for connecting to redshift, reading sql and writing to csv and gzip files.
+
+ENVIRONMENT VARIABLE SETUP
+-----------------------------
+The environment variable REDSHIFT_CONNECTION should look like this:
+
+'ENDPOINT=ds-redshift-psbx-dsa.cblrlw3ocr3v.us-west-2.redshift.amazonaws.com;PORT=5439;DB=cust_analytics_prd;USER=YOURUSERNAME;PASS=YOURPASSWORD'
+
+Where YOURUSERNAME is your username, and YOURPASSWORD is your password.  You must have this set in your environment variables to run this code.
+Pointing ENDPOINT/PORT/DB at a local Postgres runs the same code against a stand-in database.
+
+CONNECTION POOL
+-----------------------------
+Queries share one thread-safe pool of keepalive connections (see rs_connection), so a run that issues several
+queries pays the connection setup once.  configure_rs_pool changes its size and close_rs_pool closes it.
+A thread that finds every connection in use waits for one to be returned instead of failing.
+
+BACKENDS
+-----------------------------
+get_backend returns the backend a caller runs its SQL on: REDSHIFT, which is execute_rs_query, or, given a
+directory of Parquet copies of the analytics_user_vws tables (see save_parquet_tables), an EmbeddedBackend.
+The embedded backend opens the copies as views in an in-process DuckDB database and runs the same templated
+Redshift SQL on it (see translate_sql), with every UNLOAD written as the same gzipped files under a local
+export directory instead of S3 (see copy_unload).  Each query runs on its own connection, so temp tables
+do not collide and several threads can run the feature SQL at once.
+
+backend = get_backend('temp/liveramp_parquet')
+rows, header = backend.execute(sql, return_data=True)
+
+TESTING QUERY function
+----------------------------
+Below are some test for the querying function.  If you would like to run the tests, change run_tests = True, then from this directory type `python redshift_utils`
+
+'''
+
 import os
-import psycopg2
+import re
+import json
+import shutil
 import csv
 import gzip
 import decimal
 import glob
+import time
+import threading
+from contextlib import contextmanager
 
 import s3_utils as s3
 
 
 # SET UP LOGGING
 import logging
-from pythonjsonlogger import jsonlogger
 
-
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(message)s')
-logHandler = logging.StreamHandler()
-logHandler.setFormatter(formatter)
+# Importing the module installs no handler: the entry points (event_model_utils.main, the
+# event-propensity command, a notebook) call setup_logging, so pool workers do not
 logger = logging.getLogger('rs_logger')
-logger.propagate = False
-logger.addHandler(logHandler)
-logger.setLevel(logging.INFO)
-logger.info('Starting job')
-
-'''Functions for connecting to redshift, reading sql and writing to csv and gzip files.
-
-ENVIRONMENT VARIABLE SETUP
------------------------------
-The environment variable REDSHIFT_CONNECTION should look like this:
 
-'ENDPOINT=ds-redshift-psbx-dsa.cblrlw3ocr3v.us-west-2.redshift.amazonaws.com;PORT=5439;DB=cust_analytics_prd;USER=YOURUSERNAME;PASS=YOURPASSWORD'
 
-Where YOURUSERNAME is your username, and YOURPASSWORD is your password.  You must have this set in your environment variables to run this code.
+def setup_logging(level=logging.INFO):
+    ''' Writes the log of this module to stderr as JSON lines (once, however often it is called) '''
+    from pythonjsonlogger import jsonlogger
+    if not logger.handlers:
+        logHandler = logging.StreamHandler()
+        logHandler.setFormatter(jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(message)s'))
+        logger.addHandler(logHandler)
+    logger.propagate = False
+    logger.setLevel(level)
 
-TESTING QUERY function
-----------------------------
-Below are some test for the querying function.  If you would like to run the tests, change run_tests = True, then from this directory type `python redshift_utils`
-
-'''
 
 run_tests = False
 
 def read_sql_file(sql_filename):
     ''' Given a sql file, read it and return a string for execution'''
-    with open(sql_filename, "rw+") as sql_file:
+    with open(sql_filename, "r") as sql_file:
         sql_select = ' '.join(sql_file.readlines())
     return sql_select
 
@@ -53,15 +82,94 @@ def get_rs_conn_string():
     creds = redshift.split(';')
     endpoint = creds[0].split('=')[1]
     port = creds[1].split('=')[1]
+    dbname = creds[2].split('=')[1]
     usr = creds[3].split('=')[1]
     pswd = creds[4].split('=')[1]
-    conn_string = "dbname='cust_analytics_prd' port='{0}' user='{1}' password='{2}' host='{3}'".format(port, usr, pswd, endpoint)
+    conn_string = "dbname='{4}' port='{0}' user='{1}' password='{2}' host='{3}'".format(port, usr, pswd, endpoint, dbname)
     return conn_string
 
 
+_pool = None
+_pool_conn_string = None
+_pool_size = (1, 8)
+_pool_lock = threading.Lock()
+# one slot per connection of the pool: getconn raises PoolError once maxconn are lent out
+_pool_slots = threading.BoundedSemaphore(_pool_size[1])
+_keepalive_kwargs = {'keepalives': 1, 'keepalives_idle': 60, 'keepalives_interval': 10, 'keepalives_count': 5}
+
+
+def configure_rs_pool(minconn=1, maxconn=8):
+    ''' Sets the size of the connection pool, closing the current pool if there is one '''
+    global _pool_size, _pool_slots
+    close_rs_pool()
+    _pool_size = (minconn, maxconn)
+    _pool_slots = threading.BoundedSemaphore(maxconn)
+
+
+def close_rs_pool():
+    ''' Closes every pooled connection '''
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def _get_rs_pool():
+    global _pool, _pool_conn_string
+    conn_string = get_rs_conn_string()
+    with _pool_lock:
+        # a changed REDSHIFT_CONNECTION (e.g., switching to a local stand-in) gets a fresh pool
+        if _pool is not None and _pool_conn_string != conn_string:
+            _pool.closeall()
+            _pool = None
+        if _pool is None:
+            # psycopg2 is imported on first connection, so jobs that never reach Redshift skip it
+            import psycopg2.pool
+            _pool = psycopg2.pool.ThreadedConnectionPool(_pool_size[0], _pool_size[1], conn_string,
+                                                         **_keepalive_kwargs)
+            _pool_conn_string = conn_string
+        return _pool
+
+
+@contextmanager
+def rs_connection():
+    ''' Borrows a connection from the pool for the duration of a with block.  The transaction
+    is committed when the block succeeds and rolled back when it raises; connections that were
+    closed underneath us (e.g., a dropped idle connection) are discarded rather than returned.
+    When all maxconn connections are lent out, it waits for one to be returned.
+
+    Example usage:
+
+    with rs_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+
+    '''
+    slots = _pool_slots
+    slots.acquire()
+    try:
+        pool = _get_rs_pool()
+        conn = pool.getconn()
+        if conn.closed:
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        slots.release()
+
+
 def write_data_to_csv(csvfilename, header, data_rows, delimiter):
     ''' Writes data to a csv.  'header' is a list of ordered header values, and data_rows is a list of lists, containing the column values, in the order of the header.  Selecting a delimiter is required (e.g., delimiter = ',').'''
-    with open(csvfilename, 'wb') as f:
+    with open(csvfilename, 'w', newline='') as f:
         writer = csv.writer(f, delimiter = delimiter)
         writer.writerow(header)
         writer.writerows(data_rows)
@@ -70,25 +178,23 @@ def write_data_to_csv(csvfilename, header, data_rows, delimiter):
 def write_data_to_gzip(csvfilename, header, data_rows, delimiter):
     ''' Writes data to a gzip file, recommended for large data sets. 'header' is a list of ordered header values, and data_rows is a list of lists, containing the column values, in the order of the header.  Selecting a delimiter is required (e.g., delimiter = ','). '''
 
-    def make_str_from_list(mylist, delimiter):
-        mystring = ''
-        for item in mylist:
-            mystring = mystring + str(item) + delimiter
-        return mystring[:-1] + '\n'
-
     with gzip.open(csvfilename, 'wb') as g:
-        myheader = make_str_from_list(header, delimiter)
-        g.write(myheader)
-        for row in data_rows:
-            myrow = make_str_from_list(row, delimiter)
-            g.write(myrow)
+        g.write(_make_lines([header], delimiter))
+        for start in range(0, len(data_rows), 10000):
+            g.write(_make_lines(data_rows[start:start + 10000], delimiter))
+
+
+def _make_lines(rows, delimiter):
+    ''' Joins rows into one block of delimited lines, encoded for writing to a binary file '''
+    return ''.join([delimiter.join([str(item) for item in row]) + '\n' for row in rows]).encode('utf-8')
 
 
-def execute_rs_query(sql, return_data=False, return_csv=False, csvfilename='', delimiter='|', compression=False):
+def execute_rs_query(sql, return_data=False, return_csv=False, csvfilename='', delimiter='|', compression=False, stream=False, batch_size=10000):
     ''' Executes the redshift query. Optionally you can:
     1. Return the data as a list of tuples, as well as header information (return_data = True).
     2. Return a csv (return_csv = True) and csvfilename = 'myfilename.csv' with a delimiter of your choosing (delimiter = 'mydelimiter').  If there is no return, then the code will tell you there is no data to write.
     3. Choose if you want a compressed gzip format csv file (compression = True).
+    4. Stream the csv through a server-side cursor instead of holding every row in memory (stream = True, see stream_rs_query).  This cannot be combined with return_data, and returns the write statistics instead.
 
     Example usage:
     1. for a query with no return (e.g., it creates a table) you can use it by typing:
@@ -107,11 +213,18 @@ def execute_rs_query(sql, return_data=False, return_csv=False, csvfilename='', d
 
     data_rows, header = (sql, return_data = True, return_csv = True, csvfilename = 'mysuperfile.csv', delimiter = ',', compression = True)
 
+    5. For a result too large to hold in memory, stream it to the gzip file instead:
+
+    stats = execute_rs_query(sql, return_csv = True, csvfilename = 'mysuperfile.csv.gz', compression = True, stream = True)
+
     '''
-    conn_string = get_rs_conn_string()
+    if stream and return_data:
+        raise ValueError('stream = True writes the rows to csvfilename without holding them, so it cannot return_data')
+    if stream and return_csv:
+        return stream_rs_query(sql, csvfilename, delimiter, compression, batch_size)
     data_rows = []; column_names = []; header = []
     try:
-        with psycopg2.connect(conn_string) as conn:
+        with rs_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(sql)
                 if return_data or return_csv:
@@ -135,6 +248,79 @@ def execute_rs_query(sql, return_data=False, return_csv=False, csvfilename='', d
         return
 
 
+def iter_rs_query(sql, batch_size=10000):
+    ''' Executes the redshift query on a named (server-side) cursor and yields (header, rows)
+    for each batch of at most batch_size rows, so the full result never has to fit in memory.
+    An empty result yields its header once, with no rows.
+
+    Example usage:
+
+    for header, rows in iter_rs_query(sql, batch_size=50000):
+        process(rows)
+
+    '''
+    with rs_connection() as conn:
+        with conn.cursor(name='rs_stream_cursor') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(sql)
+            first = True
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows and not first:
+                    break
+                header = [desc[0] for desc in cursor.description]
+                yield header, rows
+                if not rows:
+                    break
+                first = False
+
+
+def stream_rs_query(sql, csvfilename, delimiter='|', compression=False, batch_size=10000):
+    ''' Executes the redshift query and streams the result straight into a csv (or gzip
+    when compression = True) file, batch_size rows at a time, using iter_rs_query.  Memory use
+    is bounded by one batch regardless of the size of the result.  An empty result still
+    writes its header.
+
+    Returns a dict with the rows written, the bytes written (before and after compression),
+    the elapsed seconds and the rows per second, which are also logged.
+
+    Example usage:
+
+    stats = stream_rs_query(sql, csvfilename = 'mysuperfile.csv.gz', delimiter = '|', compression = True)
+
+    '''
+    start = time.time()
+    n_rows = 0
+    n_bytes = 0
+    f = gzip.open(csvfilename, 'wb') if compression else open(csvfilename, 'wb')
+    try:
+        for i, (header, rows) in enumerate(iter_rs_query(sql, batch_size)):
+            if i == 0:
+                block = _make_lines([header], delimiter)
+                f.write(block)
+                n_bytes += len(block)
+            block = _make_lines(rows, delimiter)
+            f.write(block)
+            n_bytes += len(block)
+            n_rows += len(rows)
+    except Exception as e:
+        logger.error('SQL error: {}'.format(e))
+        raise
+    finally:
+        f.close()
+    elapsed = time.time() - start
+    stats = {'rows': n_rows,
+             'bytes': n_bytes,
+             'file_bytes': os.path.getsize(csvfilename),
+             'seconds': round(elapsed, 3),
+             'rows_per_sec': round(n_rows / elapsed, 1) if elapsed > 0 else None}
+    logger.info('Streamed {rows} rows ({bytes} bytes, {file_bytes} on disk) in {seconds}s, '
+                '{rows_per_sec} rows/s'.format(**stats))
+    if n_rows == 0:
+        print('The query returned no rows, only the header was written to {0}'.format(csvfilename))
+    return stats
+
+
 def drop_table(table_name):
     sql = '''DROP TABLE IF EXISTS {0};'''.format(table_name)
     execute_rs_query(sql)
@@ -175,20 +361,314 @@ def vacuum_table(table_name):
     -------
     None
     """
-    conn_string = get_rs_conn_string()
     try:
-        with psycopg2.connect(conn_string) as conn:
+        with rs_connection() as conn:
             old_isolation_level = conn.isolation_level
             conn.set_isolation_level(0)
-            with conn.cursor() as cursor:
-                sql = 'vacuum {};'.format(table_name)
-                cursor.execute(sql)
-                conn.commit()
-            conn.set_isolation_level(old_isolation_level)
+            try:
+                with conn.cursor() as cursor:
+                    sql = 'vacuum {};'.format(table_name)
+                    cursor.execute(sql)
+                    conn.commit()
+            finally:
+                # the connection goes back to the pool, so always restore its isolation level
+                conn.set_isolation_level(old_isolation_level)
     except Exception as e:
         logger.error('SQL error: {}'.format(e))
 
 
+SOURCE_SCHEMA = 'analytics_user_vws'
+SOURCE_TABLES = ['liveramp_trans', 'liveramp_customers', 'liveramp_funnel', 'liveramp_events',
+                 'liveramp_loyalty', 'liveramp_model_personas_clusters']
+
+# Redshift functions of the feature SQL that DuckDB does not have, as macros
+_MACROS = [
+    """create or replace macro dateadd(part, n, d) as
+         cast(d as timestamp) + cast(cast(n as varchar) || ' ' || part as interval)""",
+    """create or replace macro rs_trunc(d) as cast(d as date)""",
+    """create or replace macro months_between(a, b) as
+         (year(cast(a as date)) - year(cast(b as date))) * 12 + (month(cast(a as date)) - month(cast(b as date)))
+         + case
+             when day(cast(a as date)) = day(cast(b as date))
+               or (cast(a as date) = last_day(cast(a as date)) and cast(b as date) = last_day(cast(b as date)))
+               then 0
+             else (day(cast(a as date)) - day(cast(b as date))) / 31.0
+           end"""]
+
+# Rewrites of a Redshift statement into DuckDB's, in order: table attributes go, float is float8, date
+# parts are quoted, trunc of a timestamp is its date, a date string plus or minus days is a date, and the
+# select of an insert loses its parentheses
+_REWRITES = [
+    (re.compile(r'\bencode\s+\w+', re.I), ''),
+    (re.compile(r'\bdiststyle\s+\w+', re.I), ''),
+    (re.compile(r'\bdistkey\s*\([^)]*\)', re.I), ''),
+    (re.compile(r'\b(?:compound\s+|interleaved\s+)?sortkey\s*\([^)]*\)', re.I), ''),
+    (re.compile(r'\bfloat8?\b', re.I), 'double'),
+    (re.compile(r'\b(dateadd|datediff)\(\s*(\w+)\s*,', re.I), r"\1('\2',"),
+    (re.compile(r'\btrunc\(\s*(?=dateadd\b)', re.I), 'rs_trunc('),
+    (re.compile(r"'(\d{4}-\d{2}-\d{2})'\s*([-+])\s*(\d+)\b"), r"(date '\1' \2 \3)"),
+    (re.compile(r'^(insert\s+into\s+[\w.]+\s*)\(\s*((?:select|with)\b.*)\)$', re.I | re.S), r'\1\2'),
+]
+
+_SKIPPED = re.compile(r'^(analyze|vacuum)\b', re.I)
+
+_UNLOAD = re.compile(r"^unload\s*\(\s*'(?P<query>(?:[^'\\]|\\.|'')*)'\s*\)\s*to\s*'(?P<to>[^']*)'(?P<options>.*)$",
+                     re.I | re.S)
+
+
+def _split_sql(sql):
+    # The statements of a script without its comments, split at the semicolons outside quotes
+    statements = []
+    current = []
+    i = 0
+    n = len(sql)
+    while i < n:
+        if sql[i] == "'":
+            # to the closing quote, over backslash escapes and doubled quotes
+            j = i + 1
+            while j < n:
+                if sql[j] == '\\':
+                    j += 2
+                elif sql.startswith("''", j):
+                    j += 2
+                elif sql[j] == "'":
+                    break
+                else:
+                    j += 1
+            current.append(sql[i:j + 1])
+            i = j + 1
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = n if end < 0 else end
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+        elif sql[i] == ';':
+            statements.append(''.join(current))
+            current = []
+            i += 1
+        else:
+            current.append(sql[i])
+            i += 1
+    statements.append(''.join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def translate_sql(statement):
+    ''' Returns a statement of the Redshift SQL of this project as DuckDB runs it, or None for the
+    ones it has no use for (analyze, vacuum).  Only the constructs the project's SQL uses are
+    translated; anything else is left to fail in DuckDB. '''
+    if _SKIPPED.match(statement):
+        return None
+    for pattern, replacement in _REWRITES:
+        statement = pattern.sub(replacement, statement)
+    return statement
+
+
+def _unload_options(text):
+    # The UNLOAD options that shape its files; credentials and the like do not apply locally
+    def has(option):
+        return re.search(r'\b{0}\b'.format(option), text, re.I) is not None
+    delimiter = re.search(r"\bdelimiter\s+(?:as\s+)?'([^']*)'", text, re.I)
+    return {'delimiter': '|' if delimiter is None else delimiter.group(1),
+            'parallel': re.search(r'\bparallel\s+(off|false)\b', text, re.I) is None,
+            'gzip': has('gzip'), 'manifest': has('manifest'), 'header': has('header'),
+            'allowoverwrite': has('allowoverwrite')}
+
+
+class RedshiftBackend(object):
+    ''' Redshift, through the connection pool '''
+
+    local = False
+
+    def execute(self, sql, **kwargs):
+        ''' execute_rs_query '''
+        return execute_rs_query(sql, **kwargs)
+
+
+class EmbeddedBackend(object):
+    ''' Runs the project's Redshift SQL on local Parquet copies of its tables, in DuckDB
+
+    Parameters
+    ----------
+    data_dir : str
+        <table>.parquet files, or <table> directories of Parquet files, of the tables of schema
+        (e.g., liveramp_trans, or liveramp_trans_test for test runs)
+    export_dir : str, optional
+        where UNLOADs write, as <export_dir>/<bucket>/<key>; by default <data_dir>/unload
+    schema : str
+        the schema the queries read the tables from
+    threads : int, optional
+        DuckDB threads per query, by default one per CPU
+    slices : int
+        files written by an UNLOAD with parallel on
+    '''
+
+    local = True
+
+    def __init__(self, data_dir, export_dir=None, schema=SOURCE_SCHEMA, threads=None, slices=4):
+        import duckdb
+        self.data_dir = data_dir
+        self.export_dir = export_dir or os.path.join(data_dir, 'unload')
+        self.schema = schema
+        self.slices = slices
+        self._db = duckdb.connect(':memory:', config={} if threads is None else {'threads': threads})
+        self._db.execute('create schema if not exists {0}'.format(schema))
+        self.tables = []
+        for path in sorted(glob.glob(os.path.join(data_dir, '*'))):
+            name, ext = os.path.splitext(os.path.basename(path))
+            if os.path.isdir(path) and glob.glob(os.path.join(path, '*.parquet')):
+                source = os.path.join(path, '*.parquet')
+            elif ext == '.parquet':
+                source = path
+            else:
+                continue
+            # A view reads the columns a query needs straight from the files
+            self._db.execute("create or replace view {0}.{1} as select * from read_parquet('{2}', union_by_name=true)"
+                             .format(schema, name, source))
+            self.tables.append(name)
+        for macro in _MACROS:
+            self._db.execute(macro)
+        logger.info('Opened {0} local tables in {1}'.format(len(self.tables), data_dir))
+
+    def export_path(self, location):
+        ''' Returns the local path of an UNLOAD location, s3://<bucket>/<key> '''
+        return os.path.join(self.export_dir, *re.sub(r'^s3://', '', location).split('/'))
+
+    def execute(self, sql, return_data=False, return_csv=False, csvfilename='', delimiter='|', compression=False,
+                **kwargs):
+        ''' Runs a script of Redshift SQL as execute_rs_query does, on a connection of its own, returning
+        the rows and header of its last statement with return_data.  Errors are logged and raised. '''
+        conn = self._db.cursor()
+        header = []
+        data_rows = []
+        try:
+            # Redshift divides integers into an integer
+            conn.execute('set integer_division = true')
+            for statement in _split_sql(sql):
+                unload = _UNLOAD.match(statement)
+                if unload is not None:
+                    self._unload(conn, unload)
+                    continue
+                statement = translate_sql(statement)
+                if statement is None:
+                    continue
+                conn.execute(statement)
+            if (return_data or return_csv) and conn.description is not None:
+                header = [desc[0] for desc in conn.description]
+                data_rows = conn.fetchall()
+        except Exception as e:
+            logger.error('SQL error: {}'.format(e))
+            raise
+        finally:
+            conn.close()
+        if return_csv:
+            if data_rows == []:
+                print('You selected to write to a file, but there is no data to write!')
+            elif compression:
+                write_data_to_gzip(csvfilename, header, data_rows, delimiter)
+            else:
+                write_data_to_csv(csvfilename, header, data_rows, delimiter)
+        if return_data:
+            return data_rows, header
+
+    def _unload(self, conn, match):
+        # Writes the result of an UNLOAD's query as the files Redshift writes to its location: <prefix>000
+        # with parallel off, else <prefix><slice>_part_00 and, if asked for, <prefix>manifest
+        options = _unload_options(match.group('options'))
+        query = _split_sql(re.sub(r"\\(.)", r'\1', match.group('query')).replace("''", "'"))[0]
+        location = match.group('to')
+        prefix = self.export_path(location)
+        directory = os.path.dirname(prefix)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not options['allowoverwrite'] and glob.glob(prefix + '*'):
+            raise IOError('The unload location {0} is not empty ({1})'.format(location, prefix))
+
+        conn.execute('create temp table rs_unload as {0}'.format(translate_sql(query)))
+        n_rows = conn.execute('select count(*) from rs_unload').fetchone()[0]
+        ext = '.gz' if options['gzip'] else ''
+        copy_options = "format csv, delimiter '{0}', header {1}, compression {2}".format(
+            options['delimiter'], 'true' if options['header'] else 'false', 'gzip' if options['gzip'] else 'none')
+        if options['parallel']:
+            # Rows are dealt to the slices in turn, and a slice without rows writes no file
+            n_slices = max(1, min(self.slices, n_rows))
+            suffixes = ['{0:04d}_part_00{1}'.format(i, ext) for i in range(n_slices)]
+            for i, suffix in enumerate(suffixes):
+                conn.execute("copy (select * from rs_unload where rowid % {0} = {1}) to '{2}' ({3})".format(
+                    n_slices, i, prefix + suffix, copy_options))
+        else:
+            suffixes = ['000' + ext]
+            conn.execute("copy rs_unload to '{0}' ({1})".format(prefix + suffixes[0], copy_options))
+        conn.execute('drop table rs_unload')
+        if options['manifest']:
+            with open(prefix + 'manifest', 'w') as f:
+                json.dump({'entries': [{'url': location + suffix, 'mandatory': True} for suffix in suffixes]}, f)
+        logger.info('Unloaded {0} rows to {1} local files at {2}'.format(n_rows, len(suffixes), prefix))
+
+    def copy_unload(self, bucket, s3_path, handle, filepath=''):
+        ''' Copies the files of the UNLOAD to s3://<bucket>/<s3_path><handle> into filepath, in place
+        of downloading them (s3_utils.download_file_from_s3 or download_unload_shards), and returns
+        the paths of the copies of its data files '''
+        prefix = self.export_path('s3://{0}/{1}{2}'.format(bucket, s3_path, handle))
+        if filepath and not os.path.isdir(filepath):
+            os.makedirs(filepath)
+        if os.path.exists(prefix + 'manifest'):
+            shutil.copyfile(prefix + 'manifest', os.path.join(filepath, handle + 'manifest'))
+            with open(prefix + 'manifest', 'r') as f:
+                names = [entry['url'].rsplit('/', 1)[1] for entry in json.load(f)['entries']]
+        else:
+            names = [os.path.basename(path) for path in sorted(glob.glob(prefix + '000*'))]
+        for name in names:
+            shutil.copyfile(os.path.join(os.path.dirname(prefix), name), os.path.join(filepath, name))
+        return [os.path.join(filepath, name) for name in names]
+
+    def close(self):
+        self._db.close()
+
+
+REDSHIFT = RedshiftBackend()
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(data_dir=None, **kwargs):
+    ''' Returns REDSHIFT, or the EmbeddedBackend of the Parquet copies in data_dir, opened once per
+    directory and process (**kwargs are those of EmbeddedBackend) '''
+    if data_dir is None:
+        return REDSHIFT
+    key = os.path.abspath(data_dir)
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = EmbeddedBackend(data_dir, **kwargs)
+        return _backends[key]
+
+
+def save_parquet_tables(data_dir, tables=None, suffix='', schema=SOURCE_SCHEMA, batch_size=500000):
+    ''' Copies tables from Redshift into data_dir as an EmbeddedBackend reads them, a Parquet file
+    per batch of rows in <data_dir>/<table><suffix>/
+
+    Example usage:
+
+    save_parquet_tables('temp/liveramp_parquet', suffix='_test')
+
+    '''
+    import pandas as pd
+    for table in tables or SOURCE_TABLES:
+        name = table + suffix
+        table_dir = os.path.join(data_dir, name)
+        if os.path.isdir(table_dir):
+            shutil.rmtree(table_dir)
+        os.makedirs(table_dir)
+        n_rows = 0
+        for i, (header, rows) in enumerate(iter_rs_query('select * from {0}.{1}'.format(schema, name), batch_size)):
+            df = pd.DataFrame.from_records(rows, columns=header)
+            df.to_parquet(os.path.join(table_dir, 'part_{0:05d}.parquet'.format(i)), index=False)
+            n_rows += len(df)
+        logger.info('Saved {0} rows of {1}.{2} to {3}'.format(n_rows, schema, name, table_dir))
+
+
 #===================================================
 ''' Test runs for rs execution below '''
 
@@ -211,17 +691,17 @@ if run_tests == True:
         num_lines = sum(1 for line in open(filename, 'rb'))
         if filename in list_of_dir_files:
             if filename[-3:] == 'csv':
-                    print '{0} was written and contains {1} lines.'.format(filename, num_lines)
+                    print ('{0} was written and contains {1} lines.'.format(filename, num_lines))
             elif filename[-3:] == '.gz':
                 i = 0
                 with gzip.open(filename, 'r') as f:
                     for lin in f:
                         i = i + 1
-                print '{0} was written and contains {1} lines.'.format(filename, i)
+                print ('{0} was written and contains {1} lines.'.format(filename, i))
             else:
-                print 'Sorry, file must either end in ".csv" or ".gz".'
+                print ('Sorry, file must either end in ".csv" or ".gz".')
         else:
-            print 'Sorry, no file was written.'
+            print ('Sorry, no file was written.')
 
     sql = 'select TOP 10 * FROM analytics_user_vws.liveramp_trans;'
 
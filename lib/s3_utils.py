@@ -1,23 +1,78 @@
 ''' Functions for connecting to S3 and uploading/downloading files from it '''
 
 import os
-import boto3
-from boto3.s3.transfer import TransferConfig
-import botocore
+import json
+import threading
+from multiprocessing.pool import ThreadPool
 
 # SET UP LOGGING
 import logging
-from pythonjsonlogger import jsonlogger
 
 
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(message)s')
-logHandler = logging.StreamHandler()
-logHandler.setFormatter(formatter)
+# Importing the module installs no handler: the entry points (event_model_utils.main, the
+# event-propensity command, a notebook) call setup_logging, so pool workers do not
 logger = logging.getLogger('s3_logger')
-logger.propagate = False
-logger.addHandler(logHandler)
-logger.setLevel(logging.INFO)
-logger.info('Starting job')
+
+
+def setup_logging(level=logging.INFO):
+    ''' Writes the log of this module to stderr as JSON lines (once, however often it is called) '''
+    from pythonjsonlogger import jsonlogger
+    if not logger.handlers:
+        logHandler = logging.StreamHandler()
+        logHandler.setFormatter(jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(message)s'))
+        logger.addHandler(logHandler)
+    logger.propagate = False
+    logger.setLevel(level)
+
+
+# boto3 is imported on first use (_create_session, _transfer_config), so importing this module
+# costs nothing to jobs that never touch S3.
+# Sessions, s3 resources and verified buckets are cached per (region_name, environment, profile_name)
+# so a multi-step run builds each once.  Set S3_ENDPOINT_URL to point the helpers at a local
+# S3 stand-in (e.g., minio or moto in server mode).
+_sessions = {}
+_resources = {}
+_verified_buckets = set()
+_session_lock = threading.Lock()
+
+
+def clear_session_cache():
+    ''' Forgets every cached session, resource and verified bucket '''
+    with _session_lock:
+        _sessions.clear()
+        _resources.clear()
+        _verified_buckets.clear()
+
+
+def _get_session(region_name='us-west-2',
+                 environment='aws',
+                 profile_name='invcts-federated'):
+    ''' Returns the cached boto3 session for these settings, creating it on first use '''
+    key = (region_name, environment, profile_name)
+    with _session_lock:
+        if key not in _sessions:
+            _sessions[key] = _create_session(region_name, environment, profile_name)
+        return _sessions[key]
+
+
+def _get_resource(region_name='us-west-2',
+                  environment='aws',
+                  profile_name='invcts-federated'):
+    ''' Returns the cached s3 resource for these settings.  boto3 resources are not thread-safe,
+    so concurrent transfers should go through its (thread-safe) meta.client. '''
+    key = (region_name, environment, profile_name)
+    session = _get_session(region_name, environment, profile_name)
+    with _session_lock:
+        if key not in _resources:
+            _resources[key] = session.resource('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+        return _resources[key]
+
+
+def _transfer_config(multipart_threshold, multipart_chunksize):
+    ''' Returns the boto3 TransferConfig of a transfer '''
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=multipart_threshold,
+                          multipart_chunksize=multipart_chunksize)
 
 
 def _create_session(region_name='us-west-2',
@@ -40,6 +95,7 @@ def _create_session(region_name='us-west-2',
     N/A: this function is not intended to be called directly by user
     '''
 
+    import boto3
     if environment == 'aws':
         session = boto3.session.Session(region_name=region_name)
     else:
@@ -70,10 +126,14 @@ def get_temp_creds(region_name='us-west-2',
                    profile='invcts-federated')
     '''
 
-    session = _create_session(region_name, environment, profile_name)
-    ak = session.get_credentials().access_key
-    sk = session.get_credentials().secret_key
-    tkn = session.get_credentials().token
+    # The cached session keeps one credential provider; temporary (STS/SSO) credentials are
+    # refreshed by botocore ahead of their expiry, and freezing them reads a consistent
+    # key/secret/token triple without another round trip.
+    session = _get_session(region_name, environment, profile_name)
+    creds = session.get_credentials().get_frozen_credentials()
+    ak = creds.access_key
+    sk = creds.secret_key
+    tkn = creds.token
     cred_str = 'aws_access_key_id={0};aws_secret_access_key={1};token={2}'.format(ak, sk, tkn)
     return cred_str
 
@@ -106,11 +166,15 @@ def get_bucket(bucket,
                environment='local', profile='invcts-federated')
     '''
 
-    session = _create_session(region_name, environment, profile_name)
-    s3 = session.resource('s3')
+    s3 = _get_resource(region_name, environment, profile_name)
     mybucket = s3.Bucket(bucket)
+    key = (bucket, region_name, environment, profile_name)
+    if key in _verified_buckets:
+        return mybucket
+    import botocore.exceptions
     try:
         s3.meta.client.head_bucket(Bucket=bucket)
+        _verified_buckets.add(key)
     except botocore.exceptions.ClientError as e:
         # If a client error is thrown, then check that it was a 404
         # if it was a 404 error, then the bucket does not exist
@@ -154,8 +218,7 @@ def rename_s3_file(bucket,
                    new_file='temp/new_file.csv')
     '''
 
-    session = _create_session(environment=environment)
-    s3 = session.resource('s3')
+    s3 = _get_resource(region_name, environment, profile_name)
     s3.Object(bucket, new_file).copy_from(CopySource=bucket + '/' + old_file)
     s3.Object(bucket, old_file).delete()
     logger.info('S3: {} renamed to {}'.format(old_file, new_file))
@@ -208,8 +271,7 @@ def download_file_from_s3(bucket,
 
     mybucket = get_bucket(bucket, region_name, environment, profile_name)
     # multipart_threshold and multipart_chunksize defaults = Amazon defaults
-    config = TransferConfig(multipart_threshold=multipart_threshold,
-                            multipart_chunksize=multipart_chunksize)
+    config = _transfer_config(multipart_threshold, multipart_chunksize)
     logger.info('S3_path + filename = {0}'.format(s3_path + filename))
     logger.info('Local filepath + filename = {0}'.format(os.path.join(filepath, filename)))
     mybucket.download_file(s3_path + filename,
@@ -264,8 +326,128 @@ def upload_file_to_s3(bucket,
 
     mybucket = get_bucket(bucket, region_name, environment, profile_name)
     # multipart_threshold and multipart_chunksize defaults = Amazon defaults
-    config = TransferConfig(multipart_threshold=multipart_threshold,
-                            multipart_chunksize=multipart_chunksize)
+    config = _transfer_config(multipart_threshold, multipart_chunksize)
     mybucket.upload_file(os.path.join(filepath, filename),
                          s3_path + filename,
                          Config=config)
+
+
+def download_files_from_s3(bucket,
+                           s3_path,
+                           filenames,
+                           filepath='',
+                           max_workers=8,
+                           region_name='us-west-2',
+                           environment='aws',
+                           profile_name='invcts-federated',
+                           multipart_threshold=8388608,
+                           multipart_chunksize=8388608):
+    ''' Downloads several files from an S3 bucket concurrently
+
+    The bucket is looked up once and the files are fetched through a
+    thread pool sharing its (thread-safe) client.
+
+    Inputs
+    ======
+    bucket : string
+        S3 bucket name
+    s3_path : string
+        path within the bucket to the files you would like to download
+    filenames : list of strings
+        names of the files you would like to download
+    filepath : string
+        path to the local directory in which you would like to save the files
+    max_workers : int
+        number of concurrent downloads
+    region_name : string
+        name of region
+    environment : string
+        whether the script is running locally or on aws
+    profile_name : string
+        profile name for credential purposes when running locally,
+        typically 'invcts-federated'
+    multipart_threshold : int
+        minimum filesize to initiate multipart download
+    multipart_chunksize : int
+        chunksize for multipart download
+
+    Returns
+    =======
+    list of local paths, in the order of filenames
+
+    Example use
+    ===========
+    download_files_from_s3(bucket='persis-datalab-team',
+                           s3_path='tmp/',
+                           filenames=['myfile_0000_part_00.gz',
+                                      'myfile_0001_part_00.gz'],
+                           filepath='data/',
+                           environment='local')
+    '''
+
+    mybucket = get_bucket(bucket, region_name, environment, profile_name)
+    client = mybucket.meta.client
+    config = _transfer_config(multipart_threshold, multipart_chunksize)
+
+    def _download(filename):
+        local_file = os.path.join(filepath, filename)
+        client.download_file(bucket, s3_path + filename, local_file, Config=config)
+        return local_file
+
+    logger.info('Downloading {0} files from {1} with {2} workers'.format(len(filenames), s3_path, max_workers))
+    pool = ThreadPool(max(1, min(max_workers, len(filenames))))
+    try:
+        local_files = pool.map(_download, filenames)
+    finally:
+        pool.close()
+        pool.join()
+    return local_files
+
+
+def download_unload_shards(bucket,
+                           s3_path,
+                           handle,
+                           filepath='',
+                           max_workers=8,
+                           **kwargs):
+    ''' Downloads the files written by a Redshift UNLOAD ... MANIFEST
+
+    Fetches '<handle>manifest', then every file listed in it concurrently
+    (see download_files_from_s3).
+
+    Inputs
+    ======
+    bucket : string
+        S3 bucket name
+    s3_path : string
+        path within the bucket to the unloaded files
+    handle : string
+        prefix the UNLOAD wrote to (e.g., 'ep_valentines_day_2017_20180417_')
+    filepath : string
+        path to the local directory in which you would like to save the files
+    max_workers : int
+        number of concurrent downloads
+    **kwargs
+        passed on to download_file_from_s3 and download_files_from_s3
+        (region_name, environment, profile_name, ...)
+
+    Returns
+    =======
+    list of local paths to the shards, in manifest order
+
+    Example use
+    ===========
+    download_unload_shards(bucket='liveramp-testing',
+                           s3_path='event_propensity/temp_data/',
+                           handle='ep_valentines_day_2017_20180417_',
+                           filepath='temp/downloads',
+                           environment='local')
+    '''
+
+    manifest = handle + 'manifest'
+    download_file_from_s3(bucket, s3_path, manifest, filepath=filepath, **kwargs)
+    with open(os.path.join(filepath, manifest), 'r') as f:
+        entries = json.load(f)['entries']
+    filenames = [entry['url'].rsplit('/', 1)[1] for entry in entries]
+    return download_files_from_s3(bucket, s3_path, filenames, filepath=filepath,
+                                  max_workers=max_workers, **kwargs)
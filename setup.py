@@ -0,0 +1,54 @@
+''' Installs the modules of src/ and lib/ as top-level modules, as they import each other, and the
+event-propensity command (src/cli_utils.py)
+
+pip install .                      # numpy, pandas, scikit-learn
+pip install .[redshift,s3]         # psycopg2 and boto3 to pull extracts
+pip install .[local]               # duckdb and pyarrow for the feature store and local SQL
+pip install -e .                   # from the source tree, lib/ is found next to src/
+pip install -e .[test]             # pytest, for python -m pytest tests
+'''
+
+import os
+import glob
+
+from setuptools import setup
+from setuptools.command.build_py import build_py as _build_py
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC_MODULES = sorted(os.path.splitext(os.path.basename(f))[0] for f in glob.glob(os.path.join(HERE, 'src', '*.py')))
+LIB_MODULES = ['redshift_utils', 's3_utils']
+
+
+class build_py(_build_py):
+    ''' Adds the modules of lib/ to those of src/ (package_dir maps the top level to src/ only) '''
+
+    def find_modules(self):
+        return _build_py.find_modules(self) + [('', name, os.path.join('lib', name + '.py')) for name in LIB_MODULES]
+
+
+setup(
+    name='event-propensity',
+    version='0.1.0',
+    description='Customer likelihood to shop a marketing event: extracts, samples, models and scores',
+    package_dir={'': 'src'},
+    py_modules=SRC_MODULES,
+    cmdclass={'build_py': build_py},
+    install_requires=[
+        'numpy>=1.20.0',
+        'pandas>=1.3.0',
+        'scikit-learn>=0.24.0',
+        'python-json-logger',
+    ],
+    extras_require={
+        'redshift': ['psycopg2-binary>=2.8.0'],
+        's3': ['boto3>=1.17.0'],
+        'local': ['duckdb', 'pyarrow'],
+        'parquet': ['pyarrow'],
+        'trees': ['numba'],
+        'test': ['pytest'],
+    },
+    entry_points={
+        'console_scripts': ['event-propensity = cli_utils:main'],
+    },
+)
@@ -0,0 +1,9 @@
+/* Event propensity model - Step 2 - Get the daily flags of the marketing events */
+/*                                   for the local event calendar (see src/calendar_utils.py) */
+
+select
+  event_dt,
+  {1}
+from analytics_user_vws.liveramp_events{0}
+where event_dt >= '{2}'
+order by event_dt;
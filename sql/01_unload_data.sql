@@ -1060,4 +1060,4 @@ order by 2 desc, 3 desc;
 ')
 to 's3://{5}/{6}{7}'
 credentials '{8}'
-parallel off gzip allowoverwrite;
+{9} gzip allowoverwrite;
@@ -0,0 +1,81 @@
+/* Event propensity model - Incremental features - Create the per-customer, per-period partial tables */
+/*                                                  of the local feature store (see src/feature_utils.py) */
+/*   {0} declares the spend and shopped columns of every marketing event */
+
+-- sums, counts and maxes of every customer's lines (from the acquisition date on) of a period,
+--  stored periods are calendar months, starting on period_start
+create table if not exists cust_period (
+  cust_key bigint not null,
+  period_start date not null,
+  fl_items bigint,
+  sale_items bigint,
+  fl_spend double precision,
+  merch_spend double precision,
+  womens_prod_spend double precision,
+  mens_prod_spend double precision,
+  accessories_spend double precision,
+  apparel_spend double precision,
+  babypet_spend double precision,
+  bag_spend double precision,
+  beauty_spend double precision,
+  entertainment_spend double precision,
+  food_spend double precision,
+  home_spend double precision,
+  jewelry_spend double precision,
+  other_spend double precision,
+  shoe_spend double precision,
+  giftcard_spend double precision,
+  web_spend double precision,
+  rack_spend double precision,
+  jwn_spend double precision,
+  fl_trips bigint,
+  fl_last_sale_dt date,
+  fl_merch_ind integer,
+  employee_disc_ind integer,
+  fl_event_day_spend double precision,
+  {0}
+);
+
+create index if not exists cust_period_start on cust_period (period_start);
+
+-- the sets behind the count distinct features, which do not add up across periods
+create table if not exists cust_period_div (
+  cust_key bigint not null,
+  period_start date not null,
+  prod_div varchar(40)
+);
+
+create index if not exists cust_period_div_start on cust_period_div (period_start);
+
+create table if not exists cust_period_channel (
+  cust_key bigint not null,
+  period_start date not null,
+  intent_channel varchar(20)
+);
+
+create index if not exists cust_period_channel_start on cust_period_channel (period_start);
+
+-- the last FL sale of every customer in every event span
+create table if not exists cust_event_shop (
+  cust_key bigint not null,
+  event varchar(32) not null,
+  yr integer not null,
+  start_dt date not null,
+  end_dt date not null,
+  last_sale_dt date
+);
+
+create index if not exists cust_event_shop_cust on cust_event_shop (cust_key, event, yr);
+
+-- the periods and event spans aggregated so far
+create table if not exists partial_periods (
+  period_start date not null,
+  period_end date not null
+);
+
+create table if not exists partial_event_spans (
+  event varchar(32) not null,
+  yr integer not null,
+  start_dt date not null,
+  end_dt date not null
+);
@@ -0,0 +1,182 @@
+/* Event propensity model - Incremental features - Aggregate the lines of the days where {1} */
+/*                                                  per customer and period (see src/feature_utils.py) */
+/*   {2} prefixes the tables filled ('snap_edge_' for the edges of a snapshot), {3} is the */
+/*   period_start of a line and {4} selects the spend and shopped columns of every marketing event */
+
+insert into {2}cust_period
+select
+  trans.cust_key,
+  {3} as period_start,
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') then 1 else 0 end
+  ) as fl_items,
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') then trans.full_line_sale_ind else 0 end
+  ) as sale_items,
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') then trans.spend_gross else 0 end
+  ) as fl_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM') and trans.merch_type = 'Merch' and trans.channel <> 'RESTAURANT'
+        then trans.spend_gross
+      else 0
+    end
+  ) as merch_spend,
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') and trans.prod_gender = 'F' then trans.spend_gross else 0 end
+  ) as womens_prod_spend,
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') and trans.prod_gender = 'M' then trans.spend_gross else 0 end
+  ) as mens_prod_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Umbrellas','Small Leather Goods','Belts & Braces',
+                                       'Apparel care','Eyewear','Neckwear','Gloves/Mittens',
+                                       'Headwear','Scarves/Wraps/Ponchos')
+        then trans.spend_gross
+      else 0
+    end
+  ) as accessories_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Suits/Sets/Wardrobers','Bottoms','Sleepwear',
+                                       'Dresses','Hosiery','Swimwear','Tops',
+                                       'Jumpsuits/Coveralls','Jacket/Sportcoat',
+                                       'Outerwear','Underwear/Lingerie')
+        then trans.spend_gross
+      else 0
+    end
+  ) as apparel_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Baby Accessories','Pet Accessories')
+        then trans.spend_gross
+      else 0
+    end
+  ) as babypet_spend,
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') and trans.prod_merchlevel2 = 'Bags' then trans.spend_gross else 0 end
+  ) as bag_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Fragrance','Personal Care Accessories',
+                                       'Hair Accessories','Hair Care','Makeup',
+                                       'Skin/Body Treatment')
+        then trans.spend_gross
+      else 0
+    end
+  ) as beauty_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Toys/Games', 'Recreation/Entertainment')
+        then trans.spend_gross
+      else 0
+    end
+  ) as entertainment_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and (trans.prod_merchlevel2 = 'Food' or trans.merch_type = 'Restaurant')
+        then trans.spend_gross
+      else 0
+    end
+  ) as food_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Home','Memorabilia & Collectibles',
+                                       'Stationery/Giftwrap')
+        then trans.spend_gross
+      else 0
+    end
+  ) as home_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Jewelry', 'Jewelry Care')
+        then trans.spend_gross
+      else 0
+    end
+  ) as jewelry_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Gift/Operational','DNU I','NOT USED I')
+        then trans.spend_gross
+      else 0
+    end
+  ) as other_spend,
+  sum(
+    case
+      when trans.intent_channel in ('FLS','N.COM')
+        and trans.prod_merchlevel2 in ('Shoes', 'Shoe care')
+        then trans.spend_gross
+      else 0
+    end
+  ) as shoe_spend,
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') and trans.tender_giftcard = 1 then trans.spend_gross else 0 end
+  ) as giftcard_spend,
+  sum(
+    case when trans.intent_channel = 'N.COM' then trans.spend_gross else 0 end
+  ) as web_spend,
+  sum(
+    case when trans.intent_channel = 'RACK' then trans.spend_gross else 0 end
+  ) as rack_spend,
+  sum(trans.spend_gross) as jwn_spend,
+  -- trips are counted per period, which adds up as long as a trip's lines share a sale day
+  count(distinct
+    case when trans.intent_channel in ('FLS','N.COM') then trans.corp_trip_key else null end
+  ) as fl_trips,
+  max(
+    case when trans.intent_channel in ('FLS','N.COM') then trans.sale_dt else null end
+  ) as fl_last_sale_dt,
+  max(
+    case
+      when trans.intent_channel in ('FLS','N.COM') and trans.merch_type = 'Merch' and trans.channel <> 'RESTAURANT'
+        then 1
+      else 0
+    end
+  ) as fl_merch_ind,
+  max(trans.spend_discount_employee_ind) as employee_disc_ind,
+  -- cust_pct_spend_in_event inner joins the events, so only the days they list count
+  sum(
+    case when trans.intent_channel in ('FLS','N.COM') and events.event_dt is not null then trans.spend_gross else 0 end
+  ) as fl_event_day_spend,
+  {4}
+from analytics_user_vws.liveramp_trans{0} as trans
+inner join analytics_user_vws.liveramp_funnel{0} as funnel
+  on trans.cust_key = funnel.cust_key and trans.sale_dt >= funnel.acq_dt
+left join analytics_user_vws.liveramp_events{0} as events
+  on trans.sale_dt = events.event_dt
+where ({1})
+group by 1, 2;
+
+insert into {2}cust_period_div
+select distinct
+  trans.cust_key,
+  {3} as period_start,
+  trans.prod_div
+from analytics_user_vws.liveramp_trans{0} as trans
+inner join analytics_user_vws.liveramp_funnel{0} as funnel
+  on trans.cust_key = funnel.cust_key and trans.sale_dt >= funnel.acq_dt
+where ({1})
+  and trans.intent_channel in ('FLS','N.COM')
+  and trans.prod_div is not null;
+
+insert into {2}cust_period_channel
+select distinct
+  trans.cust_key,
+  {3} as period_start,
+  trans.intent_channel
+from analytics_user_vws.liveramp_trans{0} as trans
+inner join analytics_user_vws.liveramp_funnel{0} as funnel
+  on trans.cust_key = funnel.cust_key and trans.sale_dt >= funnel.acq_dt
+where ({1})
+  and trans.intent_channel is not null;
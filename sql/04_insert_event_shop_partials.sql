@@ -0,0 +1,27 @@
+/* Event propensity model - Incremental features - Find the last FL sale of every customer in the */
+/*                                                  event spans of new_event_spans (see src/feature_utils.py) */
+
+insert into cust_event_shop
+select
+  trans.cust_key,
+  spans.event,
+  spans.yr,
+  spans.start_dt,
+  spans.end_dt,
+  max(trans.sale_dt) as last_sale_dt
+from new_event_spans as spans
+inner join analytics_user_vws.liveramp_trans{0} as trans
+  on trans.sale_dt between spans.start_dt and spans.end_dt
+inner join analytics_user_vws.liveramp_funnel{0} as funnel
+  on trans.cust_key = funnel.cust_key and trans.sale_dt >= funnel.acq_dt
+where trans.intent_channel in ('FLS','N.COM')
+  and trans.corp_trip_key is not null
+group by 1, 2, 3, 4, 5;
+
+insert into partial_event_spans
+select
+  event,
+  yr,
+  start_dt,
+  end_dt
+from new_event_spans;
@@ -0,0 +1,119 @@
+/* Event propensity model - Incremental features - Merge the partials of the snapshot periods into */
+/*                                                  the per-customer tables of 01_unload_data.sql */
+/*   The snap_ views hold the periods of the four years before {1} (see src/feature_utils.py), {2} */
+/*   starts the base population's two years, {3} the last year and {4} the lines in no partial yet */
+
+-- customers with an employee discount on any line from their acquisition on
+create temp table snap_employees as
+select cust_key from cust_period where employee_disc_ind = 1
+union
+select cust_key from snap_edge_cust_period where employee_disc_ind = 1
+union
+select
+  trans.cust_key
+from analytics_user_vws.liveramp_trans{0} as trans
+inner join analytics_user_vws.liveramp_funnel{0} as funnel
+  on trans.cust_key = funnel.cust_key and trans.sale_dt >= funnel.acq_dt
+where trans.sale_dt >= '{4}'
+  and trans.spend_discount_employee_ind = 1;
+
+-- base_population, with the persona and acquisition date of the unload
+create temp table snap_base as
+select
+  cust.cust_key,
+  persona.persona,
+  funnel.acq_dt
+from analytics_user_vws.liveramp_customers{0} as cust
+inner join (
+  select
+    cust_key
+  from snap_cust_period
+  where period_start >= '{2}'
+  group by cust_key
+  having max(fl_merch_ind) = 1
+) as merch
+  on cust.cust_key = merch.cust_key
+inner join analytics_user_vws.liveramp_model_personas_clusters{0} as persona
+  on cust.cust_key = persona.cust_key
+inner join analytics_user_vws.liveramp_funnel{0} as funnel
+  on cust.cust_key = funnel.cust_key
+where cust.current_employee_ind = 0
+  and cust.cust_key not in (select cust_key from snap_employees);
+
+select
+  base.cust_key,
+  base.persona,
+  base.acq_dt,
+  coalesce(loyal.loyalty_tender_ind,0) as loyalty_tender_ind,
+  coalesce(loyal.loyalty_nontender_ind,0) as loyalty_nontender_ind
+from snap_base as base
+left join analytics_user_vws.liveramp_loyalty{0} as loyal
+  on base.cust_key = loyal.cust_key;
+
+-- cust_stats, cust_pct_spend_in_event and cust_event_shopped_ly
+select
+  stats.cust_key,
+  sum(stats.fl_items) as fl_items,
+  sum(stats.sale_items) as sale_items,
+  sum(stats.fl_spend) as fl_spend,
+  sum(stats.merch_spend) as merch_spend,
+  sum(stats.womens_prod_spend) as womens_prod_spend,
+  sum(stats.mens_prod_spend) as mens_prod_spend,
+  sum(stats.accessories_spend) as accessories_spend,
+  sum(stats.apparel_spend) as apparel_spend,
+  sum(stats.babypet_spend) as babypet_spend,
+  sum(stats.bag_spend) as bag_spend,
+  sum(stats.beauty_spend) as beauty_spend,
+  sum(stats.entertainment_spend) as entertainment_spend,
+  sum(stats.food_spend) as food_spend,
+  sum(stats.home_spend) as home_spend,
+  sum(stats.jewelry_spend) as jewelry_spend,
+  sum(stats.other_spend) as other_spend,
+  sum(stats.shoe_spend) as shoe_spend,
+  sum(stats.giftcard_spend) as giftcard_spend,
+  sum(stats.web_spend) as web_spend,
+  sum(stats.rack_spend) as rack_spend,
+  sum(stats.jwn_spend) as jwn_spend,
+  sum(stats.fl_trips) as fl_trips,
+  max(stats.fl_last_sale_dt) as fl_last_sale_dt,
+  max(case when stats.period_start >= '{3}' and stats.fl_items > 0 then 1 else 0 end) as fl_shopped_ly_ind,
+  sum(case when stats.period_start >= '{3}' then stats.fl_spend else 0 end) as fl_spend_ly,
+  sum(case when stats.period_start >= '{3}' then stats.fl_trips else 0 end) as fl_trips_ly,
+  sum(stats.fl_event_day_spend) as fl_event_day_spend,
+  {5}
+from snap_cust_period as stats
+inner join snap_base as base
+  on stats.cust_key = base.cust_key
+group by stats.cust_key;
+
+select
+  divs.cust_key,
+  count(distinct divs.prod_div) as fl_divs
+from snap_cust_period_div as divs
+inner join snap_base as base
+  on divs.cust_key = base.cust_key
+group by divs.cust_key;
+
+select
+  channels.cust_key,
+  count(distinct channels.intent_channel) as jwn_channels
+from snap_cust_period_channel as channels
+inner join snap_base as base
+  on channels.cust_key = base.cust_key
+group by channels.cust_key;
+
+-- cust_pct_events_shopped: a span counts as shopped if its last FL sale is in the four years
+select
+  base.cust_key,
+  {6}
+from snap_base as base
+inner join snap_event_spans as edates
+  on base.acq_dt <= edates.end_dt
+left join cust_event_shop as shop
+  on base.cust_key = shop.cust_key
+    and edates.event = shop.event
+    and edates.yr = shop.yr
+    and edates.start_dt = shop.start_dt
+    and edates.end_dt = shop.end_dt
+    and shop.last_sale_dt >= '{7}'
+group by base.cust_key;
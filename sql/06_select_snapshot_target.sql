@@ -0,0 +1,12 @@
+/* Event propensity model - Incremental features - The customers of snap_base that shopped FL in */
+/*                                                  the target span, {1} to {2} (see src/feature_utils.py) */
+
+select
+  trans.cust_key,
+  1 as target_shopped_ind
+from analytics_user_vws.liveramp_trans{0} as trans
+inner join snap_base as base
+  on trans.cust_key = base.cust_key and trans.sale_dt >= base.acq_dt
+where trans.sale_dt between '{1}' and '{2}'
+  and trans.intent_channel in ('FLS','N.COM')
+group by trans.cust_key;
@@ -0,0 +1,155 @@
+''' Functions for writing and reading the sample/train/test data artifacts
+
+Artifacts are addressed by their path without an extension (e.g.,
+'../data/ep_annpub17_scaled_train_sample') and stored in one of the
+formats in ARTIFACT_EXTENSIONS:
+
+    csv      pipe-delimited gzip, the original export format
+    parquet  columnar, compressed, supports column projection and row filters
+    feather  Arrow IPC, uncompressed, memory-mapped on read
+
+Parquet and feather need pyarrow, which is only imported when used.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+ARTIFACT_EXTENSIONS = {'csv': '.csv.gz', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.feather
+    except ImportError:
+        raise ImportError('The parquet and feather artifact formats require pyarrow (pip install pyarrow)')
+    return pyarrow
+
+
+def artifact_path(path, fmt):
+    ''' Returns the file name of the artifact at path (no extension) in format fmt '''
+    if fmt not in ARTIFACT_EXTENSIONS:
+        raise ValueError('Unknown artifact format {0}, expected one of {1}'.format(fmt, sorted(ARTIFACT_EXTENSIONS)))
+    return path + ARTIFACT_EXTENSIONS[fmt]
+
+
+def find_artifact(path):
+    ''' Returns (filename, fmt) of the most recently written artifact at path, so that one left
+    in another format by an earlier run is not read instead (columnar formats first on a tie) '''
+    found = []
+    for rank, fmt in enumerate(['feather', 'parquet', 'csv']):
+        filename = artifact_path(path, fmt)
+        if os.path.exists(filename):
+            found.append((-os.path.getmtime(filename), rank, filename, fmt))
+    if not found:
+        raise IOError('No artifact found for {0}'.format(path))
+    return min(found)[2:]
+
+
+def downcast_frame(df):
+    ''' Downcasts numeric columns in place: integers to the smallest integer type that holds
+    them, floats to float32 '''
+    for col in df.columns:
+        if pd.api.types.is_bool_dtype(df[col]):
+            continue
+        if pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        elif pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+def write_artifact(df, path, fmt='parquet', downcast=True):
+    ''' Writes df to path (no extension) in format fmt and returns the file name
+
+    Parameters
+    ----------
+    df : DataFrame
+    path : str
+        artifact path without extension
+    fmt : str
+        'parquet', 'feather' or 'csv'
+    downcast : bool
+        store integers in their smallest type and floats as float32 (columnar formats only,
+        the csv export is written as is)
+
+    Returns
+    -------
+    str
+    '''
+    filename = artifact_path(path, fmt)
+    if fmt == 'csv':
+        df.to_csv(filename, index=False, sep='|', compression='gzip')
+        return filename
+
+    _import_pyarrow()
+    df = df.reset_index(drop=True)
+    if downcast:
+        df = downcast_frame(df.copy())
+    if fmt == 'parquet':
+        df.to_parquet(filename, engine='pyarrow', index=False)
+    else:
+        df.to_feather(filename, compression='uncompressed')
+    return filename
+
+
+def read_artifact(path, columns=None, persona=None, fmt=None, partition='persona'):
+    ''' Reads the artifact at path (no extension)
+
+    Parameters
+    ----------
+    path : str
+        artifact path without extension
+    columns : list of str, optional
+        only read these columns
+    persona : int or list of int, optional
+        only return rows of these partition values
+    fmt : str, optional
+        format to read, by default that of the most recently written artifact (find_artifact)
+    partition : str
+        partition column that persona filters on
+
+    Returns
+    -------
+    DataFrame
+
+    Example use
+    -----------
+    read_artifact('../data/ep_annpub17_unscaled_train_sample',
+                  columns=['cust_key','persona','target_shopped_ind','log_fl_total_spend'],
+                  persona=3)
+    '''
+    if fmt is None:
+        filename, fmt = find_artifact(path)
+    else:
+        filename = artifact_path(path, fmt)
+
+    personas = None
+    if persona is not None:
+        personas = list(persona) if isinstance(persona, (list, tuple, set)) else [persona]
+    read_columns = columns
+    if columns is not None and personas is not None and partition not in columns:
+        read_columns = list(columns) + [partition]
+
+    if fmt == 'csv':
+        df = pd.read_csv(filename, header=0, sep='|', compression='gzip', usecols=read_columns)
+        if read_columns is not None:
+            df = df[read_columns]
+    else:
+        pa = _import_pyarrow()
+        if fmt == 'parquet':
+            filters = None if personas is None else [(partition, 'in', personas)]
+            table = pa.parquet.read_table(filename, columns=read_columns, filters=filters, memory_map=True)
+        else:
+            table = pa.feather.read_table(filename, columns=read_columns, memory_map=True)
+        df = table.to_pandas()
+
+    if personas is not None:
+        df = df.loc[df[partition].isin(personas)].reset_index(drop=True)
+    if columns is not None and read_columns is not columns:
+        df = df[list(columns)]
+    return df
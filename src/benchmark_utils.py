@@ -0,0 +1,304 @@
+''' Offline benchmarks of the pipeline on synthetic extracts
+
+run_benchmarks generates an extract of the UNLOAD's columns (synthetic_utils;
+reused while its parameters are unchanged) and times the hot stages on it,
+each in a fresh process, so the peak memory of every stage is its own:
+
+    sample_<mode>  sample_downloaded_data with each sample mode (the shards of a
+                   sharded extract with sample_downloaded_shards)
+    scale          scale_data on the train/test split of the sample
+    write_<fmt>    au.write_artifact of the scaled train sample in each format
+    fit            a LogisticRegression fit per persona on the scaled train sample,
+                   its missing values filled in (fill_missing)
+    score          scoring_utils.score_extract of the full extract with those models
+
+The spans of the stages (trace_utils) make the results: their summary by path,
+with the wall and CPU time, rows, bytes, throughput and peak RSS of every
+stage, is saved as JSON with the configuration, the git version and the
+platform.  compare lists the stages that got slower or bigger than in the
+results of an earlier version.
+
+Example use
+===========
+config = dict(DEFAULT_CONFIG, n_rows=10000000)
+summary = run_benchmarks('temp/bench', config, results_file='temp/bench/results_v2.json')
+compare('temp/bench/results_v2.json', 'temp/bench/results_v1.json')
+'''
+
+import os
+import sys
+import json
+import glob
+import pickle
+import datetime
+import platform
+import subprocess
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import event_model_utils as emu
+import pipeline_utils as pu
+import artifact_utils as au
+import schema_utils as sch
+import scoring_utils as scu
+import synthetic_utils as syn
+import transform_utils as tfu
+import trace_utils as tr
+
+
+logger = emu.logger
+
+BENCHMARKS = ['sample', 'scale', 'write', 'fit', 'score']
+
+# The parameters of the extract; any change generates a new one
+EXTRACT_KEYS = ['n_rows', 'pos_rate', 'n_personas', 'n_shards', 'null_rate', 'seed']
+
+DEFAULT_CONFIG = {
+    'n_rows': 1000000,
+    'pos_rate': 0.1,
+    'n_personas': 6,
+    'n_shards': None,
+    # nulls in the columns the UNLOAD may leave null, filled in (fill_missing) for the
+    # LogisticRegression of fit and score, which takes none
+    'null_rate': 0.01,
+    'seed': 1,
+    'sample_size': 250000,
+    'sample_seed': 30132,
+    'sample_modes': ['stream'],
+    'chunksize': 500000,
+    'train_size': 0.7,
+    'split_state': 8379,
+    'log_features': ['fl_total_spend', 'fl_total_trips', 'fl_avg_spend_per_trip',
+                     'fl_total_spend_ly', 'fl_total_trips_ly', 'fl_avg_spend_per_trip_ly'],
+    'formats': ['parquet', 'feather', 'csv'],
+    'fit_max_iter': 200,
+    'score_chunksize': 100000,
+    'n_jobs': None,
+}
+
+
+def _version():
+    # The git version of the source, if it is a checkout
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('utf-8').strip()
+
+
+def _extract(work_dir, config, sql_path):
+    # The synthetic extract of config, generated unless the one of work_dir has the same parameters
+    spec = dict((key, config[key]) for key in EXTRACT_KEYS)
+    out_handle = os.path.join(work_dir, 'ep_synth_{0}_'.format(config['n_rows']))
+    spec_file = out_handle + 'spec.json'
+    filenames = sorted(glob.glob(out_handle + ('*_part_*.gz' if config['n_shards'] else '000.gz')))
+    if filenames and os.path.exists(spec_file):
+        with open(spec_file, 'r') as f:
+            if json.load(f) == json.loads(json.dumps(spec)):
+                logger.info('Using the synthetic extract of {0} rows in {1}'.format(config['n_rows'], work_dir))
+                return filenames
+    for filename in glob.glob(out_handle + '*.gz'):
+        os.remove(filename)
+    filenames = syn.generate_extract(out_handle, config['n_rows'], pos_rate=config['pos_rate'],
+                                     n_personas=config['n_personas'], n_shards=config['n_shards'],
+                                     null_rate=config['null_rate'], seed=config['seed'], sql_path=sql_path)
+    with open(spec_file, 'w') as f:
+        json.dump(spec, f)
+    return filenames
+
+
+def _path(work_dir, name):
+    return os.path.join(work_dir, 'bench_{0}.pkl'.format(name))
+
+
+def _dump(work_dir, name, obj):
+    with open(_path(work_dir, name), 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+
+def _load(work_dir, name):
+    with open(_path(work_dir, name), 'rb') as f:
+        return pickle.load(f)
+
+
+def fill_missing(df):
+    ''' Fills the missing values of the scaled features with 0, their training mean (the
+    transform_fn of score, so module level) '''
+    return df.fillna(0)
+
+
+def _bench_sample(work_dir, filenames, config, sql_path, mode):
+    dtypes = sch.unload_dtypes(sql_path)
+    with tr.span('sample_' + mode):
+        if len(filenames) > 1:
+            sample, _ = emu.sample_downloaded_shards(filenames, list(dtypes), config['sample_size'],
+                                                     config['sample_seed'], n_jobs=config['n_jobs'],
+                                                     chunksize=config['chunksize'], dtypes=dtypes)
+        else:
+            sample, _ = emu.sample_downloaded_data(filenames[0], config['sample_size'], config['sample_seed'],
+                                                   sample_mode=mode, chunksize=config['chunksize'], dtypes=dtypes)
+    _dump(work_dir, 'sample', sample)
+
+
+def _bench_scale(work_dir, config):
+    from sklearn.model_selection import train_test_split
+    sample = tfu.log_transform(_load(work_dir, 'sample'), config['log_features'], emu.logm1)
+    features = [col for col in sample.columns if col not in ['cust_key', 'persona', 'target_shopped_ind']]
+    train, test = train_test_split(sample, train_size=config['train_size'], random_state=config['split_state'],
+                                   stratify=10 * sample['persona'].astype(np.int64) + sample['target_shopped_ind'])
+    with tr.span('scale') as sp:
+        scaled_train, scaled_test = emu.scale_data(train, test, features)
+        sp.add(rows=len(train) + len(test))
+    _dump(work_dir, 'scaled_train', scaled_train)
+    _dump(work_dir, 'scaler', {'features': features, 'scaler': tfu.StreamingScaler(features).fit(train)})
+
+
+def _bench_write(work_dir, fmt):
+    df = _load(work_dir, 'scaled_train')
+    with tr.span('write_' + fmt) as sp:
+        filename = au.write_artifact(df, os.path.join(work_dir, 'bench_scaled_train'), fmt)
+        sp.add(rows=len(df), bytes=os.path.getsize(filename))
+
+
+def _bench_fit(work_dir, config):
+    from sklearn.linear_model import LogisticRegression
+    df = fill_missing(_load(work_dir, 'scaled_train'))
+    features = _load(work_dir, 'scaler')['features']
+    models = {}
+    with tr.span('fit') as sp:
+        for persona, group in df.groupby('persona'):
+            with tr.span('persona', persona=int(persona)) as persona_sp:
+                models[persona] = LogisticRegression(max_iter=config['fit_max_iter']).fit(
+                    group[features], group['target_shopped_ind'].values)
+                persona_sp.add(rows=len(group))
+        sp.add(rows=len(df))
+    _dump(work_dir, 'models', models)
+
+
+def _bench_score(work_dir, filenames, config, sql_path):
+    scaler = _load(work_dir, 'scaler')
+    dtypes = sch.unload_dtypes(sql_path)
+    with tr.span('score'):
+        scu.score_extract(filenames, _path(work_dir, 'models'), os.path.join(work_dir, 'bench_scores.csv.gz'),
+                          features=scaler['features'], scaler=scaler, log_features=config['log_features'],
+                          log_fn=emu.logm1, transform_fn=fill_missing, names=list(dtypes) if len(filenames) > 1 else None,
+                          chunksize=config['score_chunksize'], n_jobs=config['n_jobs'], dtypes=dtypes)
+
+
+def run_benchmarks(work_dir, config=None, benchmarks=None, results_file=None, sql_path=os.path.join('..','sql')):
+    ''' Runs the benchmarks on a synthetic extract and returns the summary of their spans
+
+    Parameters
+    ----------
+    work_dir : str
+        where the extract, the intermediate samples and models are kept
+    config : dict, optional
+        DEFAULT_CONFIG updated with these
+    benchmarks : list of str, optional
+        of BENCHMARKS, by default all; each needs the output of the ones before it
+    results_file : str, optional
+        JSON file to save the results to (see compare)
+    sql_path : str
+
+    Returns
+    -------
+    DataFrame
+        trace_utils.summary of the run
+    '''
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    benchmarks = BENCHMARKS if benchmarks is None else benchmarks
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    with tr.span('benchmark', n_rows=config['n_rows']) as root:
+        filenames = _extract(work_dir, config, sql_path)
+        # Every stage runs in its own process, so its peak RSS is its own
+        if 'sample' in benchmarks:
+            for mode in config['sample_modes']:
+                pu.run_in_process(_bench_sample, work_dir, filenames, config, sql_path, mode)
+        if 'scale' in benchmarks:
+            pu.run_in_process(_bench_scale, work_dir, config)
+        if 'write' in benchmarks:
+            for fmt in config['formats']:
+                pu.run_in_process(_bench_write, work_dir, fmt)
+        if 'fit' in benchmarks:
+            pu.run_in_process(_bench_fit, work_dir, config)
+        if 'score' in benchmarks:
+            pu.run_in_process(_bench_score, work_dir, filenames, config, sql_path)
+
+    span_records = tr.pop(root.id)
+    summary = tr.summary(span_records)
+    if results_file is not None:
+        results = {'created': datetime.datetime.now().isoformat(), 'version': _version(),
+                   'python': platform.python_version(), 'platform': platform.platform(),
+                   'cpu_count': multiprocessing.cpu_count(), 'config': config,
+                   'summary': json.loads(summary.reset_index().to_json(orient='records')),
+                   'spans': span_records}
+        with open(results_file, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True, default=str)
+    return summary
+
+
+def load_results(results_file):
+    ''' Returns the saved results and their summary as a DataFrame indexed by path '''
+    with open(results_file, 'r') as f:
+        results = json.load(f)
+    return results, pd.DataFrame(results['summary']).set_index('path')
+
+
+def compare(results_file, baseline_file, tolerance=0.25, min_seconds=0.5, min_mb=50.0):
+    ''' Returns the stages of results_file that got slower or bigger than in baseline_file
+
+    Parameters
+    ----------
+    results_file, baseline_file : str
+        saved by run_benchmarks
+    tolerance : float
+        the relative growth allowed
+    min_seconds, min_mb : float
+        the growth of the wall time per call and of the peak RSS below which a stage is never
+        reported
+
+    Returns
+    -------
+    DataFrame
+        indexed by path and metric (wall_s_per_call or peak_rss_mb): value, baseline and ratio
+    '''
+    results, summary = load_results(results_file)
+    baseline, baseline_summary = load_results(baseline_file)
+    if results['config'] != baseline['config']:
+        logger.warning('The results of {0} and {1} were run with different configurations'.format(
+            results_file, baseline_file))
+
+    slower = tr.regressions(summary, baseline_summary, tolerance, min_seconds)
+    slower = slower.rename(columns={'wall_s_per_call': 'value', 'baseline_s_per_call': 'baseline'})
+    slower['metric'] = 'wall_s_per_call'
+
+    both = summary[['peak_rss_mb']].join(baseline_summary[['peak_rss_mb']], rsuffix='_baseline', how='inner')
+    bigger = ((both['peak_rss_mb'] > (1 + tolerance) * both['peak_rss_mb_baseline'])
+              & (both['peak_rss_mb'] - both['peak_rss_mb_baseline'] >= min_mb))
+    bigger = pd.DataFrame({'value': both['peak_rss_mb'], 'baseline': both['peak_rss_mb_baseline'],
+                           'ratio': both['peak_rss_mb'] / both['peak_rss_mb_baseline'],
+                           'metric': 'peak_rss_mb'}).loc[bigger]
+
+    out = pd.concat([slower, bigger])
+    out.index.name = 'path'
+    return out.set_index('metric', append=True)[['value', 'baseline', 'ratio']]
+
+
+if __name__ == '__main__':
+
+    config = dict(DEFAULT_CONFIG, n_rows=int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
+    work_dir = os.path.join('temp', 'bench')
+    version = _version() or 'local'
+    results_file = os.path.join(work_dir, 'results_{0}_{1}.json'.format(config['n_rows'], version))
+
+    summary = run_benchmarks(work_dir, config, results_file=results_file)
+    print(summary.to_string())
+
+    baseline_file = os.path.join(work_dir, 'results_{0}_baseline.json'.format(config['n_rows']))
+    if os.path.exists(baseline_file):
+        print(compare(results_file, baseline_file).to_string())
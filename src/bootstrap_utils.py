@@ -0,0 +1,183 @@
+''' Bootstrapped elastic net coefficients, per partition, across a process pool
+
+A bootstrap replicate is represented by integer sample weights (how often each
+row was drawn with replacement) instead of a resampled copy of X, so the data
+is never copied.  Each partition's X and y are written once to numpy memmaps
+that the workers map read-only, and replicates are queued in batches of all
+partitions on one process pool.
+
+Workers keep running aggregates of the coefficients of their batch (count,
+mean, sum of squared deviations and times selected) and the parent merges
+them, so memory does not grow with the number of replicates.  The result is
+the prop_selected / mean_coef / abs_mean_coef / std table of every partition.
+
+Example use
+===========
+coefs = partition_bootstrap_coefs(sdf_train, 'persona', keep_features, 'target_shopped_ind',
+                                  n_resample=1000, resample_rs=4040, sgd_rs=8889,
+                                  loss='log', penalty='elasticnet', max_iter=1000,
+                                  alpha=0.001, l1_ratio=0.4)
+'''
+
+import os
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from sklearn.linear_model import SGDClassifier
+
+import trace_utils as tr
+
+
+logger = logging.getLogger('events_logger')
+
+# Worker state, set by _init_worker in each pool process
+_worker = {}
+
+
+def bootstrap_weights(n, rng):
+    ''' Returns how often each of n rows is drawn in a resample of size n with replacement '''
+    return np.bincount(rng.randint(0, n, n), minlength=n)
+
+
+def _new_aggregate(n_features):
+    return {'n': 0, 'mean': np.zeros(n_features), 'm2': np.zeros(n_features), 'selected': np.zeros(n_features)}
+
+
+def _update_aggregate(agg, coef, threshold):
+    # Welford's update with one replicate's coefficients
+    agg['n'] += 1
+    delta = coef - agg['mean']
+    agg['mean'] += delta / agg['n']
+    agg['m2'] += delta * (coef - agg['mean'])
+    agg['selected'] += np.absolute(coef) > threshold
+
+
+def _merge_aggregates(a, b):
+    # Chan et al.'s pairwise combination of two running aggregates
+    if a['n'] == 0:
+        return b
+    n = a['n'] + b['n']
+    delta = b['mean'] - a['mean']
+    return {'n': n,
+            'mean': a['mean'] + delta * b['n'] / n,
+            'm2': a['m2'] + b['m2'] + delta ** 2 * a['n'] * b['n'] / n,
+            'selected': a['selected'] + b['selected']}
+
+
+def _init_worker(shared, sgd_kwargs, threshold):
+    _worker['shared'] = shared
+    _worker['sgd_kwargs'] = sgd_kwargs
+    _worker['threshold'] = threshold
+    _worker['arrays'] = {}
+
+
+def _load(filename):
+    # Maps a shared array once per worker process
+    if filename not in _worker['arrays']:
+        _worker['arrays'][filename] = np.load(filename, mmap_mode='r')
+    return _worker['arrays'][filename]
+
+
+def _fit_batch(task):
+    key, batch, seeds = task
+    X = _load(_worker['shared'][key]['X'])
+    y = _load(_worker['shared'][key]['y'])
+    agg = _new_aggregate(X.shape[1])
+    for resample_seed, sgd_seed in seeds:
+        weights = bootstrap_weights(len(y), np.random.RandomState(resample_seed))
+        mdl = SGDClassifier(random_state=sgd_seed, **_worker['sgd_kwargs'])
+        mdl.fit(X, y, sample_weight=weights)
+        _update_aggregate(agg, mdl.coef_[0], _worker['threshold'])
+    return key, batch, agg
+
+
+def _coef_table(agg, features):
+    std = np.sqrt(agg['m2'] / (agg['n'] - 1)) if agg['n'] > 1 else np.full(len(features), np.nan)
+    df = pd.DataFrame({'prop_selected': agg['selected'] / agg['n'], 'mean_coef': agg['mean'],
+                       'abs_mean_coef': np.absolute(agg['mean']), 'std': std},
+                      index=pd.Index(features, name='feature'))
+    return df[['prop_selected', 'mean_coef', 'abs_mean_coef', 'std']]
+
+
+def partition_bootstrap_coefs(df, partition, features, target, n_resample=100, resample_rs=None, sgd_rs=None,
+                              n_jobs=None, batch_size=None, threshold=1e-6, **sgd_kwargs):
+    ''' Bootstraps SGDClassifier coefficients on every partition of df in one process pool
+
+    Parameters
+    ----------
+    df : DataFrame
+    partition : str
+        column to bootstrap each value of separately (e.g., 'persona')
+    features : list of str, dict or Series
+        feature columns, or feature columns by partition value
+    target : str
+        target column
+    n_resample : int
+        bootstrap replicates per partition
+    resample_rs, sgd_rs : int, optional
+        replicate i resamples with seed resample_rs+i and fits with random_state sgd_rs+i
+    n_jobs : int, optional
+        worker processes, by default the number of cores
+    batch_size : int, optional
+        replicates per task, by default about four tasks per process and partition
+    threshold : float
+        a coefficient counts as selected when its absolute value exceeds this
+    **sgd_kwargs
+        arguments of SGDClassifier
+
+    Returns
+    -------
+    DataFrame
+        prop_selected, mean_coef, abs_mean_coef and std, indexed by (partition, feature)
+    '''
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    batch_size = batch_size or max(1, -(-n_resample // (4 * n_jobs)))
+    if resample_rs is None:
+        resample_seeds = np.random.randint(0, 2**31 - 1, n_resample).tolist()
+    else:
+        resample_seeds = [resample_rs + i for i in range(n_resample)]
+    sgd_seeds = [None if sgd_rs is None else sgd_rs + i for i in range(n_resample)]
+    seeds = list(zip(resample_seeds, sgd_seeds))
+
+    mm_dir = tempfile.mkdtemp(prefix='ep_bootstrap_')
+    try:
+        shared = {}
+        columns = {}
+        for i, (key, g) in enumerate(df.groupby(partition)):
+            columns[key] = list(features[key]) if isinstance(features, (dict, pd.Series)) else list(features)
+            shared[key] = {'X': os.path.join(mm_dir, 'p{0}_X.npy'.format(i)),
+                           'y': os.path.join(mm_dir, 'p{0}_y.npy'.format(i))}
+            np.save(shared[key]['X'], np.ascontiguousarray(g[columns[key]].values, dtype=np.float64))
+            np.save(shared[key]['y'], g[target].values)
+
+        tasks = [(key, b, seeds[b:b + batch_size]) for key in sorted(shared) for b in range(0, n_resample, batch_size)]
+        with tr.span('bootstrap', 'Fitting {0} bootstrap replicates for {1} partitions on {2} processes'.format(
+                n_resample, len(shared), n_jobs), replicates=n_resample, n_jobs=n_jobs) as sp:
+            batches = dict([(key, {}) for key in shared])
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(shared, sgd_kwargs, threshold))
+            try:
+                for key, batch, agg in pool.imap_unordered(_fit_batch, tasks):
+                    batches[key][batch] = agg
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            sp.add(rows=len(df))
+    finally:
+        shutil.rmtree(mm_dir, ignore_errors=True)
+
+    # Batches are merged in replicate order, so the result does not depend on n_jobs scheduling
+    keys = sorted(shared)
+    aggs = {}
+    for key in keys:
+        aggs[key] = _new_aggregate(len(columns[key]))
+        for batch in sorted(batches[key]):
+            aggs[key] = _merge_aggregates(aggs[key], batches[key][batch])
+    return pd.concat([_coef_table(aggs[key], columns[key]) for key in keys], keys=keys, names=[partition, 'feature'])
@@ -0,0 +1,251 @@
+''' Versioned bundles of the per-persona models and everything needed to score with them
+
+A bundle holds, for one (event, year) and model family,
+
+    manifest.json     personas, the exact input columns of every persona's model, the
+                      log_features, log_fn and transform_fn (by module and name), versions
+    scaler.joblib     the scaler of the training sample and its columns, if used
+    model_<p>.joblib  the fitted model of persona p
+
+Bundles are written to <path>/v<n>, a new version every save, and load_bundle
+opens the latest one unless asked for another.  Loading only reads the
+manifest; a persona's model is loaded when it is first used, so a scoring
+process starts without re-fitting anything or re-deriving feature lists.  The
+numpy attributes of a model (e.g., the coefficients of a linear model) are
+memory-mapped rather than read; the node arrays of scikit-learn trees are not,
+as unpickling a Tree copies them into memory (tree_utils.FlatEnsemble holds
+them flat for scoring).
+
+Example use
+===========
+save_bundle('../data/ep_annpub17_gradboost_bundle', gbcs, gb_features,
+            log_features=params['log_features'], log_fn=emu.logm1,
+            metadata={'event': 'anniversary_public_event', 'year': 2017})
+bundle = load_bundle('../data/ep_annpub17_gradboost_bundle')
+scores = bundle.predict_proba(bundle.transform(chunk))
+'''
+
+import os
+import sys
+import json
+import shutil
+import datetime
+import importlib
+
+import numpy as np
+import pandas as pd
+
+import transform_utils as tfu
+
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+
+
+MANIFEST = 'manifest.json'
+
+
+def transform_chunk(df, log_features=None, log_fn=np.log, scaler=None, transform_fn=None):
+    ''' Applies the transforms of prepare_sample to a chunk of the extract
+
+    Parameters
+    ----------
+    df : DataFrame
+    log_features : list of str, optional
+        columns replaced by log_fn of themselves and renamed to log_<col>
+    log_fn : function
+    scaler : dict, optional
+        {'features': [...], 'scaler': fitted StreamingScaler or StandardScaler}, as saved by
+        prepare_sample
+    transform_fn : function, optional
+        applied to the transformed chunk last, e.g., to derive model specific columns
+    '''
+    df = tfu.log_transform(df, log_features, log_fn)
+    if isinstance(scaler, dict) and isinstance(scaler['scaler'], tfu.StreamingScaler):
+        df = scaler['scaler'].transform(df, copy=False)
+    elif scaler is not None:
+        scaled = scaler['scaler'].transform(df[scaler['features']])
+        df[scaler['features']] = pd.DataFrame(scaled, index=df.index, columns=scaler['features'])
+    if transform_fn is not None:
+        df = transform_fn(df)
+    return df
+
+
+def predict_by_group(df, models, features, group_col='persona'):
+    ''' Returns the positive class probability of every row from the model of its group (NaN if none) '''
+    scores = np.full(len(df), np.nan)
+    groups = df[group_col].values
+    for key, mdl in models.items():
+        rows = np.flatnonzero(groups == key)
+        if len(rows):
+            scores[rows] = mdl.predict_proba(df.iloc[rows][features[key]])[:, 1]
+    return scores
+
+
+def fn_ref(fn):
+    ''' Returns 'module:name' of a module level function, so it can be stored in a manifest '''
+    if fn is None:
+        return None
+    module = fn.__module__
+    if module == '__main__':
+        # e.g., logm1 of event_model_utils run as a script
+        module = os.path.splitext(os.path.basename(sys.modules['__main__'].__file__))[0]
+    if fn.__name__ == '<lambda>' or getattr(sys.modules.get(fn.__module__), fn.__name__, None) is not fn:
+        raise ValueError('{0} is not a module level function and cannot be referenced'.format(fn))
+    return '{0}:{1}'.format(module, fn.__name__)
+
+
+def resolve_fn(ref):
+    ''' Returns the function a fn_ref points to '''
+    if ref is None:
+        return None
+    module, name = ref.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def _versions(path):
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(d[1:]) for d in os.listdir(path) if d.startswith('v') and d[1:].isdigit())
+
+
+def _persona_key(key):
+    # JSON keys are strings, the personas of the model dicts are integers
+    try:
+        return int(key)
+    except ValueError:
+        return key
+
+
+def save_bundle(path, models, features, scaler=None, log_features=None, log_fn=None, transform_fn=None,
+                metadata=None):
+    ''' Saves a new version of the bundle at path and returns its directory
+
+    Parameters
+    ----------
+    path : str
+        bundle directory, versions are saved in path/v1, path/v2, ...
+    models : dict
+        fitted models by persona
+    features : list of str or dict
+        input columns of the models (by persona), in the order they were fit on
+    scaler : dict, optional
+        {'features': [...], 'scaler': fitted scaler}, as saved by prepare_sample
+    log_features : list of str, optional
+    log_fn, transform_fn : function, optional
+        module level functions, see transform_chunk
+    metadata : dict, optional
+        stored in the manifest as is (e.g., event, year, params)
+
+    Returns
+    -------
+    str
+    '''
+    import sklearn
+
+    versions = _versions(path)
+    version = versions[-1] + 1 if versions else 1
+    bundle_dir = os.path.join(path, 'v{0}'.format(version))
+    staging = bundle_dir + '.tmp'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+
+    if not isinstance(features, (dict, pd.Series)):
+        features = dict((key, features) for key in models)
+    manifest = {
+        'version': version,
+        'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'sklearn_version': sklearn.__version__,
+        'personas': [str(key) for key in sorted(models)],
+        'model_class': sorted(set(type(mdl).__name__ for mdl in models.values())),
+        'features': dict((str(key), list(features[key])) for key in models),
+        'log_features': log_features,
+        'log_fn': fn_ref(log_fn),
+        'transform_fn': fn_ref(transform_fn),
+        'scaled': scaler is not None,
+        'metadata': metadata or {},
+    }
+    # Uncompressed, so the numpy attributes can be memory-mapped when loaded (not tree nodes,
+    # which sklearn copies when it unpickles a Tree)
+    for key, mdl in models.items():
+        joblib.dump(mdl, os.path.join(staging, 'model_{0}.joblib'.format(key)))
+    if scaler is not None:
+        joblib.dump(scaler, os.path.join(staging, 'scaler.joblib'))
+    with open(os.path.join(staging, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, default=str)
+    os.rename(staging, bundle_dir)
+    return bundle_dir
+
+
+def load_bundle(path, version=None, mmap_mode='r'):
+    ''' Opens version (by default the latest) of the bundle at path '''
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return ModelBundle(path, mmap_mode)
+    versions = _versions(path)
+    if not versions:
+        raise IOError('No bundle found at {0}'.format(path))
+    version = versions[-1] if version is None else version
+    return ModelBundle(os.path.join(path, 'v{0}'.format(version)), mmap_mode)
+
+
+class ModelBundle(object):
+    ''' One version of a saved bundle, loading models and the scaler on first use '''
+
+    def __init__(self, bundle_dir, mmap_mode='r'):
+        self.bundle_dir = bundle_dir
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(bundle_dir, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        self.personas = [_persona_key(key) for key in self.manifest['personas']]
+        self.features = dict((_persona_key(key), cols) for key, cols in self.manifest['features'].items())
+        self.log_features = self.manifest['log_features']
+        self._models = {}
+        self._scaler = None
+
+    def model(self, persona):
+        if persona not in self._models:
+            filename = os.path.join(self.bundle_dir, 'model_{0}.joblib'.format(persona))
+            self._models[persona] = joblib.load(filename, mmap_mode=self.mmap_mode)
+        return self._models[persona]
+
+    @property
+    def models(self):
+        return dict((key, self.model(key)) for key in self.personas)
+
+    @property
+    def scaler(self):
+        if self.manifest['scaled'] and self._scaler is None:
+            self._scaler = joblib.load(os.path.join(self.bundle_dir, 'scaler.joblib'))
+        return self._scaler
+
+    @property
+    def log_fn(self):
+        return resolve_fn(self.manifest['log_fn']) or np.log
+
+    @property
+    def transform_fn(self):
+        return resolve_fn(self.manifest['transform_fn'])
+
+    def input_columns(self, persona):
+        ''' Returns the columns of the extract the scaler and the model of persona (if it has one)
+        read, or None with a transform_fn, which may derive some '''
+        if self.manifest['transform_fn'] is not None:
+            return None
+        scaled = self.manifest['scaled'] and self.scaler['features'] or []
+        raw = dict(('log_' + col, col) for col in self.log_features or [])
+        columns = []
+        for col in list(self.features.get(persona, [])) + list(scaled):
+            col = raw.get(col, col)
+            if col not in columns:
+                columns.append(col)
+        return columns
+
+    def transform(self, df):
+        ''' Applies the bundle's transforms to a chunk of the extract '''
+        return transform_chunk(df, self.log_features, self.log_fn, self.scaler, self.transform_fn)
+
+    def predict_proba(self, df, group_col='persona'):
+        ''' Returns the positive class probability of every transformed row from its persona's model '''
+        return predict_by_group(df, self.models, self.features, group_col)
@@ -0,0 +1,210 @@
+''' Content-addressed cache for the stages of event_model_utils.main
+
+An entry is addressed by (stage, key), where the key is a hash of everything
+the stage's output depends on: the rendered SQL, the event and year, the
+stage parameters and the key of the stage before it.  Changing anything
+upstream therefore changes every key downstream, and those stages are
+recomputed while unchanged ones are loaded.
+
+Entries live in <cache_dir>/<stage>/<key>/ and hold data frames (stored with
+artifact_utils, dtypes preserved), a JSON value, or arbitrary
+files written into a staging directory (e.g., a downloaded extract).  An
+entry only counts once it is committed, and every hit refreshes its
+last-used time, so evict() can drop the least recently used entries when
+the cache grows past max_bytes.  Commits never evict: a run calls evict()
+once it is done, so no entry a stage of the run has resolved (e.g., the
+extract a sample is about to be drawn from) is removed underneath it.
+Eviction also removes the staging directories that runs which died before
+their commit left behind.
+'''
+
+import os
+import re
+import json
+import time
+import errno
+import shutil
+import hashlib
+import inspect
+
+from lazy_utils import LazyModule
+
+# artifact_utils (and pandas) load with the first frame stored or loaded; JSON entries and
+# keys do not need them
+au = LazyModule('artifact_utils')
+
+
+_COMPLETE = '_complete'
+
+# <key>.tmp<pid>, the staging directory of an entry (StageCache.staging_dir)
+_STAGING = re.compile(r'\.tmp(\d+)$')
+
+
+def fn_id(fn):
+    ''' Identifies a function for a cache key: its source when available, else its name '''
+    try:
+        return inspect.getsource(fn).strip()
+    except (IOError, TypeError):
+        return '{0}.{1}'.format(getattr(fn, '__module__', ''), getattr(fn, '__name__', repr(fn)))
+
+
+def _pid_alive(pid):
+    # Whether a process pid runs on this machine (signal 0 only checks that it exists)
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def file_fingerprint(filenames):
+    ''' Identifies local files for a cache key by name, size and modification time '''
+    return [[os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f))] for f in sorted(filenames)]
+
+
+class StageCache(object):
+    ''' Stage cache rooted at cache_dir, evicting least recently used entries past max_bytes
+
+    Example use
+    ===========
+    cache = StageCache('temp/cache', max_bytes=50*2**30)
+    key = cache.key('sample', extract_key, {'sample_size': 250000, 'sample_seed': 30132})
+    if cache.has('sample', key):
+        frames = cache.load_frames('sample', key)
+    else:
+        frames = {'sample': sample_df, 'summary': summary_df}
+        cache.save_frames('sample', key, frames)
+    '''
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, stage, *parts):
+        blob = json.dumps([stage] + list(parts), sort_keys=True, default=str)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def has(self, stage, key):
+        marker = os.path.join(self.entry_dir(stage, key), _COMPLETE)
+        if not os.path.exists(marker):
+            return False
+        os.utime(marker, None)
+        return True
+
+    def staging_dir(self, stage, key):
+        ''' Returns an empty directory to build the entry in before commit '''
+        staging = '{0}.tmp{1}'.format(self.entry_dir(stage, key), os.getpid())
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        return staging
+
+    def commit(self, stage, key, staging):
+        ''' Moves a staging directory into place and marks the entry complete '''
+        entry = self.entry_dir(stage, key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(staging, entry)
+        with open(os.path.join(entry, _COMPLETE), 'w') as f:
+            f.write(time.strftime('%Y-%m-%d %H:%M:%S'))
+        return entry
+
+    def save_json(self, stage, key, value):
+        staging = self.staging_dir(stage, key)
+        with open(os.path.join(staging, 'value.json'), 'w') as f:
+            json.dump(value, f, default=str)
+        self.commit(stage, key, staging)
+
+    def load_json(self, stage, key):
+        with open(os.path.join(self.entry_dir(stage, key), 'value.json'), 'r') as f:
+            return json.load(f)
+
+    def save_frames(self, stage, key, frames):
+        ''' Saves a dict of data frames; the index is kept as a column and restored on load '''
+        fmt = 'parquet'
+        try:
+            au._import_pyarrow()
+        except ImportError:
+            fmt = 'csv'
+        staging = self.staging_dir(stage, key)
+        index_names = {}
+        for name, df in frames.items():
+            index_names[name] = [n for n in df.index.names if n is not None]
+            frame = df.reset_index() if index_names[name] else df
+            au.write_artifact(frame, os.path.join(staging, name), fmt, downcast=False)
+        with open(os.path.join(staging, 'frames.json'), 'w') as f:
+            json.dump(index_names, f)
+        self.commit(stage, key, staging)
+
+    def load_frames(self, stage, key):
+        entry = self.entry_dir(stage, key)
+        with open(os.path.join(entry, 'frames.json'), 'r') as f:
+            index_names = json.load(f)
+        frames = {}
+        for name, index in index_names.items():
+            df = au.read_artifact(os.path.join(entry, name))
+            frames[name] = df.set_index(index) if index else df
+        return frames
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for stage in os.listdir(self.cache_dir):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                entry = os.path.join(stage_dir, key)
+                marker = os.path.join(entry, _COMPLETE)
+                if not os.path.exists(marker):
+                    continue
+                size = sum(os.path.getsize(os.path.join(root, f))
+                           for root, dirs, files in os.walk(entry) for f in files)
+                entries.append((os.path.getmtime(marker), size, entry))
+        return entries
+
+    def size(self):
+        return sum(size for used, size, entry in self._entries())
+
+    def remove_stale_staging(self):
+        ''' Removes the staging directories of processes that are no longer running (a run that
+        failed before its commit) and returns them '''
+        removed = []
+        if not os.path.isdir(self.cache_dir):
+            return removed
+        for stage in os.listdir(self.cache_dir):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for name in os.listdir(stage_dir):
+                match = _STAGING.search(name)
+                if match and not _pid_alive(int(match.group(1))):
+                    shutil.rmtree(os.path.join(stage_dir, name), ignore_errors=True)
+                    removed.append(os.path.join(stage_dir, name))
+        return removed
+
+    def evict(self, keep=None):
+        ''' Removes stale staging directories and then the least recently used entries, but
+        keep, until the cache fits in max_bytes; call it once a run is done, never while its
+        stages hold entries.  Returns the entries removed. '''
+        self.remove_stale_staging()
+        if self.max_bytes is None:
+            return []
+        entries = sorted(self._entries())
+        total = sum(size for used, size, entry in entries)
+        removed = []
+        for used, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed.append(entry)
+        return removed
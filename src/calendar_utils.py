@@ -0,0 +1,233 @@
+''' Local calendar of the date spans of every marketing event
+
+00_get_event_span.sql and event_dates_select.txt find an event's spans with a
+window scan of liveramp_events on every run.  EventCalendar instead pulls the
+daily event flags of all events once (00_get_event_flags.sql) and finds every
+(event, year, start_dt, end_dt) span in one vectorized run-length pass: a
+span is a run of consecutive flagged rows, and its year is the year it ends
+in, exactly as the window queries group them.
+
+The spans are kept as a few sorted arrays, with a dict index by (event, year),
+and saved as JSON.  refresh only pulls the rows after the last day seen (and
+those of spans still running on that day), so keeping the calendar current is
+cheap.  dates_select renders the spans as a literal select of event, yr,
+start_dt and end_dt, a drop-in replacement for the unioned window queries of
+the unload SQL.
+
+Example use
+===========
+calendar = load_calendar('temp/event_calendar.json', events,
+                         lambda sql: rs.execute_rs_query(sql, return_data=True))
+target_start_dt, target_end_dt = calendar.span('anniversary_public_event', 2017)
+event_dates_txt = calendar.dates_select()
+'''
+
+import os
+import json
+import datetime
+
+import numpy as np
+
+
+FLAGS_SQL = '00_get_event_flags.sql'
+FIRST_DAY = '1900-01-01'
+
+
+def run_lengths(days, flags):
+    ''' Returns the spans of runs of flagged rows in every column of flags
+
+    Parameters
+    ----------
+    days : array of datetime64[D]
+        sorted days of the rows
+    flags : 2d array of 0/1
+        one column per event
+
+    Returns
+    -------
+    tuple
+        event (column) numbers, start days and end days of the runs, by event then start
+    '''
+    flags = np.asarray(flags, dtype=np.int8)
+    edge = np.zeros((1, flags.shape[1]), dtype=np.int8)
+    steps = np.diff(np.concatenate([edge, flags, edge]), axis=0).T
+    # Rows of steps.T are events, so nonzero lists each event's starts (and ends) in order
+    event, start = np.nonzero(steps == 1)
+    end = np.nonzero(steps == -1)[1] - 1
+    return event, days[start], days[end]
+
+
+def _years(days):
+    return days.astype('datetime64[Y]').astype(int) + 1970
+
+
+def _date(day):
+    return datetime.datetime.strptime(str(day), '%Y-%m-%d').date()
+
+
+class EventCalendar(object):
+    ''' Spans of the marketing events, indexed by (event, year)
+
+    Parameters
+    ----------
+    events : list of str
+        event columns of liveramp_events
+    suffix : str
+        suffix of the tables ('_test' for the test tables)
+    '''
+
+    def __init__(self, events, suffix=''):
+        self.events = list(events)
+        self.suffix = suffix
+        self.through = None
+        self._set_spans(np.zeros(0, dtype=int), np.zeros(0, dtype='datetime64[D]'),
+                        np.zeros(0, dtype='datetime64[D]'))
+
+    def _set_spans(self, event, start, end):
+        order = np.lexsort((start, event))
+        self.event = np.asarray(event, dtype=np.int16)[order]
+        self.start = np.asarray(start, dtype='datetime64[D]')[order]
+        self.end = np.asarray(end, dtype='datetime64[D]')[order]
+        self.year = _years(self.end).astype(np.int16)
+        # The first span of an (event, year), as date objects, so a lookup is one dict access
+        self._index = {}
+        for e, y, s, t in zip(self.event.tolist(), self.year.tolist(), self.start.astype(str), self.end.astype(str)):
+            self._index.setdefault((self.events[e], y), (_date(s), _date(t)))
+
+    def __len__(self):
+        return len(self.event)
+
+    def span(self, event, year):
+        ''' Returns (start_dt, end_dt) of the event in year, raising KeyError if unknown '''
+        return self._index[(event, year)]
+
+    def has(self, event, year):
+        return (event, year) in self._index
+
+    def spans(self):
+        ''' Returns every span as a DataFrame of event, yr, start_dt and end_dt '''
+        import pandas as pd
+        return pd.DataFrame({'event': np.array(self.events, dtype=object)[self.event] if len(self) else [],
+                             'yr': self.year, 'start_dt': self.start, 'end_dt': self.end},
+                            columns=['event', 'yr', 'start_dt', 'end_dt'])
+
+    def update(self, days, flags):
+        ''' Adds the runs of daily flags that continue the calendar
+
+        The rows must start no later than the day after the last day seen and include the
+        rows of every span still running on it (see refresh); spans ending on or after the
+        first row are replaced.
+        '''
+        days = np.asarray(days, dtype='datetime64[D]')
+        if not len(days):
+            return self
+        event, start, end = run_lengths(days, flags)
+        keep = self.end < days[0]
+        self._set_spans(np.concatenate([self.event[keep], event]),
+                        np.concatenate([self.start[keep], start]),
+                        np.concatenate([self.end[keep], end]))
+        self.through = str(days[-1])
+        return self
+
+    def _refresh_from(self):
+        # The day after the last one seen, or the start of a span still running on it, moved
+        # back to the start of every span overlapping the days to pull, which update replaces
+        if self.through is None:
+            return FIRST_DAY
+        since = np.datetime64(self.through, 'D') + 1
+        while True:
+            overlap = self.start[self.end >= since - 1]
+            if not len(overlap) or overlap.min() >= since:
+                return str(since)
+            since = overlap.min()
+
+    def refresh(self, run_query, sql_path=os.path.join('..','sql')):
+        ''' Pulls the flags after the last day seen with run_query(sql) -> (rows, header) and
+        adds their spans; returns the number of rows pulled '''
+        with open(os.path.join(sql_path, FLAGS_SQL), 'r') as f:
+            sql = f.read()
+        sql = sql.format(self.suffix, ',\n  '.join(self.events), self._refresh_from())
+        rows, header = run_query(sql)
+        if rows:
+            days = np.array([str(row[0])[:10] for row in rows], dtype='datetime64[D]')
+            self.update(days, np.array([[flag or 0 for flag in row[1:]] for row in rows], dtype=np.int8))
+        return len(rows)
+
+    def dates_select(self, events=None, start_year=None, end_year=None):
+        ''' Returns a select of the spans (event, yr, start_dt, end_dt), to stand in for the
+        unioned event_dates_select.txt queries '''
+        df = self.spans()
+        if events is not None:
+            df = df.loc[df['event'].isin(events)]
+        if start_year is not None:
+            df = df.loc[df['yr'] >= start_year]
+        if end_year is not None:
+            df = df.loc[df['yr'] <= end_year]
+        if not len(df):
+            return "select null::varchar(32) as event, null::integer as yr, null::date as start_dt, null::date as end_dt where false"
+        row = "select '{0}'::varchar(32) as event, {1} as yr, '{2}'::date as start_dt, '{3}'::date as end_dt"
+        return '\nunion all\n'.join(row.format(e, y, s, t) for e, y, s, t in
+                                    zip(df['event'], df['yr'], df['start_dt'].astype(str), df['end_dt'].astype(str)))
+
+    def to_dict(self):
+        return {'events': self.events, 'suffix': self.suffix, 'through': self.through,
+                'spans': [[int(e), str(s), str(t)] for e, s, t in zip(self.event, self.start, self.end)]}
+
+    @classmethod
+    def from_dict(cls, d):
+        calendar = cls(d['events'], d['suffix'])
+        calendar.through = d['through']
+        spans = d['spans']
+        calendar._set_spans(np.array([s[0] for s in spans], dtype=int),
+                            np.array([s[1] for s in spans], dtype='datetime64[D]'),
+                            np.array([s[2] for s in spans], dtype='datetime64[D]'))
+        return calendar
+
+    def save(self, filename):
+        # Written next to filename and renamed, so readers never see half a calendar
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.rename(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+
+def load_calendar(filename, events, run_query=None, suffix='', sql_path=os.path.join('..','sql'), refresh=False):
+    ''' Opens the calendar saved at filename, building it (or refreshing it, if asked) with
+    run_query when needed and saving it back
+
+    Parameters
+    ----------
+    filename : str
+    events : list of str
+        event columns the calendar must cover; a calendar of other events is rebuilt
+    run_query : function, optional
+        run_query(sql) -> (rows, header), e.g., rs.execute_rs_query with return_data=True
+    suffix : str
+    sql_path : str
+    refresh : bool
+        pull the days after the last one seen even if the calendar exists
+
+    Returns
+    -------
+    EventCalendar
+    '''
+    calendar = None
+    if os.path.exists(filename):
+        calendar = EventCalendar.load(filename)
+        if calendar.suffix != suffix or not set(events) <= set(calendar.events):
+            calendar = None
+    if calendar is not None and not refresh:
+        return calendar
+    if run_query is None:
+        raise IOError('No event calendar at {0} and no query to build it with'.format(filename))
+    calendar = calendar or EventCalendar(events, suffix)
+    calendar.refresh(run_query, sql_path)
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    calendar.save(filename)
+    return calendar
@@ -0,0 +1,358 @@
+''' The event-propensity command: one subcommand per job, each importing only what it runs
+
+This module imports nothing heavier than argparse, so the command starts in
+milliseconds.  Every subcommand imports its own modules when it runs: span
+needs the calendar and SQL helpers only (no pandas, scikit-learn, psycopg2 or
+boto3), score and serve need pandas and the bundles, and run, shared and
+pipeline the full event_model_utils.
+
+Job parameters are the params dict of the __main__ blocks of
+event_model_utils and pipeline_utils, as a JSON file (--params) with
+overrides (--set key=json_value).  Functions such as log_fn are given as
+'module:name' references (bundle_utils.fn_ref).
+
+import-time runs a cold import of the modules behind every subcommand in a
+fresh interpreter and fails (exit status 1) if one takes longer than its
+budget, loads a heavy dependency it should not or installs a log handler
+(only the entry points set up logging), so it can run as a check before a
+release.
+
+Example use
+===========
+event-propensity span anniversary_public_event 2017 --params params.json
+event-propensity run anniversary_public_event 2017 --params params.json --set skip_data_pull=true
+event-propensity shared mktg_valentines_day:2017 anniversary_public_event:2017 --params params.json
+event-propensity pipeline mktg_valentines_day:2017 mktg_valentines_day:2018 --params params.json --limits '{"redshift": 2, "s3": 4, "cpu": 2}'
+event-propensity score temp/downloads/ep_annpub_2017_20180417_000.gz --models ../data/ep_annpub17_gradboost_bundle --out ../data/ep_annpub17_gradboost_scores.csv.gz
+event-propensity serve annpub17_gradboost=../data/ep_annpub17_gradboost_bundle --port 8080
+event-propensity synth temp/bench/ep_synth_1m_ 1000000 --n-shards 4 --seed 1
+event-propensity bench 1000000
+event-propensity import-time
+python cli_utils.py span anniversary_public_event 2017     # from src/ of a checkout
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import logging
+
+
+# The params of a job that name functions ('module:name')
+FN_PARAMS = ['log_fn', 'transform_fn']
+
+# Modules no job should load unless it uses them
+HEAVY_MODULES = ['pandas', 'sklearn', 'scipy', 'psycopg2', 'boto3', 'duckdb', 'pyarrow', 'numba']
+
+# The most milliseconds a cold import of the modules behind each subcommand may take, and the
+# heavy modules it may load (recent pandas imports pyarrow when it is installed)
+IMPORT_BUDGETS = [
+    ('cli_utils', 50, []),
+    ('trace_utils', 50, []),
+    ('cache_utils', 50, []),
+    ('redshift_utils', 150, []),
+    ('s3_utils', 150, []),
+    ('calendar_utils', 300, []),
+    ('event_model_utils', 400, []),
+    ('pipeline_utils', 400, []),
+    ('scoring_utils', 2000, ['pandas', 'pyarrow']),
+    ('serving_utils', 2000, ['pandas', 'pyarrow']),
+    ('synthetic_utils', 2000, ['pandas', 'pyarrow']),
+]
+
+_PROBE = '''import sys, time, json, logging
+start = time.time()
+import {module}
+ms = 1000 * (time.time() - start)
+loggers = [logging.getLogger()] + [logging.getLogger(name) for name in logging.Logger.manager.loggerDict]
+print(json.dumps({{'ms': ms, 'loaded': [m for m in {heavy!r} if m in sys.modules],
+                  'handlers': sorted(logger.name for logger in loggers if logger.handlers)}}))
+'''
+
+
+def _setup_logging():
+    # The JSON handler of event_model_utils.setup_logging, for the subcommands that do not import it
+    from pythonjsonlogger import jsonlogger
+    logger = logging.getLogger('events_logger')
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(message)s'))
+        logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+
+def _module_path():
+    # PYTHONPATH that finds the modules from a checkout (src/ and lib/) as well as installed
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = [here]
+    lib_path = os.path.join(here, '..', 'lib')
+    if os.path.isfile(os.path.join(lib_path, 'redshift_utils.py')):
+        paths.append(lib_path)
+    if os.environ.get('PYTHONPATH'):
+        paths.append(os.environ['PYTHONPATH'])
+    return os.pathsep.join(paths)
+
+
+def import_time(module, heavy=None):
+    ''' Returns the milliseconds of a cold import of module in a fresh interpreter, the heavy
+    modules it loaded and the loggers it installed a handler on '''
+    heavy = HEAVY_MODULES if heavy is None else heavy
+    env = dict(os.environ, PYTHONPATH=_module_path())
+    out = subprocess.check_output([sys.executable, '-c', _PROBE.format(module=module, heavy=heavy)], env=env)
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    return result['ms'], result['loaded'], result['handlers']
+
+
+def check_import_budgets(budgets=None, repeat=3):
+    ''' Times the cold import of every module of budgets (by default IMPORT_BUDGETS), the best of
+    repeat runs, and returns a dict per module: module, ms, budget_ms, loaded (the heavy modules
+    it loaded), unexpected (those it should not have), handlers (the loggers it installed a
+    handler on, which only the entry points may do) and ok '''
+    budgets = IMPORT_BUDGETS if budgets is None else budgets
+    results = []
+    for module, budget_ms, allowed in budgets:
+        runs = [import_time(module) for _ in range(repeat)]
+        ms = min(run[0] for run in runs)
+        loaded = sorted(set(m for run in runs for m in run[1]))
+        unexpected = [m for m in loaded if m not in allowed]
+        handlers = sorted(set(name for run in runs for name in run[2]))
+        results.append({'module': module, 'ms': round(ms, 1), 'budget_ms': budget_ms, 'loaded': loaded,
+                        'unexpected': unexpected, 'handlers': handlers,
+                        'ok': ms <= budget_ms and not unexpected and not handlers})
+    return results
+
+
+def _params(args, resolve_fns=True):
+    # The params JSON of a job with the --set overrides, its function references resolved
+    params = {}
+    if args.params is not None:
+        with open(args.params, 'r') as f:
+            params = json.load(f)
+    for override in args.set or []:
+        key, _, value = override.partition('=')
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    if resolve_fns and any(params.get(key) is not None for key in FN_PARAMS):
+        import bundle_utils as bdu
+        for key in FN_PARAMS:
+            if params.get(key) is not None:
+                params[key] = bdu.resolve_fn(params[key])
+    return params
+
+
+def _event_year_pairs(pairs):
+    # ['event:year', ...] as the event_year_pairs of main_shared and run_pipeline
+    out = []
+    for pair in pairs:
+        event, _, year = pair.rpartition(':')
+        if not event or not year.isdigit():
+            raise argparse.ArgumentTypeError('Expected event:year, got {0}'.format(pair))
+        out.append({'event': event, 'year': int(year)})
+    return out
+
+
+def _span(args):
+    import event_model_utils as emu
+    emu.setup_logging()
+    start_dt, end_dt = emu.get_event_span(args.event, args.year, **_params(args, resolve_fns=False))
+    print('{0} {1}'.format(start_dt, end_dt))
+    return 0
+
+
+def _run(args):
+    import event_model_utils as emu
+    emu.main(args.event, args.year, **_params(args))
+    return 0
+
+
+def _shared(args):
+    import event_model_utils as emu
+    emu.main_shared(_event_year_pairs(args.pairs), **_params(args))
+    return 0
+
+
+def _pipeline(args):
+    import pipeline_utils as pu
+    limits = json.loads(args.limits) if args.limits else None
+    report = pu.run_pipeline(_event_year_pairs(args.pairs), limits=limits, max_jobs=args.max_jobs, **_params(args))
+    if args.report is not None:
+        report.to_csv(args.report, index=False)
+    print(report.to_string())
+    return 0 if (report['status'] == 'done').all() else 1
+
+
+def _score(args):
+    import numpy as np
+    import schema_utils as sch
+    import scoring_utils as scu
+    dtypes = sch.unload_dtypes(args.sql_path) if args.sql_path is not None else None
+    names = list(dtypes) if dtypes is not None and len(args.files) > 1 else None
+    log_fn = np.log
+    if args.log_fn is not None:
+        import bundle_utils as bdu
+        log_fn = bdu.resolve_fn(args.log_fn)
+    stats = scu.score_extract(args.files, args.models, args.out, scaler=args.scaler, log_features=args.log_features,
+                              log_fn=log_fn, names=names, dtypes=dtypes,
+                              deciles=not args.no_deciles, decile_by_group=args.decile_by_group,
+                              chunksize=args.chunksize, n_jobs=args.n_jobs, compile_trees=args.compile_trees)
+    print(json.dumps(stats, default=str))
+    return 0
+
+
+def _serve(args):
+    import schema_utils as sch
+    import serving_utils as svu
+    bundles = dict(bundle.split('=', 1) for bundle in args.bundles)
+    dtypes = sch.unload_dtypes(args.sql_path) if args.sql_path is not None else None
+    service = svu.ScoringService(bundles, dtypes=dtypes, max_batch_rows=args.max_batch_rows,
+                                 max_wait_ms=args.max_wait_ms)
+    service.serve(host=args.host, port=args.port)
+    return 0
+
+
+def _synth(args):
+    import synthetic_utils as syn
+    pos_rate = json.loads(args.pos_rate)
+    if isinstance(pos_rate, dict):
+        pos_rate = dict((int(persona), rate) for persona, rate in pos_rate.items())
+    filenames = syn.generate_extract(args.out_handle, args.n_rows, pos_rate=pos_rate, n_personas=args.n_personas,
+                                     n_shards=args.n_shards, seed=args.seed, null_rate=args.null_rate,
+                                     sql_path=args.sql_path)
+    print('\n'.join(filenames))
+    return 0
+
+
+def _bench(args):
+    import benchmark_utils as bu
+    config = dict(bu.DEFAULT_CONFIG, n_rows=args.n_rows)
+    version = bu._version() or 'local'
+    results_file = os.path.join(args.work_dir, 'results_{0}_{1}.json'.format(config['n_rows'], version))
+    summary = bu.run_benchmarks(args.work_dir, config, benchmarks=args.benchmarks, results_file=results_file,
+                                sql_path=args.sql_path)
+    print(summary.to_string())
+    baseline_file = os.path.join(args.work_dir, 'results_{0}_baseline.json'.format(config['n_rows']))
+    if os.path.exists(baseline_file):
+        print(bu.compare(results_file, baseline_file).to_string())
+    return 0
+
+
+def _import_time(args):
+    budgets = IMPORT_BUDGETS
+    if args.modules:
+        budgets = [budget for budget in IMPORT_BUDGETS if budget[0] in args.modules]
+    results = check_import_budgets(budgets, repeat=args.repeat)
+    for row in results:
+        problems = []
+        if row['unexpected']:
+            problems.append('loads ' + ', '.join(row['unexpected']))
+        if row['handlers']:
+            problems.append('logs to ' + ', '.join(row['handlers']))
+        print('{0:<20} {1:>8.1f} ms  budget {2:>5} ms  {3:<4} {4}'.format(
+            row['module'], row['ms'], row['budget_ms'], 'ok' if row['ok'] else 'FAIL', '; '.join(problems)))
+    return 0 if all(row['ok'] for row in results) else 1
+
+
+def _add_params(parser):
+    parser.add_argument('--params', help='JSON file of job parameters')
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE',
+                        help='override a parameter (the value is read as JSON, else as a string)')
+
+
+def parser():
+    ''' Returns the argument parser of the event-propensity command '''
+    sql_path = os.path.join('..', 'sql')
+    main_parser = argparse.ArgumentParser(prog='event-propensity', description=__doc__.split('\n')[0])
+    commands = main_parser.add_subparsers(dest='command', metavar='command')
+
+    cmd = commands.add_parser('span', help='print the start and end dates of an event')
+    cmd.add_argument('event')
+    cmd.add_argument('year', type=int)
+    _add_params(cmd)
+    cmd.set_defaults(func=_span)
+
+    cmd = commands.add_parser('run', help='extract, sample and prepare one event (event_model_utils.main)')
+    cmd.add_argument('event')
+    cmd.add_argument('year', type=int)
+    _add_params(cmd)
+    cmd.set_defaults(func=_run)
+
+    cmd = commands.add_parser('shared', help='prepare many events from one shared extract (main_shared)')
+    cmd.add_argument('pairs', nargs='+', metavar='event:year')
+    _add_params(cmd)
+    cmd.set_defaults(func=_shared)
+
+    cmd = commands.add_parser('pipeline', help='run many events concurrently (pipeline_utils.run_pipeline)')
+    cmd.add_argument('pairs', nargs='+', metavar='event:year')
+    cmd.add_argument('--limits', help='JSON of the jobs allowed on each resource at once')
+    cmd.add_argument('--max-jobs', type=int)
+    cmd.add_argument('--report', help='CSV file to write the report to')
+    _add_params(cmd)
+    cmd.set_defaults(func=_pipeline)
+
+    cmd = commands.add_parser('score', help='score an extract with a bundle or models (scoring_utils)')
+    cmd.add_argument('files', nargs='+', help='the gzipped extract, or its shards in order')
+    cmd.add_argument('--models', required=True, help='bundle directory or pickle of models by persona')
+    cmd.add_argument('--out', required=True, help='pipe-delimited gzip of the scores')
+    cmd.add_argument('--scaler', help='pickle of the scaler of prepare_sample, for models fit on scaled data')
+    cmd.add_argument('--log-features', nargs='+', help='as passed to prepare_sample (a bundle has its own)')
+    cmd.add_argument('--log-fn', help="'module:name' of the log function, by default numpy:log")
+    cmd.add_argument('--sql-path', default=sql_path, help='for the dtypes and columns of the UNLOAD')
+    cmd.add_argument('--chunksize', type=int, default=100000)
+    cmd.add_argument('--n-jobs', type=int)
+    cmd.add_argument('--compile-trees', action='store_true')
+    cmd.add_argument('--decile-by-group', action='store_true')
+    cmd.add_argument('--no-deciles', action='store_true')
+    cmd.set_defaults(func=_score)
+
+    cmd = commands.add_parser('serve', help='serve bundles over HTTP (serving_utils)')
+    cmd.add_argument('bundles', nargs='+', metavar='name=bundle_dir')
+    cmd.add_argument('--host', default='127.0.0.1')
+    cmd.add_argument('--port', type=int, default=8080)
+    cmd.add_argument('--sql-path', default=sql_path, help='for the dtypes of the UNLOAD')
+    cmd.add_argument('--max-batch-rows', type=int, default=2048)
+    cmd.add_argument('--max-wait-ms', type=float, default=2.0)
+    cmd.set_defaults(func=_serve)
+
+    cmd = commands.add_parser('synth', help='write a synthetic extract (synthetic_utils)')
+    cmd.add_argument('out_handle')
+    cmd.add_argument('n_rows', type=int)
+    cmd.add_argument('--pos-rate', default='0.1', help='share of positives, or JSON of it by persona')
+    cmd.add_argument('--n-personas', type=int, default=6)
+    cmd.add_argument('--n-shards', type=int)
+    cmd.add_argument('--seed', type=int)
+    cmd.add_argument('--null-rate', type=float, default=0.01)
+    cmd.add_argument('--sql-path', default=sql_path)
+    cmd.set_defaults(func=_synth)
+
+    cmd = commands.add_parser('bench', help='run the offline benchmarks (benchmark_utils)')
+    cmd.add_argument('n_rows', type=int, nargs='?', default=1000000)
+    cmd.add_argument('--work-dir', default=os.path.join('temp', 'bench'))
+    cmd.add_argument('--benchmarks', nargs='+')
+    cmd.add_argument('--sql-path', default=sql_path)
+    cmd.set_defaults(func=_bench)
+
+    cmd = commands.add_parser('import-time', help='check the import time of every subcommand against its budget')
+    cmd.add_argument('modules', nargs='*', help='of IMPORT_BUDGETS, by default all')
+    cmd.add_argument('--repeat', type=int, default=3)
+    cmd.set_defaults(func=_import_time)
+    return main_parser
+
+
+def main(argv=None):
+    ''' Runs the subcommand of argv (by default the command line) and returns its exit status '''
+    main_parser = parser()
+    args = main_parser.parse_args(argv)
+    if getattr(args, 'func', None) is None:
+        main_parser.print_help()
+        return 2
+    _setup_logging()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+''' Evaluation of many models by persona from one sort of their probabilities
+
+Evaluation takes the target and the positive class probabilities of every
+model (one array per model family, e.g., from bundle_utils.predict_by_group)
+and sorts the rows of each persona by each model's probability once, with a
+single lexsort per model.  The cumulative counts of positives and negatives
+down each sorted persona give the confusion matrix at every distinct
+probability, as sklearn's ROC curve does, so
+
+    metrics          the Series of part_score_model, by model and persona
+    curves           the ROC and precision-recall curves
+    thresholds       accuracy, precision, recall, bal_accuracy and f1 at every
+                     distinct threshold
+    best_thresholds  the threshold per persona that maximizes one of them
+    deciles          the lift and gains table
+
+come from those counts without another predict, sort or per-metric pass.
+summary and persona_table give the comparison tables of the README, and
+to_markdown prints them as its markdown.
+
+A row is predicted positive when its probability is at least the threshold,
+which, for the default of 0.5, matches predict on all but the rows scored
+exactly 0.5.
+
+Example use
+===========
+probs = {'Random Forest': bdu.predict_by_group(rf_test_df, rfcs, rf_model_features),
+         'Logistic Regression': bdu.predict_by_group(lr_test_df, lcs, lr_model_features)}
+ev = Evaluation(rf_test_df['target_shopped_ind'], probs, rf_test_df['persona'])
+print(to_markdown(ev.summary()))
+print(to_markdown(ev.persona_table('Random Forest')))
+best = ev.best_thresholds('f1', min_recall=0.2)
+ev.metrics(threshold=best['threshold'])
+'''
+
+import numpy as np
+import pandas as pd
+
+
+METRICS = ['n', 'null_accuracy', 'accuracy', 'precision', 'recall', 'bal_accuracy', 'log_loss', 'roc_auc']
+
+PERSONA_COLUMNS = [('accuracy', 'Accuracy'), ('precision', 'Precision'), ('recall', 'Recall'),
+                   ('bal_accuracy', 'Bal_Accuracy'), ('log_loss', 'Log_Loss'), ('roc_auc', 'ROC-AUC')]
+
+SUMMARY_COLUMNS = [('accuracy', 'max', 'Best Accuracy'), ('precision', 'max', 'Best Precision'),
+                   ('recall', 'max', 'Best Recall'), ('roc_auc', 'max', 'Best ROC-AUC'),
+                   ('accuracy', 'mean', 'Avg Accuracy')]
+
+
+def _rates(tp, fp, n_pos, n_neg):
+    # The threshold metrics of confusion counts, elementwise; an undefined ratio is 0, as sklearn's
+    tp = np.asarray(tp, dtype=np.float64)
+    fp = np.asarray(fp, dtype=np.float64)
+    n = n_pos + n_neg
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = tp / n_pos if n_pos else np.zeros_like(tp)
+        specificity = (n_neg - fp) / n_neg if n_neg else np.zeros_like(fp)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return {'accuracy': (tp + n_neg - fp) / n, 'precision': precision, 'recall': recall,
+            'specificity': specificity, 'bal_accuracy': 0.5 * (recall + specificity), 'f1': f1,
+            'predicted_rate': (tp + fp) / n}
+
+
+class _Ranking(object):
+    # The rows of one group sorted by one model's probability, descending, and the cumulative
+    # counts of positives (tps) and negatives (fps) at every distinct probability (thresholds)
+
+    def __init__(self, y, prob, eps):
+        self.y = y
+        self.n_pos = int(y.sum())
+        self.n_neg = len(y) - self.n_pos
+        last = np.r_[np.flatnonzero(np.diff(prob)), len(prob) - 1]
+        self.thresholds = prob[last]
+        self.tps = np.cumsum(y)[last]
+        self.fps = last + 1 - self.tps
+        clipped = np.clip(prob, eps, 1 - eps)
+        self.log_loss = -np.mean(np.where(y == 1, np.log(clipped), np.log(1 - clipped)))
+
+    def counts(self, threshold):
+        # tp, fp of predicting positive at prob >= threshold, for a scalar or array threshold
+        k = np.searchsorted(-self.thresholds, -np.asarray(threshold, dtype=np.float64), side='right')
+        tps = np.r_[0, self.tps]
+        fps = np.r_[0, self.fps]
+        return tps[k], fps[k]
+
+    def roc(self):
+        tpr = np.r_[0, self.tps] / float(self.n_pos) if self.n_pos else np.zeros(len(self.tps) + 1)
+        fpr = np.r_[0, self.fps] / float(self.n_neg) if self.n_neg else np.zeros(len(self.fps) + 1)
+        return fpr, tpr
+
+    def roc_auc(self):
+        if not self.n_pos or not self.n_neg:
+            return np.nan
+        fpr, tpr = self.roc()
+        return np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1])) / 2
+
+    def average_precision(self):
+        if not self.n_pos:
+            return np.nan
+        precision = self.tps / (self.tps + self.fps).astype(np.float64)
+        return np.sum(np.diff(np.r_[0, self.tps]) * precision) / float(self.n_pos)
+
+
+class Evaluation(object):
+    ''' Metrics of many models by group from one sort of each model's probabilities
+
+    Parameters
+    ----------
+    y_true : array-like
+        the 0/1 target
+    probs : dict or DataFrame
+        the positive class probability of every row, by model name; rows without a
+        probability (NaN) are left out of that model's metrics
+    groups : array-like, optional
+        the group (e.g., persona) of every row, all rows in one group if None
+    eps : float, optional
+        probabilities are clipped to [eps, 1 - eps] for the log loss, by default the machine
+        epsilon of their dtype, as sklearn's log_loss
+    '''
+
+    def __init__(self, y_true, probs, groups=None, eps=None):
+        y = np.asarray(y_true).astype(np.int64)
+        groups = np.zeros(len(y), dtype=np.int64) if groups is None else np.asarray(groups)
+        if isinstance(probs, pd.DataFrame):
+            probs = dict((name, probs[name].values) for name in probs.columns)
+        self.models = list(probs)
+        self.rankings_ = {}
+        for name in self.models:
+            prob = np.asarray(probs[name])
+            model_eps = eps
+            if model_eps is None:
+                model_eps = np.finfo(prob.dtype if np.issubdtype(prob.dtype, np.floating) else np.float64).eps
+            prob = prob.astype(np.float64)
+            if len(prob) != len(y):
+                raise ValueError('{0} has {1} probabilities for {2} rows'.format(name, len(prob), len(y)))
+            scored = np.flatnonzero(~np.isnan(prob))
+            # One sort per model: by group, then by probability descending within the group
+            order = scored[np.lexsort((-prob[scored], groups[scored]))]
+            codes, uniques = pd.factorize(groups[order], sort=True)
+            bounds = np.r_[0, np.flatnonzero(np.diff(codes)) + 1, len(order)]
+            for i, grp in enumerate(uniques):
+                rows = order[bounds[i]:bounds[i + 1]]
+                key = grp.item() if hasattr(grp, 'item') else grp
+                self.rankings_[(name, key)] = _Ranking(y[rows], prob[rows], model_eps)
+        self.groups = sorted(set(grp for _, grp in self.rankings_))
+
+    def _keys(self, models=None):
+        models = self.models if models is None else [models] if not isinstance(models, list) else models
+        return [(name, grp) for name in models for grp in self.groups if (name, grp) in self.rankings_]
+
+    @staticmethod
+    def _threshold(threshold, key):
+        # A scalar, or a threshold by (model, group) or by group, e.g. from best_thresholds
+        if np.isscalar(threshold):
+            return threshold
+        if key in threshold:
+            return threshold[key]
+        return threshold[key[1]]
+
+    def metrics(self, threshold=0.5, models=None):
+        ''' Returns the metrics of part_score_model and the average precision, by model and group
+
+        Parameters
+        ----------
+        threshold : float, dict or Series
+            one threshold, or one by (model, group) or by group
+        models : str or list of str, optional
+            by default all of them
+
+        Returns
+        -------
+        DataFrame
+            indexed by (model, group), columns METRICS + ['avg_precision']
+        '''
+        rows = []
+        keys = self._keys(models)
+        for key in keys:
+            rk = self.rankings_[key]
+            tp, fp = rk.counts(self._threshold(threshold, key))
+            rates = _rates(tp, fp, rk.n_pos, rk.n_neg)
+            n = rk.n_pos + rk.n_neg
+            rows.append([n, rk.n_neg / float(n), rates['accuracy'], rates['precision'], rates['recall'],
+                         rates['bal_accuracy'], rk.log_loss, rk.roc_auc(), rk.average_precision()])
+        return pd.DataFrame(rows, columns=METRICS + ['avg_precision'],
+                            index=pd.MultiIndex.from_tuples(keys, names=['model', 'group']))
+
+    def curves(self, models=None):
+        ''' Returns the ROC and precision-recall curves, one row per distinct threshold of every model
+        and group: threshold, fpr, tpr (= recall) and precision, from the highest threshold down '''
+        frames = []
+        for name, grp in self._keys(models):
+            rk = self.rankings_[(name, grp)]
+            fpr, tpr = rk.roc()
+            frames.append(pd.DataFrame({'model': name, 'group': grp,
+                                        'threshold': np.r_[np.inf, rk.thresholds], 'fpr': fpr, 'tpr': tpr,
+                                        'precision': np.r_[1.0, rk.tps / (rk.tps + rk.fps).astype(np.float64)]},
+                                       columns=['model', 'group', 'threshold', 'fpr', 'tpr', 'precision']))
+        return pd.concat(frames, ignore_index=True)
+
+    def thresholds(self, models=None, grid=None):
+        ''' Returns the threshold metrics at every distinct probability, or at the thresholds of grid
+
+        Parameters
+        ----------
+        models : str or list of str, optional
+        grid : array-like, optional
+            e.g. np.linspace(0, 1, 101), by default every distinct probability of the group
+
+        Returns
+        -------
+        DataFrame
+            model, group, threshold, tp, fp, accuracy, precision, recall, specificity,
+            bal_accuracy, f1 and predicted_rate
+        '''
+        frames = []
+        for name, grp in self._keys(models):
+            rk = self.rankings_[(name, grp)]
+            if grid is None:
+                threshold, tp, fp = rk.thresholds, rk.tps, rk.fps
+            else:
+                threshold = np.asarray(grid, dtype=np.float64)
+                tp, fp = rk.counts(threshold)
+            df = pd.DataFrame(_rates(tp, fp, rk.n_pos, rk.n_neg))
+            df.insert(0, 'fp', fp)
+            df.insert(0, 'tp', tp)
+            df.insert(0, 'threshold', threshold)
+            df.insert(0, 'group', grp)
+            df.insert(0, 'model', name)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
+
+    def best_thresholds(self, objective='bal_accuracy', models=None, min_precision=None, min_recall=None):
+        ''' Returns, by model and group, the threshold maximizing objective (a column of
+        thresholds) among those meeting min_precision and min_recall, and its metrics.  Groups
+        where no threshold meets them are left out. '''
+        th = self.thresholds(models)
+        keep = np.ones(len(th), dtype=bool)
+        if min_precision is not None:
+            keep &= th['precision'].values >= min_precision
+        if min_recall is not None:
+            keep &= th['recall'].values >= min_recall
+        th = th.loc[keep]
+        # The highest threshold among ties, i.e. the fewest predicted positives
+        best = th.loc[th.groupby(['model', 'group'], sort=False)[objective].idxmax()]
+        return best.set_index(['model', 'group'])
+
+    def deciles(self, models=None, n_bins=10):
+        ''' Returns the lift table: the rows of every model and group in n_bins equal bins by
+        probability, highest first, with their positives, rate, lift over the group rate and the
+        cumulative share of positives captured (gain).  Rows of equal probability may fall in
+        neighbouring bins. '''
+        frames = []
+        for name, grp in self._keys(models):
+            rk = self.rankings_[(name, grp)]
+            n = len(rk.y)
+            edges = np.round(np.linspace(0, n, n_bins + 1)).astype(np.int64)
+            cum_pos = np.r_[0, np.cumsum(rk.y)][edges]
+            size = np.diff(edges)
+            positives = np.diff(cum_pos)
+            base_rate = rk.n_pos / float(n)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rate = np.where(size > 0, positives / size.astype(np.float64), np.nan)
+                lift = rate / base_rate if base_rate else np.full(n_bins, np.nan)
+                gain = cum_pos[1:] / float(rk.n_pos) if rk.n_pos else np.full(n_bins, np.nan)
+            frames.append(pd.DataFrame({'model': name, 'group': grp, 'decile': np.arange(1, n_bins + 1),
+                                        'n': size, 'positives': positives, 'rate': rate, 'lift': lift,
+                                        'gain': gain},
+                                       columns=['model', 'group', 'decile', 'n', 'positives', 'rate', 'lift',
+                                                'gain']))
+        return pd.concat(frames, ignore_index=True)
+
+    def summary(self, threshold=0.5):
+        ''' Returns the Overall Model Performance Summary of the README: the best accuracy,
+        precision, recall and ROC-AUC over the groups and the average accuracy, by model '''
+        metrics = self.metrics(threshold)
+        grouped = metrics.groupby(level='model', sort=False)
+        df = pd.DataFrame(dict((label, grouped[col].agg(how)) for col, how, label in SUMMARY_COLUMNS),
+                          columns=[label for _, _, label in SUMMARY_COLUMNS])
+        df.index.name = 'Model'
+        return df
+
+    def persona_table(self, model, threshold=0.5):
+        ''' Returns the Detailed Performance by Customer Persona table of the README for a model '''
+        metrics = self.metrics(threshold, models=model).xs(model, level='model')
+        df = metrics[[col for col, _ in PERSONA_COLUMNS]]
+        df.columns = [label for _, label in PERSONA_COLUMNS]
+        df.index.name = 'Persona'
+        return df
+
+
+def to_markdown(df, digits=3, bold_best=True):
+    ''' Returns df as a markdown table with its index as the first column, as the README's tables,
+    the best value of every column in bold (the lowest for a log loss) '''
+    cols = [df.index.name or ''] + [str(col) for col in df.columns]
+    best = {}
+    if bold_best and len(df) > 1:
+        for col in df.columns:
+            values = df[col].values.astype(np.float64)
+            best[col] = np.nanmin(values) if 'log_loss' in str(col).lower() else np.nanmax(values)
+    lines = ['| ' + ' | '.join(cols) + ' |', '|' + '|'.join('-' * (len(col) + 2) for col in cols) + '|']
+    for idx, row in df.iterrows():
+        cells = [str(idx)]
+        for col in df.columns:
+            cell = '{0:.{1}f}'.format(row[col], digits)
+            cells.append('**{0}**'.format(cell) if col in best and row[col] == best[col] else cell)
+        lines.append('| ' + ' | '.join(cells) + ' |')
+    return '\n'.join(lines)
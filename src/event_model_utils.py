@@ -5,29 +5,57 @@ import json
 import time
 import datetime
 import gzip
+import threading
+import glob
+import pickle
+import multiprocessing
 
 import numpy as np
-import pandas as pd
-
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
 
 import logging
-from pythonjsonlogger import jsonlogger
-
-lib_path = os.path.abspath(os.path.join('..','lib'))
-sys.path.append(lib_path)
-import redshift_utils as rs
-import s3_utils as s3
 
-# Setup logging
-formatter = jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(message)s')
-logHandler = logging.StreamHandler()
-logHandler.setFormatter(formatter)
+# From the source tree the lib modules sit in ../lib next to this directory; installed, they are
+# top-level modules already
+lib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+if os.path.isfile(os.path.join(lib_path, 'redshift_utils.py')) and lib_path not in sys.path:
+    sys.path.append(lib_path)
+
+import schema_utils as sch
+import calendar_utils as cal
+import target_utils as tu
+import trace_utils as tr
+from lazy_utils import LazyModule
+
+# pandas, the database and S3 clients and the modelling modules load on first use, so a span
+# lookup or a pool worker does not pay for them
+pd = LazyModule('pandas')
+rs = LazyModule('redshift_utils')
+s3 = LazyModule('s3_utils')
+au = LazyModule('artifact_utils')
+cu = LazyModule('cache_utils')
+scu = LazyModule('scoring_utils')
+bdu = LazyModule('bundle_utils')
+tfu = LazyModule('transform_utils')
+fu = LazyModule('feature_utils')
+
+# Logging is set up by the entry points (setup_logging), not on import
 logger = logging.getLogger('events_logger')
-logger.propagate = False
-logger.addHandler(logHandler)
-logger.setLevel(logging.INFO)
+
+
+def setup_logging():
+    ''' Writes the logs of the pipeline (events_logger, shared by the modules of src) and of the
+    Redshift and S3 helpers to stderr as JSON lines.  main, main_shared, run_pipeline and the
+    event-propensity command call it, so merely importing them (e.g., in a pool worker) installs
+    no handler. '''
+    from pythonjsonlogger import jsonlogger
+    if not logger.handlers:
+        logHandler = logging.StreamHandler()
+        logHandler.setFormatter(jsonlogger.JsonFormatter('%(asctime)s %(levelname)s %(message)s'))
+        logger.addHandler(logHandler)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    rs.setup_logging()
+    s3.setup_logging()
 
 
 def _read_event_text(json_path = os.path.join('..','json_and_txt'), **kwargs):
@@ -41,24 +69,161 @@ def _read_event_text(json_path = os.path.join('..','json_and_txt'), **kwargs):
     return mktg_events, event_dates_str
 
 
-def sample_downloaded_data(filename, sample_size=250000, sample_seed=None, group_col='persona', target_col='target_shopped_ind', **kwargs):
-    start = time.time()
-    logger.info('Sampling data from downloaded file...')
+def _read_unload_columns(sql_path=os.path.join('..','sql'), sql_file='01_unload_data.sql'):
+    return sch.read_unload_select(sql_path, sql_file)[0]
+
+
+def _unload_dtypes(sql_path, **kwargs):
+    # Compact dtypes of the extract columns, unless compact_dtypes is off
+    if 'compact_dtypes' in kwargs and not kwargs['compact_dtypes']:
+        return None
+    return sch.unload_dtypes(sql_path)
+
+
+def _sample_reservoir(filename, cap, group_col, target_col, chunksize=500000, rng=np.random, names=None, dtypes=None):
+    # Single pass priority sampling: every row draws a uniform key and each group keeps the
+    # cap rows with the smallest keys, which is a uniform sample without replacement per group.
+    # Reservoirs of different files merge exactly by taking the smallest keys again.
+    # With names, the file is a shard of a parallel UNLOAD, which starts with the header row
+    # if it holds it (schema_utils.has_header); that line is skipped, so every chunk is parsed
+    # straight into dtypes.  target_col may list the target columns of a shared extract;
+    # target_num counts the positives of each, by group.
+    targets = target_col if isinstance(target_col, list) else [target_col]
+    group_num = {}
+    target_num = {}
+    thresholds = {}
+    pool = []
+    pool_rows = 0
+    offset = 0
+
+    def compact(frames):
+        df = pd.concat(frames, ignore_index=True).sort_values('_key', kind='mergesort')
+        return df.groupby(group_col, sort=False).head(cap)
+
+    if names is None:
+        reader = pd.read_csv(filename, header=0, sep='|', compression='gzip', chunksize=chunksize, dtype=dtypes)
+    else:
+        reader = pd.read_csv(filename, header=None, names=names, sep='|', compression='gzip', chunksize=chunksize,
+                             skiprows=1 if sch.has_header(filename, names) else 0, dtype=dtypes)
+    for chunk in reader:
+        keys = rng.random_sample(len(chunk))
+        grouped = chunk.groupby(group_col)
+        sizes = grouped.size()
+        sums = grouped[targets].sum()
+        for grp in sizes.index:
+            group_num[grp] = group_num.get(grp, 0) + int(sizes[grp])
+            totals = target_num.setdefault(grp, dict.fromkeys(targets, 0))
+            for col in targets:
+                totals[col] += int(sums.at[grp, col])
+
+        mask = keys < chunk[group_col].map(thresholds).fillna(1.0).values
+        cand = chunk.loc[mask].copy()
+        cand['_key'] = keys[mask]
+        cand['_row'] = np.arange(offset, offset + len(chunk))[mask]
+        offset += len(chunk)
+        pool.append(cand)
+        pool_rows += len(cand)
+
+        if pool_rows > 2 * cap * max(len(group_num), 1):
+            kept = compact(pool)
+            pool = [kept]
+            pool_rows = len(kept)
+            full = kept.groupby(group_col)['_key'].agg(['count', 'max'])
+            thresholds = full.loc[full['count'] >= cap, 'max'].to_dict()
+
+    return compact(pool), group_num, target_num
+
+
+def _sample_shard(args):
+    filename, cap, group_col, target_col, chunksize, seed, names, dtypes = args
+    return _sample_reservoir(filename, cap, group_col, target_col, chunksize,
+                             rng=np.random.RandomState(seed), names=names, dtypes=dtypes)
+
+
+def _finish_sample(kept, group_num, target_num, sample_size, group_col, target_col, order_cols):
+    group_size = sample_size // len(group_num)
+    kept = kept.sort_values('_key', kind='mergesort')
+    sample = kept.groupby(group_col, sort=False).head(group_size).sort_values(order_cols)
+    sample = sample.drop(['_key'] + order_cols, axis=1).reset_index(drop=True)
+
+    # n and n_pos by group, or the positives of every target column of a shared extract
+    group_ord = sorted(group_num)
+    targets = target_col if isinstance(target_col, list) else [target_col]
+    pos_cols = targets if isinstance(target_col, list) else ['n_pos']
+    columns = {'n': [group_num[g] for g in group_ord]}
+    for col, pos_col in zip(targets, pos_cols):
+        columns[pos_col] = [target_num[g][col] for g in group_ord]
+    summary = pd.DataFrame(columns, index=pd.Index(group_ord, name='persona'), columns=['n'] + pos_cols)
+    return sample, summary
+
 
+def sample_downloaded_shards(filenames, columns, sample_size=250000, sample_seed=None, group_col='persona', target_col='target_shopped_ind', n_jobs=None, **kwargs):
+    with tr.span('sample', 'Sampling data from {} downloaded shards'.format(len(filenames)), files=len(filenames)) as sp:
+        sample, summary = _sample_shards(filenames, columns, sample_size, sample_seed, group_col, target_col, n_jobs, **kwargs)
+        sp.add(rows=summary['n'].sum(), bytes=sum(os.path.getsize(filename) for filename in filenames))
+    return sample, summary
+
+
+def _sample_shards(filenames, columns, sample_size, sample_seed, group_col, target_col, n_jobs, **kwargs):
+    # Every shard draws its keys from its own seed (sample_seed + shard number), so the merged
+    # sample is reproducible whatever order the workers finish in.
+    cap = sample_size if 'n_groups' not in kwargs else sample_size // kwargs['n_groups']
+    chunksize = 500000 if 'chunksize' not in kwargs else kwargs['chunksize']
+    dtypes = None if 'dtypes' not in kwargs else kwargs['dtypes']
+    tasks = [(filename, cap, group_col, target_col, chunksize,
+              None if sample_seed is None else sample_seed + i, columns, dtypes)
+             for i, filename in enumerate(filenames)]
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        results = pool.map(_sample_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    group_num = {}
+    target_num = {}
+    for i, (kept, shard_num, shard_target) in enumerate(results):
+        kept['_shard'] = i
+        for grp in shard_num:
+            group_num[grp] = group_num.get(grp, 0) + shard_num[grp]
+            totals = target_num.setdefault(grp, dict.fromkeys(shard_target[grp], 0))
+            for col in shard_target[grp]:
+                totals[col] += shard_target[grp][col]
+    kept = pd.concat([res[0] for res in results], ignore_index=True)
+    return _finish_sample(kept, group_num, target_num, sample_size, group_col, target_col, ['_shard', '_row'])
+
+
+def sample_downloaded_data(filename, sample_size=250000, sample_seed=None, group_col='persona', target_col='target_shopped_ind', sample_mode='skiprows', **kwargs):
+    with tr.span('sample', 'Sampling data from downloaded file', files=1, sample_mode=sample_mode) as sp:
+        sample, summary = _sample_file(filename, sample_size, sample_seed, group_col, target_col, sample_mode, **kwargs)
+        sp.add(rows=summary['n'].sum(), bytes=os.path.getsize(filename))
+    return sample, summary
+
+
+def _sample_file(filename, sample_size, sample_seed, group_col, target_col, sample_mode, **kwargs):
     if sample_seed is not None:
         np.random.seed(sample_seed)
+    dtypes = None if 'dtypes' not in kwargs else kwargs['dtypes']
+
+    if sample_mode == 'stream':
+        # The number of groups is only known at the end of the file, so unless n_groups is given
+        # each reservoir holds up to sample_size rows and is trimmed to the group size afterwards.
+        cap = sample_size if 'n_groups' not in kwargs else sample_size // kwargs['n_groups']
+        chunksize = 500000 if 'chunksize' not in kwargs else kwargs['chunksize']
+        kept, group_num, target_num = _sample_reservoir(filename, cap, group_col, target_col, chunksize, dtypes=dtypes)
+        return _finish_sample(kept, group_num, target_num, sample_size, group_col, target_col, ['_row'])
 
     group_ord = []
     group_num = []
     target_num = []
 
     with gzip.open(filename, 'rb') as f:
-        header = f.readline().strip().split('|')
+        header = f.readline().decode('utf-8').strip().split('|')
         gx = header.index(group_col)
         tx = header.index(target_col)
         mx = max(gx,tx)
         for row in f:
-            row = row.split('|',mx+1)
+            row = row.decode('utf-8').split('|',mx+1)
             grp = row[gx]
             tgt = row[tx]
             if len(group_ord) == 0 or grp != group_ord[-1]:
@@ -67,15 +232,12 @@ def sample_downloaded_data(filename, sample_size=250000, sample_seed=None, group
                 target_num.append(0)
             group_num[-1] += 1
             target_num[-1] += int(tgt)
-        group_size = sample_size / len(group_ord)
-        skip = np.concatenate(map(lambda n,s: s - np.random.choice(n, n-group_size, replace=False),
-                                  group_num, np.cumsum(group_num)))
+        group_size = sample_size // len(group_ord)
+        skip = np.concatenate(list(map(lambda n,s: s - np.random.choice(n, max(n-group_size, 0), replace=False),
+                                       group_num, np.cumsum(group_num))))
         skip.sort()
         f.seek(0)
-        sample = pd.read_csv(f, header=0, delimiter='|', skiprows=skip)
-
-    end = time.time()
-    logger.info('Sampling data required {}s'.format(round(end - start, 3)))
+        sample = pd.read_csv(f, header=0, delimiter='|', skiprows=skip, dtype=dtypes)
 
     summary = pd.DataFrame({'n': group_num, 'n_pos': target_num},
                            index=pd.Index(group_ord, name='persona')).sort_index()
@@ -84,22 +246,18 @@ def sample_downloaded_data(filename, sample_size=250000, sample_seed=None, group
 
 
 def scale_data(df_train, df_test, features):
+    # The statistics are gathered from the train frame in chunks, then each frame is copied once
+    # (non-features first) and scaled in place
     nonfeatures = [col for col in df_train.columns if col not in features]
-    ldf_train = pd.DataFrame(df_train[nonfeatures].values, columns=nonfeatures)
-    ldf_test = pd.DataFrame(df_test[nonfeatures].values, columns=nonfeatures)
-
-    SS = StandardScaler(with_mean=True, with_std=True)
-    SS.fit(df_train[features])
-    tdf_train = pd.DataFrame(SS.transform(df_train[features]), columns=features)
-    tdf_test = pd.DataFrame(SS.transform(df_test[features]), columns=features)
+    scaler = tfu.StreamingScaler(features).fit(df_train)
 
-    sdf_train = pd.concat([ldf_train, tdf_train], axis=1)
-    sdf_test = pd.concat([ldf_test, tdf_test], axis=1)
+    sdf_train = scaler.transform(df_train[nonfeatures + features].reset_index(drop=True), copy=False)
+    sdf_test = scaler.transform(df_test[nonfeatures + features].reset_index(drop=True), copy=False)
 
     return sdf_train, sdf_test
 
 
-def main(event, year, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+def _run_settings(event, year, test=False, **kwargs):
 
     suffix = '_test' if test else ''
 
@@ -107,98 +265,655 @@ def main(event, year, sql_path=os.path.join('..','sql'), test=False, **kwargs):
 
     event_dates_txt = "\nunion\n\n".join(map(lambda s: event_dates_str.format(suffix, **s), mktg_events))
 
-    event_dict = filter(lambda d: d['event']==event, mktg_events)[0]
+    event_dict = [d for d in mktg_events if d['event']==event][0]
     short_event = event_dict['short_event']
 
     date_tag = time.strftime('%Y%m%d') if 'date_tag' not in kwargs else kwargs['date_tag']
     out_handle = 'ep_{0}_{1}_{2}_'.format(short_event, year, date_tag)
-    out_filename = out_handle + '000.gz'
-
-    slug = event_dict['event_slug'] + str(year % 1000)
 
     dl_path = '.' if 'dl_path' not in kwargs else kwargs['dl_path']
-    data_path = dl_path if 'data_path' not in kwargs else kwargs['data_path']
 
-    if 'skip_data_pull' not in kwargs or not kwargs['skip_data_pull']:
-        environment = kwargs['environment']
-        s3_bucket = kwargs['s3_bucket']
-        s3_path = kwargs['s3_path']
+    # A feature store snapshot is a single headed file, like an unload with parallel off
+    parallel_unload = 'parallel_unload' in kwargs and kwargs['parallel_unload'] and _feature_db(**kwargs) is None
 
-        start = time.time()
-        logger.info('Getting target event date span...')
-        sql = rs.read_sql_file(os.path.join(sql_path, '00_get_event_span.sql'))
-        sql = sql.format(suffix, event, year)
-        rows, header = rs.execute_rs_query(sql, return_data=True)
-        end = time.time()
-        logger.info('Obtaining target event dates required {}s'.format(round(end - start, 3)))
+    return {'suffix': suffix,
+            'event_dates_txt': event_dates_txt,
+            'out_handle': out_handle,
+            'out_filename': out_handle + '000.gz',
+            'slug': event_dict['event_slug'] + str(year % 1000),
+            'dl_path': dl_path,
+            'data_path': dl_path if 'data_path' not in kwargs else kwargs['data_path'],
+            'parallel_unload': parallel_unload,
+            'unload_opts': 'manifest parallel on' if parallel_unload else 'parallel off'}
 
-        target_start_dt, target_end_dt = rows[0]
 
-        if 'feature_date_offset' in kwargs:
-            feature_end_dt = target_start_dt - datetime.timedelta(days=kwargs['feature_date_offset'])
-        else:
-            feature_end_dt = target_start_dt
+def _get_cache(**kwargs):
+    if 'cache_dir' not in kwargs or kwargs['cache_dir'] is None:
+        return None
+    max_bytes = None if 'cache_max_bytes' not in kwargs else kwargs['cache_max_bytes']
+    return cu.StageCache(kwargs['cache_dir'], max_bytes)
+
+
+def _evict(cache):
+    # The last stage of a run cuts the cache to its size; run_pipeline clears max_bytes for its
+    # jobs and evicts once they are all done
+    if cache is not None:
+        removed = cache.evict()
+        if removed:
+            logger.info('Evicted {0} cache entries'.format(len(removed)))
+
+
+def _feature_db(**kwargs):
+    return None if 'feature_db' not in kwargs else kwargs['feature_db']
+
+
+def _sql_backend(**kwargs):
+    # Redshift, or the embedded engine over the Parquet copies of its tables in local_sql_dir
+    return rs.get_backend(None if 'local_sql_dir' not in kwargs else kwargs['local_sql_dir'])
 
-        start = time.time()
-        logger.info('Creating and unloading features...')
-        logger.info('This might take some time')
-        creds = s3.get_temp_creds(environment=environment, profile_name='default')
-        sql = rs.read_sql_file(os.path.join(sql_path, '01_unload_data.sql'))
-        sql = sql.format(suffix, target_start_dt, target_end_dt, feature_end_dt,
-                         event_dates_txt, s3_bucket, s3_path, out_handle, creds)
-        rs.execute_rs_query(sql)
-        end = time.time()
-        logger.info('Creating and unloading features required {}s'.format(round(end - start, 3)))
-
-        start = time.time()
-        logger.info('Downloading features locally...')
-        s3.download_file_from_s3(s3_bucket, s3_path, out_filename, filepath=dl_path,
-                                 environment=environment, profile_name='default')
-        end = time.time()
-        logger.info('Downloading features required {}s'.format(round(end - start, 3)))
-
-    sample_df, summary_df = sample_downloaded_data(os.path.join(dl_path, out_filename), **kwargs)
-
-    if 'save_summary' in kwargs and kwargs['save_summary']:
-        summary_file = 'ep_{0}_{1}_summary.csv'
-        summary_df.to_csv(os.path.join(data_path, summary_file.format(slug, 'data')), index=True)
-        sample_gb = sample_df.groupby('persona')['target_shopped_ind'].agg(['count','sum'])
-        sample_gb = sample_gb.rename(columns={'count': 'n', 'sum': 'n_pos'})
-        sample_gb.to_csv(os.path.join(data_path, summary_file.format(slug, 'sample')), index=True)
 
+def _sql_source(**kwargs):
+    # Extra parts of the cache key of a query's result: local copies may hold other rows than Redshift
+    backend = _sql_backend(**kwargs)
+    return [os.path.abspath(backend.data_dir)] if backend.local else []
+
+
+def _query_rows(sql, feature_db=None, backend=None):
+    # The SQL backend (Redshift by default), or the local database of the feature store if there is one
+    if feature_db is None:
+        return (backend or rs.REDSHIFT).execute(sql, return_data=True)
+    conn = fu.connect(feature_db)
+    try:
+        return fu.query(conn, sql)
+    finally:
+        conn.close()
+
+
+# Event calendars by file, loaded once per process
+_calendars = {}
+_calendar_lock = threading.Lock()
+
+# Snapshots write partials to the local database, so they run one at a time
+_store_lock = threading.Lock()
+
+
+def _event_calendar(sql_path, test=False, refresh=False, **kwargs):
+    # The local event calendar if event_calendar names its file (one per table suffix), built
+    # from Redshift the first time and, if refresh, brought up to date.  With a feature_db, the
+    # calendar of its events table, kept next to it unless event_calendar names a file.
+    feature_db = _feature_db(**kwargs)
+    if 'event_calendar' in kwargs and kwargs['event_calendar'] is not None:
+        calendar_file = kwargs['event_calendar']
+    elif feature_db is not None:
+        calendar_file = os.path.splitext(feature_db)[0] + '_calendar.json'
+    else:
+        return None
+    suffix = '_test' if test else ''
+    root, ext = os.path.splitext(calendar_file)
+    filename = root + suffix + ext
+    with _calendar_lock:
+        if filename not in _calendars or refresh:
+            mktg_events, _ = _read_event_text(**kwargs)
+            with tr.span('event_calendar', refresh=refresh):
+                _calendars[filename] = cal.load_calendar(filename, [d['event'] for d in mktg_events],
+                                                         lambda sql: _query_rows(sql, feature_db, _sql_backend(**kwargs)),
+                                                         suffix, sql_path, refresh=refresh)
+        return _calendars[filename]
+
+
+def get_event_span(event, year, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    calendar = _event_calendar(sql_path, test, **kwargs)
+    if calendar is not None:
+        if not calendar.has(event, year):
+            # A span that ended after the calendar was last refreshed
+            logger.info('Refreshing the event calendar')
+            calendar = _event_calendar(sql_path, test, refresh=True, **kwargs)
+        return calendar.span(event, year)
+
+    settings = _run_settings(event, year, test, **kwargs)
+    sql = rs.read_sql_file(os.path.join(sql_path, '00_get_event_span.sql'))
+    sql = sql.format(settings['suffix'], event, year)
+
+    cache = _get_cache(**kwargs)
+    if cache is not None:
+        key = cache.key('span', sql, *_sql_source(**kwargs))
+        if cache.has('span', key):
+            logger.info('Using cached target event date span')
+            return tuple(datetime.datetime.strptime(dt, '%Y-%m-%d').date() for dt in cache.load_json('span', key))
+
+    with tr.span('event_span_sql', 'Getting target event date span'):
+        rows, header = _sql_backend(**kwargs).execute(sql, return_data=True)
+
+    target_start_dt, target_end_dt = rows[0]
+    if cache is not None:
+        cache.save_json('span', key, [str(target_start_dt), str(target_end_dt)])
+    return target_start_dt, target_end_dt
+
+
+def _feature_end_dt(target_start_dt, **kwargs):
+    if 'feature_date_offset' in kwargs:
+        return target_start_dt - datetime.timedelta(days=kwargs['feature_date_offset'])
+    return target_start_dt
+
+
+def _render_unload_sql(settings, target_start_dt, target_end_dt, sql_path, creds, out_handle, **kwargs):
+    sql = rs.read_sql_file(os.path.join(sql_path, '01_unload_data.sql'))
+    return _format_unload_sql(sql, settings, target_start_dt, target_end_dt, _feature_end_dt(target_start_dt, **kwargs),
+                              sql_path, creds, out_handle, **kwargs)
+
+
+def _render_shared_unload_sql(settings, feature_end_dt, targets, sql_path, creds, out_handle, **kwargs):
+    sql = rs.read_sql_file(os.path.join(sql_path, '01_unload_data.sql'))
+    sql = tu.shared_unload_sql(sql, [(t['slug'], t['start_dt'], t['end_dt']) for t in targets])
+    return _format_unload_sql(sql, settings, None, None, feature_end_dt, sql_path, creds, out_handle, **kwargs)
+
+
+def _format_unload_sql(sql, settings, target_start_dt, target_end_dt, feature_end_dt, sql_path, creds, out_handle, **kwargs):
+    event_dates_txt = settings['event_dates_txt']
+    calendar = _event_calendar(sql_path, settings['suffix'] == '_test', **kwargs)
+    if calendar is not None:
+        # Only the spans the unload keeps (ending in the four years before the features end),
+        # so spans added to the calendar later do not change the SQL
+        mktg_events, _ = _read_event_text(**kwargs)
+        event_dates_txt = calendar.dates_select([d['event'] for d in mktg_events],
+                                                feature_end_dt.year - 4, feature_end_dt.year)
+
+    return sql.format(settings['suffix'], target_start_dt, target_end_dt, feature_end_dt,
+                      event_dates_txt, kwargs['s3_bucket'], kwargs['s3_path'],
+                      out_handle, creds, settings['unload_opts'])
+
+
+def _feature_db_source(settings, sql_path, test, **kwargs):
+    # What a feature store snapshot depends on besides its dates: the rows loaded into the
+    # database and the event spans of the calendar it is cut with
+    with _store_lock:
+        conn = fu.connect(kwargs['feature_db'])
+        try:
+            fingerprint = fu.source_fingerprint(conn, settings['suffix'])
+        finally:
+            conn.close()
+    spans = _event_calendar(sql_path, test, **kwargs).spans()
+    span_rows = [[event, int(yr), str(start_dt), str(end_dt)] for event, yr, start_dt, end_dt in
+                 zip(spans['event'], spans['yr'], spans['start_dt'], spans['end_dt'])]
+    return [fingerprint, span_rows]
+
+
+def _extract_key(cache, event, year, sql_path, test, **kwargs):
+    # The extract is addressed by its rendered SQL, without the (per call) credentials and the
+    # date_tag carrying output handle, so rerunning unchanged SQL on another day is still a hit.
+    settings = _run_settings(event, year, test, **kwargs)
+    if 'skip_data_pull' in kwargs and kwargs['skip_data_pull']:
+        return cache.key('extract', cu.file_fingerprint(_extract_files(settings, settings['dl_path'])))
+    target_start_dt, target_end_dt = get_event_span(event, year, sql_path, test, **kwargs)
+    if _feature_db(**kwargs) is not None:
+        # A feature store snapshot is addressed by its database, its source rows, the spans of
+        # its calendar and the dates
+        return cache.key('extract', event, year, os.path.abspath(kwargs['feature_db']), settings['suffix'],
+                         target_start_dt, target_end_dt, _feature_end_dt(target_start_dt, **kwargs),
+                         *_feature_db_source(settings, sql_path, test, **kwargs))
+    sql = _render_unload_sql(settings, target_start_dt, target_end_dt, sql_path, 'CREDENTIALS', 'HANDLE', **kwargs)
+    return cache.key('extract', event, year, sql, *_sql_source(**kwargs))
+
+
+def _extract_files(settings, extract_dir, cached=False):
+    # A cache entry only holds its extract, which may have been downloaded under another date_tag
+    if cached:
+        manifests = glob.glob(os.path.join(extract_dir, '*manifest'))
+        if manifests:
+            return _manifest_files(extract_dir, manifests[0])
+        return sorted(glob.glob(os.path.join(extract_dir, '*.gz')))
+    if settings['parallel_unload']:
+        # The shards of this unload are those of its manifest, not whatever an earlier unload with
+        # more slices left next to them; only an extract written without one is globbed
+        manifest = os.path.join(extract_dir, settings['out_handle'] + 'manifest')
+        if os.path.exists(manifest):
+            return _manifest_files(extract_dir, manifest)
+        return sorted(glob.glob(os.path.join(extract_dir, settings['out_handle'] + '*_part_*.gz')))
+    return [os.path.join(extract_dir, settings['out_filename'])]
+
+
+def _manifest_files(extract_dir, manifest):
+    # The local paths of the files an UNLOAD ... MANIFEST lists, in manifest order
+    with open(manifest, 'r') as f:
+        entries = json.load(f)['entries']
+    return [os.path.join(extract_dir, entry['url'].rsplit('/', 1)[1]) for entry in entries]
+
+
+def unload_features(event, year, target_start_dt, target_end_dt, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    settings = _run_settings(event, year, test, **kwargs)
+    cache = _get_cache(**kwargs)
+    key = None if cache is None else _extract_key(cache, event, year, sql_path, test, **kwargs)
+    _unload_extract(settings, cache, key, lambda creds: _render_unload_sql(
+        settings, target_start_dt, target_end_dt, sql_path, creds, settings['out_handle'], **kwargs), **kwargs)
+
+
+def _unload_extract(settings, cache, key, render, **kwargs):
+    # Runs the UNLOAD render(creds) returns, unless the cache holds its extract
+    if cache is not None and cache.has('extract', key):
+        logger.info('Using cached features, skipping the unload')
+        return
+
+    backend = _sql_backend(**kwargs)
+    with tr.span('unload_sql', 'Creating and unloading features', local=backend.local):
+        logger.info('This might take some time')
+        # A local unload writes to the export directory of the embedded engine, without S3
+        creds = '' if backend.local else s3.get_temp_creds(environment=kwargs['environment'], profile_name='default')
+        backend.execute(render(creds))
+
+
+def download_features(event, year, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    settings = _run_settings(event, year, test, **kwargs)
+    cache = _get_cache(**kwargs)
+    key = None if cache is None else _extract_key(cache, event, year, sql_path, test, **kwargs)
+    _download_extract(settings, cache, key, **kwargs)
+
+
+def _download_extract(settings, cache, key, **kwargs):
+    environment = kwargs['environment']
+    dl_path = settings['dl_path']
+
+    # With a cache, the extract is downloaded into a staging directory that becomes its entry
+    if cache is not None:
+        if cache.has('extract', key):
+            logger.info('Using cached features, skipping the download')
+            return
+        dl_path = cache.staging_dir('extract', key)
+
+    backend = _sql_backend(**kwargs)
+    with tr.span('s3_transfer', 'Downloading features locally', local=backend.local) as sp:
+        if backend.local:
+            backend.copy_unload(kwargs['s3_bucket'], kwargs['s3_path'], settings['out_handle'], filepath=dl_path)
+        elif settings['parallel_unload']:
+            download_workers = 8 if 'download_workers' not in kwargs else kwargs['download_workers']
+            s3.download_unload_shards(kwargs['s3_bucket'], kwargs['s3_path'], settings['out_handle'],
+                                      filepath=dl_path, max_workers=download_workers,
+                                      environment=environment, profile_name='default')
+        else:
+            s3.download_file_from_s3(kwargs['s3_bucket'], kwargs['s3_path'], settings['out_filename'],
+                                     filepath=dl_path, environment=environment, profile_name='default')
+        filenames = [f for f in _extract_files(settings, dl_path) if os.path.exists(f)]
+        sp.add(bytes=sum(os.path.getsize(f) for f in filenames))
+        sp.set(files=len(filenames))
+
+    if cache is not None:
+        cache.commit('extract', key, dl_path)
+
+
+def compute_features(event, year, target_start_dt, target_end_dt, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    ''' Writes the extract from the partials of the local feature store in feature_db, in place of
+    unload_features and download_features
+
+    Only the months of transactions added since the last snapshot are aggregated (see
+    feature_utils), and the spans of the events come from the calendar of its events table.
+    '''
+    settings = _run_settings(event, year, test, **kwargs)
+    cache = _get_cache(**kwargs)
+    key = None if cache is None else _extract_key(cache, event, year, sql_path, test, **kwargs)
+    feature_end_dt = _feature_end_dt(target_start_dt, **kwargs)
+    _compute_extract(settings, cache, key, sql_path, test,
+                     lambda store, spans: store.snapshot(feature_end_dt, target_start_dt, target_end_dt, spans),
+                     **kwargs)
+
+
+def _compute_extract(settings, cache, key, sql_path, test, snapshot, **kwargs):
+    # Writes the extract snapshot(store, spans) returns, unless the cache holds it
+    dl_path = settings['dl_path']
+    if cache is not None:
+        if cache.has('extract', key):
+            logger.info('Using cached features, skipping the feature store')
+            return
+        dl_path = cache.staging_dir('extract', key)
+
+    with tr.span('feature_store', 'Computing features from the local feature store') as sp:
+        mktg_events, _ = _read_event_text(**kwargs)
+        calendar = _event_calendar(sql_path, test, **kwargs)
+        with _store_lock:
+            conn = fu.connect(kwargs['feature_db'])
+            try:
+                df = snapshot(fu.FeatureStore(conn, mktg_events, settings['suffix'], sql_path), calendar.spans())
+            finally:
+                conn.close()
+        sp.add(rows=len(df))
+        fu.write_extract(df, os.path.join(dl_path, settings['out_filename']))
+
+    if cache is not None:
+        cache.commit('extract', key, dl_path)
+
+
+def _sample_stage(settings, sql_path, extract_dir, cached=False, **kwargs):
+    extract_files = _extract_files(settings, extract_dir, cached)
+    kwargs['dtypes'] = _unload_dtypes(sql_path, **kwargs)
+    columns = _read_unload_columns(sql_path)
+    if 'slugs' in settings:
+        # A shared extract is sampled once, counting the positives of every target column
+        target_names = tu.target_columns(sql_path)
+        columns = tu.shared_columns(columns, target_names, settings['slugs'])
+        if kwargs['dtypes'] is not None:
+            kwargs['dtypes'] = tu.shared_dtypes(kwargs['dtypes'], target_names, settings['slugs'])
+        target_col = 'target_shopped_ind' if 'target_col' not in kwargs else kwargs['target_col']
+        kwargs['target_col'] = [tu.shared_name(slug, target_col) for slug in settings['slugs']]
+    if settings['parallel_unload']:
+        # Shards are neither persona-ordered nor headed, so sample them by name in a process pool
+        return sample_downloaded_shards(extract_files, columns, **kwargs)
+    return sample_downloaded_data(extract_files[0], **kwargs)
+
+
+def transform_sample(sample_df, **kwargs):
     if 'log_features' in kwargs:
         log_fn = np.log if 'log_fn' not in kwargs else kwargs['log_fn']
-        for col in kwargs['log_features']:
-            if col in sample_df.columns:
-                sample_df[col] = log_fn(sample_df[col])
-                sample_df.rename(columns={col: 'log_'+col}, inplace=True)
+        sample_df = tfu.log_transform(sample_df, kwargs['log_features'], log_fn)
+    return sample_df
+
+
+def split_scale_sample(sample_df, **kwargs):
+    with tr.span('split_scale', 'Splitting and scaling sample data') as sp:
+        splits = _split_scale(sample_df, **kwargs)
+        sp.add(rows=len(sample_df))
+    return splits
+
 
-    start = time.time()
-    logger.info('Splitting, scaling, and saving sample data...')
+def _split_scale(sample_df, **kwargs):
     features = [col for col in sample_df.columns if col not in ['cust_key','persona','target_shopped_ind']]
     split_state = None if 'split_state' not in kwargs else kwargs['split_state']
     train_size = None if 'train_size' not in kwargs else kwargs['train_size']
     test_size = None if 'test_size' not in kwargs else kwargs['test_size']
-    stratify_col = 10*sample_df['persona'] + sample_df['target_shopped_ind']
+    from sklearn.model_selection import train_test_split
+    stratify_col = 10*sample_df['persona'].astype(np.int64) + sample_df['target_shopped_ind']
     sample_df_train, sample_df_test = train_test_split(sample_df, train_size=train_size, test_size=test_size,
                                                        random_state=split_state, stratify=stratify_col)
     scaled_df_train, scaled_df_test = scale_data(sample_df_train, sample_df_test, features)
-    data_file = 'ep_{0}_{1}_sample.csv.gz'
-    sample_df_train.to_csv(os.path.join(data_path, data_file.format(slug, 'unscaled_train')),
-                           index=False, sep='|', compression='gzip')
-    sample_df_test.to_csv(os.path.join(data_path, data_file.format(slug, 'unscaled_test')),
-                          index=False, sep='|', compression='gzip')
-    scaled_df_train.to_csv(os.path.join(data_path, data_file.format(slug, 'scaled_train')),
-                           index=False, sep='|', compression='gzip')
-    scaled_df_test.to_csv(os.path.join(data_path, data_file.format(slug, 'scaled_test')),
-                          index=False, sep='|', compression='gzip')
-    end = time.time()
-    logger.info('Splitting and scaling sample required {}s'.format(round(end - start, 3)))
+    return {'unscaled_train': sample_df_train, 'unscaled_test': sample_df_test,
+            'scaled_train': scaled_df_train, 'scaled_test': scaled_df_test}
+
+
+def _sample_params(**kwargs):
+    return dict([(k, kwargs[k]) for k in ['sample_size', 'sample_seed', 'sample_mode', 'group_col',
+                                         'target_col', 'n_groups', 'compact_dtypes'] if k in kwargs])
+
+
+def _cached_sample(settings, cache, extract_key, **kwargs):
+    # The extract's directory and the key of its sample, which chains the extract's key
+    if cache is None:
+        return settings['dl_path'], False, None
+    cached_extract = 'skip_data_pull' not in kwargs or not kwargs['skip_data_pull']
+    dl_path = cache.entry_dir('extract', extract_key) if cached_extract else settings['dl_path']
+    return dl_path, cached_extract, cache.key('sample', extract_key, _sample_params(**kwargs))
+
+
+def _load_sample(settings, sql_path, cache, sample_key, extract_dir, cached_extract, **kwargs):
+    if cache is not None and cache.has('sample', sample_key):
+        logger.info('Using cached sample')
+        return cache.load_frames('sample', sample_key)
+    sample_df, summary_df = _sample_stage(settings, sql_path, extract_dir, cached_extract, **kwargs)
+    frames = {'sample': sample_df, 'summary': summary_df}
+    if cache is not None:
+        cache.save_frames('sample', sample_key, frames)
+    return frames
+
+
+def prepare_sample(event, year, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    settings = _run_settings(event, year, test, **kwargs)
+
+    # Each stage's key chains the key of the stage before it, so a changed parameter
+    # recomputes that stage and everything after it
+    cache = _get_cache(**kwargs)
+    extract_key = None if cache is None else _extract_key(cache, event, year, sql_path, test, **kwargs)
+    dl_path, cached_extract, sample_key = _cached_sample(settings, cache, extract_key, **kwargs)
+    _prepare_from_sample(settings, cache, sample_key,
+                         lambda: _load_sample(settings, sql_path, cache, sample_key, dl_path, cached_extract, **kwargs),
+                         **kwargs)
+    _evict(cache)
+
+
+def _prepare_from_sample(settings, cache, sample_key, load_sample, **kwargs):
+    # Transforms, splits, scales and saves the sample (and summary) load_sample returns, unless
+    # the cache holds the stages after the one of sample_key
+    data_path = settings['data_path']
+    slug = settings['slug']
+    if cache is not None:
+        log_fn = np.log if 'log_fn' not in kwargs else kwargs['log_fn']
+        transform_params = {'log_features': kwargs.get('log_features'), 'log_fn': cu.fn_id(log_fn)}
+        transform_key = cache.key('transform', sample_key, transform_params)
+        split_params = dict([(k, kwargs[k]) for k in ['split_state', 'train_size', 'test_size'] if k in kwargs])
+        split_key = cache.key('split', transform_key, split_params)
+
+    if cache is not None and cache.has('split', split_key):
+        logger.info('Using cached split and scaled sample')
+        splits = cache.load_frames('split', split_key)
+    else:
+        if cache is not None and cache.has('transform', transform_key):
+            logger.info('Using cached transformed sample')
+            sample_df = cache.load_frames('transform', transform_key)['sample']
+        else:
+            frames = load_sample()
+            if 'save_summary' in kwargs and kwargs['save_summary']:
+                summary_file = 'ep_{0}_{1}_summary.csv'
+                frames['summary'].to_csv(os.path.join(data_path, summary_file.format(slug, 'data')), index=True)
+                sample_gb = frames['sample'].groupby('persona')['target_shopped_ind'].agg(['count','sum'])
+                sample_gb = sample_gb.rename(columns={'count': 'n', 'sum': 'n_pos'})
+                sample_gb.to_csv(os.path.join(data_path, summary_file.format(slug, 'sample')), index=True)
+
+            sample_df = transform_sample(frames['sample'], **kwargs)
+            if cache is not None:
+                cache.save_frames('transform', transform_key, {'sample': sample_df})
+
+        splits = split_scale_sample(sample_df, **kwargs)
+        if cache is not None:
+            cache.save_frames('split', split_key, splits)
+
+    with tr.span('save_sample', 'Saving sample data') as sp:
+        data_file = 'ep_{0}_{1}_sample'
+        artifact_format = 'csv' if 'artifact_format' not in kwargs else kwargs['artifact_format']
+        for name in ['unscaled_train', 'unscaled_test', 'scaled_train', 'scaled_test']:
+            filename = au.write_artifact(splits[name], os.path.join(data_path, data_file.format(slug, name)), artifact_format)
+            sp.add(rows=len(splits[name]), bytes=os.path.getsize(filename))
+
+        # The scaler is refit on the unscaled train sample (as in scale_data), so it is also
+        # available when the split came from the cache, and kept for scoring the extract
+        features = [col for col in splits['unscaled_train'].columns if col not in ['cust_key','persona','target_shopped_ind']]
+        scaler = tfu.StreamingScaler(features).fit(splits['unscaled_train'])
+        with open(os.path.join(data_path, 'ep_{0}_scaler.pkl'.format(slug)), 'wb') as f:
+            pickle.dump({'features': features, 'scaler': scaler}, f)
+        scaler.save(os.path.join(data_path, 'ep_{0}_scaler.json'.format(slug)))
+
+
+def score_population(event, year, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    settings = _run_settings(event, year, test, **kwargs)
+    data_path = settings['data_path']
+    slug = settings['slug']
+
+    cache = _get_cache(**kwargs)
+    cached_extract = cache is not None and not ('skip_data_pull' in kwargs and kwargs['skip_data_pull'])
+    if cached_extract:
+        extract_dir = cache.entry_dir('extract', _extract_key(cache, event, year, sql_path, test, **kwargs))
+    else:
+        extract_dir = settings['dl_path']
+    extract_files = _extract_files(settings, extract_dir, cached_extract)
+    names = _read_unload_columns(sql_path) if settings['parallel_unload'] else None
+
+    # score_model names a bundle saved by the model selection notebook, which brings its own
+    # features and transforms
+    model_name = kwargs['score_model']
+    bundle_path = os.path.join(data_path, 'ep_{0}_{1}_bundle'.format(slug, model_name))
+    out_filename = os.path.join(data_path, 'ep_{0}_{1}_scores.csv.gz'.format(slug, model_name))
+    return scu.score_extract(extract_files, bdu.load_bundle(bundle_path), out_filename, names=names,
+                             dtypes=_unload_dtypes(sql_path, **kwargs),
+                             chunksize=100000 if 'score_chunksize' not in kwargs else kwargs['score_chunksize'],
+                             n_jobs=kwargs.get('score_workers'))
+
+
+def _save_trace(root, out_handle, **kwargs):
+    # With a trace_dir, the spans of the run and their summary go there (see trace_utils.save)
+    if 'trace_dir' not in kwargs or kwargs['trace_dir'] is None:
+        return None
+    baseline = None if 'trace_baseline' not in kwargs else kwargs['trace_baseline']
+    return tr.save(root.id, os.path.join(kwargs['trace_dir'], out_handle), baseline)
+
+
+def main(event, year, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+
+    setup_logging()
+    with tr.span('main', event=event, year=year) as root:
+        if 'skip_data_pull' not in kwargs or not kwargs['skip_data_pull']:
+            target_start_dt, target_end_dt = get_event_span(event, year, sql_path, test, **kwargs)
+            if _feature_db(**kwargs) is not None:
+                compute_features(event, year, target_start_dt, target_end_dt, sql_path, test, **kwargs)
+            else:
+                unload_features(event, year, target_start_dt, target_end_dt, sql_path, test, **kwargs)
+                download_features(event, year, sql_path, test, **kwargs)
+
+        with tr.span('prepare'):
+            prepare_sample(event, year, sql_path, test, **kwargs)
+
+        if 'score_model' in kwargs:
+            with tr.span('score'):
+                score_population(event, year, sql_path, test, **kwargs)
+
+    _save_trace(root, _run_settings(event, year, test, **kwargs)['out_handle'], **kwargs)
 
     ## Pick up from here
 
 
 
+def shared_targets(event_year_pairs, feature_end_dt=None, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    ''' Returns the feature_end_dt shared by the (event, year) pairs and their targets
+
+    feature_end_dt defaults to the earliest of the pairs' own (see feature_date_offset) and may
+    not be after the start of any target span.  Each target is a dict of event, year, slug,
+    start_dt and end_dt; with skip_data_pull the extract is already there, so the spans and
+    feature_end_dt are not looked up (None).
+    '''
+    targets = [{'event': pair['event'], 'year': pair['year'],
+                'slug': _run_settings(pair['event'], pair['year'], test, **kwargs)['slug']} for pair in event_year_pairs]
+    if 'skip_data_pull' in kwargs and kwargs['skip_data_pull']:
+        return None, targets
+
+    for target in targets:
+        target['start_dt'], target['end_dt'] = get_event_span(target['event'], target['year'], sql_path, test, **kwargs)
+    if feature_end_dt is None:
+        feature_end_dt = min(_feature_end_dt(target['start_dt'], **kwargs) for target in targets)
+    elif not isinstance(feature_end_dt, datetime.date):
+        feature_end_dt = datetime.datetime.strptime(str(feature_end_dt), '%Y-%m-%d').date()
+    early = [target['slug'] for target in targets if target['start_dt'] < feature_end_dt]
+    if early:
+        raise ValueError('The target spans of {0} start before the feature end date {1}'.format(
+            ', '.join(early), feature_end_dt))
+    return feature_end_dt, targets
+
+
+def _shared_settings(targets, test=False, **kwargs):
+    # The settings of the first event, with the output handle and slugs of the shared extract
+    settings = _run_settings(targets[0]['event'], targets[0]['year'], test, **kwargs)
+    slugs = [target['slug'] for target in targets]
+    date_tag = time.strftime('%Y%m%d') if 'date_tag' not in kwargs else kwargs['date_tag']
+    out_handle = 'ep_shared_{0}_{1}_'.format('_'.join(slugs), date_tag)
+    del settings['slug']
+    settings.update({'out_handle': out_handle, 'out_filename': out_handle + '000.gz', 'slugs': slugs})
+    return settings
+
+
+def _shared_extract_key(cache, settings, feature_end_dt, targets, sql_path, test=False, **kwargs):
+    # As _extract_key, for the extract of all the targets
+    if 'skip_data_pull' in kwargs and kwargs['skip_data_pull']:
+        return cache.key('extract', cu.file_fingerprint(_extract_files(settings, settings['dl_path'])))
+    if _feature_db(**kwargs) is not None:
+        return cache.key('extract', 'shared', os.path.abspath(kwargs['feature_db']), settings['suffix'], feature_end_dt,
+                         [(target['slug'], target['start_dt'], target['end_dt']) for target in targets],
+                         *_feature_db_source(settings, sql_path, test, **kwargs))
+    sql = _render_shared_unload_sql(settings, feature_end_dt, targets, sql_path, 'CREDENTIALS', 'HANDLE', **kwargs)
+    return cache.key('extract', 'shared', sql, *_sql_source(**kwargs))
+
+
+def unload_shared_features(targets, feature_end_dt, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    settings = _shared_settings(targets, test, **kwargs)
+    cache = _get_cache(**kwargs)
+    key = None if cache is None else _shared_extract_key(cache, settings, feature_end_dt, targets, sql_path, test, **kwargs)
+    _unload_extract(settings, cache, key, lambda creds: _render_shared_unload_sql(
+        settings, feature_end_dt, targets, sql_path, creds, settings['out_handle'], **kwargs), **kwargs)
+
+
+def download_shared_features(targets, feature_end_dt, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    settings = _shared_settings(targets, test, **kwargs)
+    cache = _get_cache(**kwargs)
+    key = None if cache is None else _shared_extract_key(cache, settings, feature_end_dt, targets, sql_path, test, **kwargs)
+    _download_extract(settings, cache, key, **kwargs)
+
+
+def compute_shared_features(targets, feature_end_dt, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    settings = _shared_settings(targets, test, **kwargs)
+    cache = _get_cache(**kwargs)
+    key = None if cache is None else _shared_extract_key(cache, settings, feature_end_dt, targets, sql_path, test, **kwargs)
+    spans = [(target['slug'], target['start_dt'], target['end_dt']) for target in targets]
+    _compute_extract(settings, cache, key, sql_path, test,
+                     lambda store, calendar_spans: store.shared_snapshot(feature_end_dt, spans, calendar_spans),
+                     **kwargs)
+
+
+def prepare_shared_samples(targets, feature_end_dt, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    ''' prepare_sample for every target of a shared extract, from a single sample of it
+
+    The sample is drawn once by persona, as for the extract of one event, and every target
+    gets its rows with its own target columns, and a summary of its own positives.
+    '''
+    # One streaming pass counts the positives of every target column
+    kwargs['sample_mode'] = 'stream'
+    settings = _shared_settings(targets, test, **kwargs)
+    cache = _get_cache(**kwargs)
+    extract_key = None if cache is None else _shared_extract_key(cache, settings, feature_end_dt, targets, sql_path,
+                                                                 test, **kwargs)
+    dl_path, cached_extract, sample_key = _cached_sample(settings, cache, extract_key, **kwargs)
+
+    # The shared sample is only loaded (or drawn) for the first target whose stages are not cached
+    shared = {}
+    names = _read_unload_columns(sql_path)
+    target_names = tu.target_columns(sql_path)
+    target_col = 'target_shopped_ind' if 'target_col' not in kwargs else kwargs['target_col']
+
+    def load_sample(slug):
+        if not shared:
+            shared.update(_load_sample(settings, sql_path, cache, sample_key, dl_path, cached_extract, **kwargs))
+        pos_col = tu.shared_name(slug, target_col)
+        return {'sample': tu.target_frame(shared['sample'], slug, names, target_names),
+                'summary': shared['summary'][['n', pos_col]].rename(columns={pos_col: 'n_pos'})}
+
+    for target in targets:
+        target_key = None if cache is None else cache.key('sample', sample_key, target['slug'])
+        _prepare_from_sample(_run_settings(target['event'], target['year'], test, **kwargs), cache, target_key,
+                             lambda slug=target['slug']: load_sample(slug), **kwargs)
+    _evict(cache)
+
+
+def main_shared(event_year_pairs, feature_end_dt=None, sql_path=os.path.join('..','sql'), test=False, **kwargs):
+    ''' main for many (event, year) pairs from one extract of the features they share
+
+    The UNLOAD (or feature store snapshot) runs once for feature_end_dt (see shared_targets), with
+    the target columns of every pair (see target_utils), and each pair gets the samples and
+    summary main would save for it.  The extract is not scored; score_population scores the
+    extract of a single event.
+    '''
+    setup_logging()
+    with tr.span('main_shared', targets=len(event_year_pairs)) as root:
+        feature_end_dt, targets = shared_targets(event_year_pairs, feature_end_dt, sql_path, test, **kwargs)
+
+        if 'skip_data_pull' not in kwargs or not kwargs['skip_data_pull']:
+            if _feature_db(**kwargs) is not None:
+                compute_shared_features(targets, feature_end_dt, sql_path, test, **kwargs)
+            else:
+                unload_shared_features(targets, feature_end_dt, sql_path, test, **kwargs)
+                download_shared_features(targets, feature_end_dt, sql_path, test, **kwargs)
+
+        with tr.span('prepare'):
+            prepare_shared_samples(targets, feature_end_dt, sql_path, test, **kwargs)
+
+    _save_trace(root, _shared_settings(targets, test, **kwargs)['out_handle'], **kwargs)
+
+
+def add_lr_features(df):
+    # Features only the linear models use, derived after scaling
+    df['months_since_last_squared'] = df['months_since_last_sale']**2
+    return df
+
+
 def logm1(x):
     y = x.copy()
     y[y <= 0] = -1
@@ -223,10 +938,20 @@ if __name__ == '__main__':
         "s3_path": 'event_propensity/temp_data/',
         "feature_date_offset": 30,
         "skip_data_pull": True,
+        "parallel_unload": False,
         "date_tag": "20180417",
         "sample_size": 250000,
         "sample_seed": 30132,
+        "sample_mode": 'stream',
         "save_summary": True,
+        "artifact_format": 'parquet',
+        "compact_dtypes": True,
+        "event_calendar": os.path.join('temp','event_calendar.json'),
+        "feature_db": None, #os.path.join('temp','liveramp.duckdb'),
+        "local_sql_dir": None, #os.path.join('temp','liveramp_parquet'),
+        "cache_dir": os.path.join('temp','cache'),
+        "cache_max_bytes": 20*2**30,
+        "trace_dir": os.path.join('temp','traces'),
         "log_features": ['fl_total_spend','fl_total_trips','fl_avg_spend_per_trip',
                          'fl_total_spend_ly', 'fl_total_trips_ly','fl_avg_spend_per_trip_ly'],
         "log_fn": logm1, #lambda x: np.log1p(x) if (x <= 0).any() else np.log(x)
@@ -238,3 +963,4 @@ if __name__ == '__main__':
 
     for eyp in event_year_pairs:
         main(eyp['event'], eyp['year'], **params)
+    #main_shared(event_year_pairs, **params)
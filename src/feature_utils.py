@@ -0,0 +1,419 @@
+''' Incremental features from per-customer, per-period partial aggregates
+
+01_unload_data.sql rebuilds base_population, base_trans and the cust_* tables
+from the full transaction history on every (event, year) run, though most of
+that history is the same from one event year to the next.  FeatureStore keeps
+the aggregates of every customer's lines per calendar month in partial tables
+of a local database (SQLite, or DuckDB for a .duckdb file) holding the
+analytics_user_vws.liveramp_* tables of the unload:
+
+    cust_period          sums, counts and maxes of the lines (cust_stats, event spend)
+    cust_period_div      FL product divisions shopped
+    cust_period_channel  channels shopped
+    cust_event_shop      last FL sale in every event span
+
+snapshot merges the partials of the months in the windows of a
+feature_end_dt (the four years of base_trans, the two years of
+base_population and the last year) into the columns of the unload.  A month is
+aggregated once, so a run only scans the months added since the last one, the
+days at the edges of its windows that do not fill a month, and the lines after
+feature_end_dt (an employee discount on any line excludes a customer).
+
+The count distinct features merge through their sets (divisions, channels);
+trips are counted per period, which adds up as long as a trip's lines share a
+sale day.  months_between follows Redshift's.
+
+Example use
+===========
+store = FeatureStore(connect('temp/liveramp.db'), mktg_events)
+df = store.snapshot(feature_end_dt, target_start_dt, target_end_dt, calendar.spans())
+shared_df = store.shared_snapshot(feature_end_dt, [('valday18', '2018-02-01', '2018-02-14'), ...], calendar.spans())
+write_extract(df, 'temp/downloads/ep_valentines_day_2018_20180417_000.gz')
+'''
+
+import os
+import re
+import datetime
+import logging
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import schema_utils as sch
+import target_utils as tu
+import trace_utils as tr
+
+
+logger = logging.getLogger('events_logger')
+
+SOURCE_SCHEMA = 'analytics_user_vws'
+SOURCE_TABLES = ['liveramp_trans', 'liveramp_customers', 'liveramp_funnel', 'liveramp_events',
+                 'liveramp_loyalty', 'liveramp_model_personas_clusters']
+PERIOD_TABLES = ['cust_period', 'cust_period_div', 'cust_period_channel']
+MONTH_START = "substr(cast(trans.sale_dt as varchar), 1, 7) || '-01'"
+
+# cust_stats spends reported as a percent of FL spend, as <name>_pct_spend
+PCT_SPENDS = ['merch', 'womens_prod', 'mens_prod', 'accessories', 'apparel', 'babypet', 'bag', 'beauty',
+              'entertainment', 'food', 'home', 'jewelry', 'other', 'shoe', 'giftcard', 'web']
+
+EVENT_DDL = '''{short}_spend double precision,
+  {short}_shopped_ind integer'''
+EVENT_PARTIALS = '''sum(
+    case when trans.intent_channel in ('FLS','N.COM') and events.{event} = 1 then trans.spend_gross else 0 end
+  ) as {short}_spend,
+  max(
+    case when trans.intent_channel in ('FLS','N.COM') then coalesce(events.{event},0) else 0 end
+  ) as {short}_shopped_ind'''
+EVENT_STATS = '''sum(stats.{short}_spend) as {short}_spend,
+  max(case when stats.period_start >= '{ly_start}' then stats.{short}_shopped_ind else 0 end) as {short}_shop_ly_ind'''
+EVENT_SHOPPED = '''count(distinct case when edates.event = '{event}' then edates.yr else null end) as {short}_years,
+  count(distinct
+    case when edates.event = '{event}' and shop.cust_key is not null then edates.yr else null end
+  ) as {short}_years_shopped'''
+
+
+def connect(filename, partials_filename=None):
+    ''' Opens the local database, DuckDB for a .duckdb file and SQLite otherwise
+
+    The tables of the unload are read as analytics_user_vws.liveramp_*.  A DuckDB file holds
+    them in that schema and the partials next to them.  SQLite has no schemas, so its file
+    is attached under that name to a second file that holds the partials (partials_filename,
+    by default <filename>_partials.db).
+    '''
+    root, ext = os.path.splitext(filename)
+    if ext == '.duckdb':
+        import duckdb
+        return duckdb.connect(filename)
+    conn = sqlite3.connect(partials_filename or root + '_partials.db')
+    conn.execute("attach database '{0}' as {1}".format(filename, SOURCE_SCHEMA))
+    return conn
+
+
+def query(conn, sql):
+    ''' Runs a query, returning (rows, header) like rs.execute_rs_query(sql, return_data=True) '''
+    cursor = conn.execute(sql)
+    return cursor.fetchall(), [d[0] for d in cursor.description]
+
+
+def source_fingerprint(conn, suffix=''):
+    ''' Identifies the source tables of the local database for a cache key: the rows of every
+    liveramp_* table and the last sale_dt of the transactions, which change as rows are loaded
+    (unlike the file, whose partials change with every snapshot) '''
+    fingerprint = []
+    for table in SOURCE_TABLES:
+        rows = conn.execute('select count(*) from {0}.{1}{2}'.format(SOURCE_SCHEMA, table, suffix)).fetchone()[0]
+        fingerprint.append([table, int(rows)])
+    last = conn.execute('select max(sale_dt) from {0}.liveramp_trans{1}'.format(SOURCE_SCHEMA, suffix)).fetchone()[0]
+    fingerprint.append(['max_sale_dt', None if last is None else str(_date(last))])
+    return fingerprint
+
+
+def _date(day):
+    if isinstance(day, datetime.datetime):
+        return day.date()
+    if isinstance(day, datetime.date):
+        return day
+    return datetime.datetime.strptime(str(day)[:10], '%Y-%m-%d').date()
+
+
+def _add_years(day, years):
+    # dateadd(year, ...): the same month and day, Feb 29 falling back to Feb 28
+    try:
+        return day.replace(year=day.year + years)
+    except ValueError:
+        return day.replace(year=day.year + years, day=28)
+
+
+def _next_month(day):
+    return (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def _periods(first_day, last_day, cuts=()):
+    # Splits the days first_day to last_day at every month start and cut into (start, end, whole
+    # month) periods, so any window starting at a cut is a union of periods
+    one_day = datetime.timedelta(days=1)
+    bounds = set([first_day, last_day + one_day])
+    bounds.update(cut for cut in cuts if first_day < cut <= last_day)
+    month = _next_month(first_day)
+    while month <= last_day:
+        bounds.add(month)
+        month = _next_month(month)
+    bounds = sorted(bounds)
+    return [(start, end - one_day, start.day == 1 and end == _next_month(start))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def months_between(later, earlier):
+    ''' Redshift's months_between of a date and a Series of dates (NaN for nulls): the whole
+    months between them, plus the difference of their days over 31 unless the days are the
+    same or both are the last of their months '''
+    later = pd.Timestamp(later)
+    earlier = pd.to_datetime(pd.Series(earlier).values)
+    months = 12 * (later.year - earlier.year) + (later.month - earlier.month)
+    days = np.asarray(later.day - earlier.day, dtype=np.float64)
+    whole = (days == 0) | (later.is_month_end & np.asarray(earlier.is_month_end))
+    return np.asarray(months, dtype=np.float64) + np.where(whole, 0, days / 31)
+
+
+def _days(periods):
+    # The condition on the sale date of a line falling in one of the (start, end) periods
+    return ' or '.join("trans.sale_dt between '{0}' and '{1}'".format(start, end) for start, end in periods)
+
+
+def _period_start(periods):
+    # The start of the period a line falls in, as a case expression
+    return 'case {0} end'.format(' '.join("when trans.sale_dt between '{0}' and '{1}' then '{0}'".format(start, end)
+                                          for start, end in periods))
+
+
+def _statements(sql):
+    # The statements of a script, stripped of comments, with their first word
+    code = re.sub(r'/\*.*?\*/|--[^\n]*', '', sql, flags=re.S)
+    statements = [statement.strip() for statement in code.split(';')]
+    return [(statement, statement.split(None, 1)[0].lower()) for statement in statements if statement]
+
+
+class FeatureStore(object):
+    ''' Partial aggregates of the transactions of a local database, merged into features
+
+    Parameters
+    ----------
+    conn : DB-API connection
+        see connect
+    mktg_events : list of dict
+        the events of mktg_events.json, whose spend and shopped columns the partials hold
+    suffix : str
+        suffix of the tables ('_test' for the test tables)
+    sql_path : str
+    '''
+
+    def __init__(self, conn, mktg_events, suffix='', sql_path=os.path.join('..','sql')):
+        self.conn = conn
+        self.events = [(d['event'], d['short_event']) for d in mktg_events]
+        self.suffix = suffix
+        self.sql_path = sql_path
+        self._run(self._sql('02_create_feature_partials.sql', self._event_columns(EVENT_DDL)))
+
+    def _sql(self, sql_file, *args):
+        with open(os.path.join(self.sql_path, sql_file), 'r') as f:
+            return f.read().format(*args)
+
+    def _event_columns(self, template, **kwargs):
+        return ',\n  '.join(template.format(event=event, short=short, **kwargs) for event, short in self.events)
+
+    def _run(self, sql):
+        # Runs every statement of a script in one transaction; returns the results of its selects
+        frames = []
+        for statement, verb in _statements(sql):
+            cursor = self.conn.execute(statement)
+            if verb == 'select':
+                frames.append(pd.DataFrame(cursor.fetchall(), columns=[d[0] for d in cursor.description]))
+        self.conn.commit()
+        return frames
+
+    def built_through(self):
+        ''' Returns the last day of the partials, or None before any are built '''
+        day = self.conn.execute('select max(period_end) from partial_periods').fetchone()[0]
+        return None if day is None else _date(day)
+
+    def build_partials(self, through_dt):
+        ''' Aggregates the calendar months of the transactions after the last built one, up to
+        the last month ending by through_dt; returns the number of months built '''
+        through_dt = _date(through_dt)
+        built = self.built_through()
+        if built is not None:
+            first_day = built + datetime.timedelta(days=1)
+        else:
+            first = self.conn.execute('select min(sale_dt) from {0}.liveramp_trans{1}'
+                                      .format(SOURCE_SCHEMA, self.suffix)).fetchone()[0]
+            if first is None:
+                return 0
+            first_day = _date(first).replace(day=1)
+        months = [(start, end) for start, end, whole in _periods(first_day, through_dt) if whole]
+        if not months:
+            return 0
+
+        with tr.span('build_partials', 'Building feature partials of {0} months'.format(len(months)),
+                     months=len(months)):
+            sql = self._sql('03_insert_feature_partials.sql', self.suffix, _days([(months[0][0], months[-1][1])]), '',
+                            MONTH_START, self._event_columns(EVENT_PARTIALS))
+            sql += 'insert into partial_periods values {0};\n'.format(
+                ', '.join("('{0}', '{1}')".format(s, e) for s, e in months))
+            self._run(sql)
+        return len(months)
+
+    def build_event_spans(self, spans):
+        ''' Finds the last FL sale of every customer in the spans (a DataFrame of event, yr,
+        start_dt and end_dt, e.g., EventCalendar.spans()) not aggregated yet; returns their number '''
+        built = set((event, int(yr), str(_date(s)), str(_date(e))) for event, yr, s, e in
+                    self.conn.execute('select event, yr, start_dt, end_dt from partial_event_spans').fetchall())
+        new = [span for span in self._span_rows(spans) if span not in built]
+        if not new:
+            return 0
+        self._run('drop table if exists new_event_spans;\n'
+                  'create temp table new_event_spans (event varchar(32), yr integer, start_dt date, end_dt date);\n'
+                  'insert into new_event_spans values {0};\n'.format(self._span_values(new)) +
+                  self._sql('04_insert_event_shop_partials.sql', self.suffix) +
+                  'drop table new_event_spans;\n')
+        return len(new)
+
+    def _span_rows(self, spans):
+        return [(event, int(yr), str(_date(s)), str(_date(e))) for event, yr, s, e in
+                zip(spans['event'], spans['yr'], spans['start_dt'], spans['end_dt'])]
+
+    def _span_values(self, rows):
+        return ', '.join("('{0}', {1}, '{2}', '{3}')".format(*row) for row in rows)
+
+    def snapshot(self, feature_end_dt, target_start_dt, target_end_dt, spans):
+        ''' Returns the features of the unload for feature_end_dt and the target span
+
+        Builds the partials the windows need first, then merges them with the aggregates of
+        the days at the edges of the windows.
+
+        Parameters
+        ----------
+        feature_end_dt : date
+            the features use the lines of the four years before it
+        target_start_dt, target_end_dt : date
+        spans : DataFrame
+            event, yr, start_dt and end_dt of the event spans (EventCalendar.spans())
+
+        Returns
+        -------
+        DataFrame
+            the columns of 01_unload_data.sql, in its order
+        '''
+        return self._snapshot(feature_end_dt, [(None, target_start_dt, target_end_dt)], spans)
+
+    def shared_snapshot(self, feature_end_dt, targets, spans):
+        ''' Returns the shared extract of many target spans for feature_end_dt (see target_utils)
+
+        Parameters
+        ----------
+        feature_end_dt : date
+        targets : list of (slug, start_dt, end_dt)
+        spans : DataFrame
+            as for snapshot
+
+        Returns
+        -------
+        DataFrame
+            the columns of target_utils.shared_columns
+        '''
+        return self._snapshot(feature_end_dt, targets, spans)
+
+    def _snapshot(self, feature_end_dt, targets, spans):
+        feature_end_dt = _date(feature_end_dt)
+        last_day = feature_end_dt - datetime.timedelta(days=1)
+        window_start = _add_years(feature_end_dt, -4)
+        pop_start = _add_years(feature_end_dt, -2)
+        ly_start = _add_years(feature_end_dt, -1)
+
+        self.build_partials(last_day)
+        spans = spans.loc[spans['event'].isin([event for event, _ in self.events])
+                          & (pd.to_datetime(spans['end_dt']) >= pd.Timestamp(window_start))
+                          & (pd.to_datetime(spans['end_dt']) <= pd.Timestamp(last_day))]
+        self.build_event_spans(spans)
+
+        with tr.span('merge_partials', 'Merging feature partials', targets=len(targets)) as sp:
+            # The snap_ views of the partials union the stored months of the windows with the
+            # aggregates of their edges, scanned in one pass
+            periods = _periods(window_start, last_day, [pop_start, ly_start])
+            months = ', '.join("'{0}'".format(s) for s, _, whole in periods if whole) or 'null'
+            edges = [(s, e) for s, e, whole in periods if not whole]
+            sql = ''.join('drop view if exists snap_{0};\ndrop table if exists snap_edge_{0};\n'.format(table)
+                          for table in PERIOD_TABLES)
+            sql += ''.join('drop table if exists snap_{0};\n'.format(table) for table in ['event_spans', 'employees', 'base'])
+            for table in PERIOD_TABLES:
+                sql += 'create temp table snap_edge_{0} as select * from {0} where 1 = 0;\n'.format(table)
+                sql += ('create temp view snap_{0} as select * from {0} where period_start in ({1})\n'
+                        'union all select * from snap_edge_{0};\n'.format(table, months))
+            if edges:
+                sql += self._sql('03_insert_feature_partials.sql', self.suffix, _days(edges), 'snap_edge_',
+                                 _period_start(edges), self._event_columns(EVENT_PARTIALS))
+            sql += 'create temp table snap_event_spans as select * from partial_event_spans where 1 = 0;\n'
+            if len(spans):
+                sql += 'insert into snap_event_spans values {0};\n'.format(self._span_values(self._span_rows(spans)))
+            built = self.built_through()
+            tail_start = feature_end_dt if built is None else max(feature_end_dt, built + datetime.timedelta(days=1))
+            sql += self._sql('05_select_feature_snapshot.sql', self.suffix, feature_end_dt, pop_start, ly_start,
+                             tail_start, self._event_columns(EVENT_STATS, ly_start=ly_start),
+                             self._event_columns(EVENT_SHOPPED), window_start)
+            # then the customers that shopped every target span
+            for _, target_start_dt, target_end_dt in targets:
+                sql += self._sql('06_select_snapshot_target.sql', self.suffix, target_start_dt, target_end_dt)
+            frames = self._run(sql)
+            df = frames[0]
+            for frame in frames[1:5]:
+                df = df.merge(frame, how='left', on='cust_key')
+            for (slug, _, _), frame in zip(targets, frames[5:]):
+                name = 'target_shopped_ind' if slug is None else tu.shared_name(slug, 'target_shopped_ind')
+                df = df.merge(frame.rename(columns={'target_shopped_ind': name}), how='left', on='cust_key')
+            df = self._unload_columns(df, feature_end_dt, targets)
+            sp.add(rows=len(df))
+        return df
+
+    def _unload_columns(self, df, feature_end_dt, targets):
+        # The select list of the unload, from the merged per-customer aggregates, with the
+        # target columns of every target prefixed by its slug (unless it is None)
+        def value(col):
+            return pd.to_numeric(df[col]).fillna(0).values.astype(np.float64)
+
+        def ratio(num, den, scale=100):
+            out = np.zeros(len(df))
+            np.divide(scale * value(num), value(den), out=out, where=value(den) != 0)
+            return out
+
+        features = {'cust_key': df['cust_key'].values,
+                    'persona': df['persona'].values,
+                    'tenure_total_months': months_between(feature_end_dt, df['acq_dt']),
+                    'loyalty_tender_ind': value('loyalty_tender_ind'),
+                    'loyalty_nontender_ind': value('loyalty_nontender_ind'),
+                    'fl_total_spend': value('fl_spend'),
+                    'fl_total_trips': value('fl_trips'),
+                    'fl_avg_spend_per_trip': ratio('fl_spend', 'fl_trips', 1),
+                    'sale_pct_items': ratio('sale_items', 'fl_items'),
+                    'rack_pct_spend': ratio('rack_spend', 'jwn_spend'),
+                    'fl_total_divs': value('fl_divs'),
+                    'total_channels': value('jwn_channels'),
+                    'fl_shopped_ly_ind': value('fl_shopped_ly_ind'),
+                    'fl_total_spend_ly': value('fl_spend_ly'),
+                    'fl_total_trips_ly': value('fl_trips_ly')}
+        for name in PCT_SPENDS:
+            features[name + '_pct_spend'] = ratio(name + '_spend', 'fl_spend')
+        for _, short in self.events:
+            features[short + '_pct_spend'] = ratio(short + '_spend', 'fl_event_day_spend')
+            features[short + '_pct_shopped'] = ratio(short + '_years_shopped', short + '_years')
+            features[short + '_shop_ly_ind'] = value(short + '_shop_ly_ind')
+        for slug, target_start_dt, _ in targets:
+            target = {'target_shopped_ind': value('target_shopped_ind' if slug is None else
+                                                  tu.shared_name(slug, 'target_shopped_ind')),
+                      'months_since_last_sale': months_between(target_start_dt, df['fl_last_sale_dt'])}
+            for name, column in target.items():
+                features[name if slug is None else tu.shared_name(slug, name)] = column
+
+        names = sch.read_unload_select(self.sql_path)[0]
+        dtypes = sch.unload_dtypes(self.sql_path)
+        if targets[0][0] is not None:
+            target_names = tu.target_columns(self.sql_path)
+            slugs = [slug for slug, _, _ in targets]
+            names = tu.shared_columns(names, target_names, slugs)
+            dtypes = tu.shared_dtypes(dtypes, target_names, slugs)
+        missing = [name for name in names if name not in features]
+        if missing:
+            raise ValueError('The partials have no features {0}'.format(', '.join(missing)))
+        df = pd.DataFrame(dict((name, features[name]) for name in names), columns=names)
+        # Integer columns are written as integers, as the unload does
+        df = sch.apply_dtypes(df, dict((name, dtype) for name, dtype in dtypes.items()
+                                       if np.issubdtype(dtype, np.integer)))
+        # The unload's order by persona and (the first) target, descending
+        return df.sort_values(names[1:3], ascending=False, kind='mergesort')
+
+
+def write_extract(df, filename):
+    ''' Writes df as the single file UNLOAD writes: gzipped, pipe delimited, with a header '''
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    df.to_csv(filename, sep='|', index=False, compression='gzip')
@@ -0,0 +1,59 @@
+''' Modules imported on first use
+
+pandas, scikit-learn, psycopg2 and boto3 take most of a second or more to
+import, which a span lookup or a scoring worker that never touches them
+should not pay.  LazyModule stands in for a module bound at import time and
+imports it the first time one of its attributes is read, after which it is
+the module itself to every caller (sys.modules holds the one copy).
+
+Example use
+===========
+pd = LazyModule('pandas')
+rs = LazyModule('redshift_utils')
+df = pd.DataFrame(rows)       # pandas is imported here
+is_loaded('pandas')
+'''
+
+import sys
+import importlib
+
+
+class LazyModule(object):
+    ''' A module imported the first time one of its attributes is read
+
+    Parameters
+    ----------
+    name : str
+        the module, as for import_module
+    '''
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        # import_module is thread-safe and returns the one module of sys.modules, so threads
+        # racing here bind the same module
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return '<lazy module {0!r} ({1})>'.format(self.__dict__['_name'], state)
+
+
+def is_loaded(name):
+    ''' Returns whether module name has been imported in this process '''
+    return name in sys.modules
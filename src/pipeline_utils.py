@@ -0,0 +1,240 @@
+''' Runs the event model pipeline for many (event, year) pairs at once
+
+Each (event, year) pair is a job that walks the stages in STAGES.  Every stage
+is bound to a resource, and each resource has its own concurrency limit:
+
+    redshift  the event span query and the feature UNLOAD (or the snapshot of
+              the local feature store, with a feature_db, or the same SQL on the
+              embedded engine, with a local_sql_dir)
+    s3        downloading the unloaded features (or copying a local unload)
+    cpu       sampling, log transforms, splitting, scaling and writing
+
+Jobs run in their own threads, so the I/O-bound stages of one job overlap
+with those of others, while the cpu stage of each job runs in a separate
+process (see run_in_process), spawned rather than forked, as a fork of the
+threaded parent could copy a lock another thread holds.  run_pipeline returns one row per job with
+its status and the time every stage waited for and spent on its resource.
+
+With a cache_dir, the jobs run without a cache_max_bytes, and the cache is
+cut to it once all jobs are done: the end of one job must not evict the
+extract another job has resolved but not yet sampled.
+
+Example use
+===========
+report = run_pipeline([{"event": "mktg_valentines_day", "year": 2017},
+                       {"event": "mktg_valentines_day", "year": 2018}],
+                      limits={'redshift': 2, 's3': 4, 'cpu': 2},
+                      **params)
+'''
+
+import os
+import time
+import threading
+import traceback
+import multiprocessing
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+import event_model_utils as emu
+import trace_utils as tr
+
+
+logger = emu.logger
+
+STAGES = [('event_span', 'redshift'), ('unload', 'redshift'), ('download', 's3'), ('prepare', 'cpu')]
+
+DEFAULT_LIMITS = {'redshift': 2, 's3': 4, 'cpu': max(1, multiprocessing.cpu_count() // 2)}
+
+
+def _process_target(queue, func, args, kwargs, log):
+    # The spans of the worker go back with its result; a spawned worker imports the modules
+    # afresh, so it logs only if the parent had set up logging
+    if log:
+        emu.setup_logging()
+    tr.reset()
+    try:
+        result = (True, func(*args, **kwargs))
+    except Exception:
+        result = (False, traceback.format_exc())
+    queue.put(result + (tr.records(),))
+
+
+# Seconds between checks that a worker process is still alive
+POLL_S = 1.0
+
+# Workers are spawned: forking the threads of run_pipeline could copy a held lock (of
+# trace_utils, of a log handler) into the child, which would then wait on it forever.
+# Python 2 only forks.
+_mp = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+
+def run_in_process(func, *args, **kwargs):
+    ''' Runs func, a module level function, in a freshly spawned (non-daemonic) process and
+    returns its result.  A pool's daemonic workers could not start the sampling process pool of
+    a parallel unload.  A worker that dies without a result (killed for memory, a signal, a
+    crash in native code) raises RuntimeError rather than leaving the job waiting. '''
+    queue = _mp.Queue()
+    proc = _mp.Process(target=_process_target, args=(queue, func, args, kwargs, bool(logger.handlers)))
+    proc.start()
+    while True:
+        try:
+            ok, result, span_records = queue.get(timeout=POLL_S)
+            break
+        except Empty:
+            if proc.is_alive():
+                continue
+            # The result may still be in the pipe of a worker that has just exited
+            try:
+                ok, result, span_records = queue.get(timeout=POLL_S)
+                break
+            except Empty:
+                proc.join()
+                raise RuntimeError('{0} failed in a worker process: it exited with code {1} without '
+                                   'a result'.format(func.__name__, proc.exitcode))
+    proc.join()
+    tr.adopt(span_records)
+    if not ok:
+        raise RuntimeError('{0} failed in a worker process:\n{1}'.format(func.__name__, result))
+    return result
+
+
+def _run_job(job, semaphores, record, params, pipeline_span):
+    event = job['event']
+    year = job['year']
+    skip_data_pull = 'skip_data_pull' in params and params['skip_data_pull']
+    local_features = 'feature_db' in params and params['feature_db'] is not None
+    state = {}
+
+    def run_stage(name, resource, func):
+        wait_start = time.time()
+        with semaphores[resource]:
+            run_start = time.time()
+            record['stage'] = name
+            logger.info('{0} {1}: starting {2}'.format(event, year, name))
+            with tr.span(name, resource=resource, wait_s=round(run_start - wait_start, 3)):
+                result = func()
+        record[name + '_wait_s'] = round(run_start - wait_start, 3)
+        record[name + '_s'] = round(time.time() - run_start, 3)
+        return result
+
+    stage_funcs = {
+        'event_span': lambda: state.update(span=emu.get_event_span(event, year, **params)),
+        'unload': lambda: (emu.compute_features if local_features else emu.unload_features)(
+            event, year, state['span'][0], state['span'][1], **params),
+        'download': lambda: None if local_features else emu.download_features(event, year, **params),
+        'prepare': lambda: run_in_process(emu.prepare_sample, event, year, **params),
+    }
+
+    start = time.time()
+    with tr.attach(pipeline_span), tr.span('job', event=event, year=year):
+        record['status'] = 'running'
+        try:
+            for name, resource in STAGES:
+                if skip_data_pull and resource != 'cpu':
+                    continue
+                run_stage(name, resource, stage_funcs[name])
+            record['status'] = 'done'
+            del record['stage']
+        except Exception as e:
+            record['status'] = 'failed'
+            # the report keeps the last line, the log has the full (worker) traceback
+            record['error'] = str(e).strip().splitlines()[-1] if str(e).strip() else repr(e)
+            logger.error('{0} {1} failed in {2}: {3}'.format(event, year, record.get('stage'), e))
+    record['total_s'] = round(time.time() - start, 3)
+
+
+def run_pipeline(event_year_pairs, limits=None, max_jobs=None, **params):
+    ''' Runs every (event, year) job concurrently and returns the per-job report
+
+    Parameters
+    ----------
+    event_year_pairs : list of dict
+        [{"event": ..., "year": ...}, ...], events as in mktg_events.json
+    limits : dict, optional
+        concurrent stages allowed per resource, defaults to DEFAULT_LIMITS
+    max_jobs : int, optional
+        jobs in flight at once, by default all of them
+    **params
+        the keyword arguments of event_model_utils.main; with trace_dir, the spans of the run
+        are saved there as ep_pipeline_<date>_trace.jsonl and _trace_summary.csv
+
+    Returns
+    -------
+    DataFrame
+        one row per job: event, year, status, stage (where it failed), error, total_s and
+        <stage>_wait_s / <stage>_s for every stage it ran
+    '''
+    emu.setup_logging()
+    res_limits = dict(DEFAULT_LIMITS)
+    if limits is not None:
+        res_limits.update(limits)
+    semaphores = dict([(res, threading.BoundedSemaphore(n)) for res, n in res_limits.items()])
+    job_slots = threading.BoundedSemaphore(max_jobs or len(event_year_pairs) or 1)
+
+    records = [{'event': job['event'], 'year': job['year'], 'status': 'queued'} for job in event_year_pairs]
+    # Entries in use by running jobs are never evicted: eviction waits for the end of the run
+    job_params = dict(params, cache_max_bytes=None)
+
+    def worker(job, record, pipeline_span):
+        with job_slots:
+            _run_job(job, semaphores, record, job_params, pipeline_span)
+
+    with tr.span('pipeline', 'Pipeline of {0} jobs'.format(len(records)), jobs=len(records)) as root:
+        threads = [threading.Thread(target=worker, args=(job, record, root))
+                   for job, record in zip(event_year_pairs, records)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        emu._evict(emu._get_cache(**params))
+    if 'trace_dir' in params and params['trace_dir'] is not None:
+        tr.save(root.id, os.path.join(params['trace_dir'], 'ep_pipeline_{0}_'.format(time.strftime('%Y%m%d'))),
+                params.get('trace_baseline'))
+
+    import pandas as pd
+    report = pd.DataFrame(records)
+    first = [c for c in ['event', 'year', 'status', 'stage', 'error', 'total_s'] if c in report.columns]
+    timings = [c for name, res in STAGES for c in [name + '_wait_s', name + '_s'] if c in report.columns]
+    return report[first + timings]
+
+
+if __name__ == '__main__':
+
+    event_year_pairs = [{"event": event, "year": year}
+                        for event in ["mktg_valentines_day", "anniversary_public_event"]
+                        for year in [2016, 2017]]
+
+    params = {
+        "test": False,
+        "sql_path": os.path.join('..','sql'),
+        "dl_path": os.path.join('temp','downloads'),
+        "json_path": os.path.join('..','json_and_txt'),
+        "data_path": os.path.join('..','data'),
+        "environment": 'local',
+        "s3_bucket": 'liveramp-testing',
+        "s3_path": 'event_propensity/temp_data/',
+        "feature_date_offset": 30,
+        "skip_data_pull": False,
+        "parallel_unload": True,
+        "sample_size": 250000,
+        "sample_seed": 30132,
+        "sample_mode": 'stream',
+        "save_summary": True,
+        "artifact_format": 'parquet',
+        "event_calendar": os.path.join('temp','event_calendar.json'),
+        "feature_db": None,
+        "local_sql_dir": None,
+        "log_features": ['fl_total_spend','fl_total_trips','fl_avg_spend_per_trip',
+                         'fl_total_spend_ly', 'fl_total_trips_ly','fl_avg_spend_per_trip_ly'],
+        "log_fn": emu.logm1,
+        "split_state": 8379,
+        "train_size": 0.7
+    }
+
+    report = run_pipeline(event_year_pairs, limits={'redshift': 2, 's3': 4, 'cpu': 2}, **params)
+    report.to_csv(os.path.join(params['data_path'], 'ep_pipeline_report_{}.csv'.format(time.strftime('%Y%m%d'))),
+                  index=False)
+    print(report.to_string())
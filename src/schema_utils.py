@@ -0,0 +1,152 @@
+''' Compact column dtypes of the UNLOAD extract, declared by the select list of 01_unload_data.sql
+
+pandas parses every column of the extract as int64 or float64.  unload_dtypes
+reads the column names from the header select of the UNLOAD and the
+expression of every column from the data select, and gives each column the
+first dtype of DTYPE_RULES its name matches:
+
+    cust_key              int64
+    persona               uint8
+    *_ind                 uint8 (0/1 flags)
+    *_pct_*               float32
+    *_trips               uint32
+    *_divs, *_channels    uint8
+    anything else         float32 (spend, months)
+
+An integer dtype is only kept for a column that cannot be null: one that the
+select list coalesces or that only references inner joined tables.  Others
+(e.g., months_since_last_sale of customers without a sale) are float32, so
+they can hold NaN.
+
+Pass the dtypes to pd.read_csv(dtype=...) to parse straight into them, after
+skipping the header row of a shard that starts with it (has_header), or cast
+a frame that could not be parsed typed with apply_dtypes.
+
+Example use
+===========
+dtypes = unload_dtypes('../sql')
+df = pd.read_csv('temp/downloads/ep_annpub_2017_20180417_000.gz', sep='|', dtype=dtypes)
+'''
+
+import os
+import re
+import gzip
+import collections
+
+import numpy as np
+
+
+DTYPE_RULES = [
+    (r'^cust_key$', np.int64),
+    (r'^persona$', np.uint8),
+    (r'_ind$', np.uint8),
+    (r'_pct_', np.float32),
+    (r'_trips$', np.uint32),
+    (r'(_divs|_channels)$', np.uint8),
+]
+DEFAULT_DTYPE = np.float32
+
+
+def _split_select(select):
+    # Splits a select list on the commas outside of parentheses
+    exprs = []
+    depth = 0
+    current = []
+    for char in select:
+        if char == ',' and depth == 0:
+            exprs.append(''.join(current).strip())
+            current = []
+            continue
+        depth += (char == '(') - (char == ')')
+        current.append(char)
+    exprs.append(''.join(current).strip())
+    return exprs
+
+
+def read_unload_select(sql_path=os.path.join('..','sql'), sql_file='01_unload_data.sql'):
+    ''' Returns the column names of the UNLOAD, their select expressions and the aliases of
+    its left joined tables
+
+    The UNLOAD writes its header as the first select of a union (the quoted column names)
+    and the data as the second.
+    '''
+    with open(os.path.join(sql_path, sql_file), 'r') as f:
+        sql = f.read()
+    unload = sql[sql.index("unload('"):]
+    header, data = unload.split('\nunion\n', 1)
+    names = re.findall(r"\\'(\w+)\\'", header)
+
+    select = data[data.index('select') + len('select'):data.index('\nfrom ')]
+    exprs = _split_select(select)
+    if len(exprs) != len(names):
+        raise ValueError('The UNLOAD selects {0} columns but names {1}'.format(len(exprs), len(names)))
+    from_clause = data[data.index('\nfrom '):]
+    left_aliases = re.findall(r'left join\s+\S+\s+as\s+(\w+)', from_clause)
+    return names, exprs, left_aliases
+
+
+def _nullable(expr, left_aliases):
+    if 'coalesce(' in expr:
+        return False
+    return any(re.search(r'\b{0}\.'.format(alias), expr) for alias in left_aliases)
+
+
+def nullable_columns(sql_path=os.path.join('..','sql'), sql_file='01_unload_data.sql'):
+    ''' Returns the columns of the UNLOAD that can be null, in order: those that reference a
+    left joined table and are not coalesced '''
+    names, exprs, left_aliases = read_unload_select(sql_path, sql_file)
+    return [name for name, expr in zip(names, exprs) if _nullable(expr, left_aliases)]
+
+
+def unload_dtypes(sql_path=os.path.join('..','sql'), sql_file='01_unload_data.sql', rules=None):
+    ''' Returns the dtype of every column of the UNLOAD, in order
+
+    Parameters
+    ----------
+    sql_path, sql_file : str
+        the UNLOAD query
+    rules : list of (regex, dtype), optional
+        tried in order on the column names, by default DTYPE_RULES
+
+    Returns
+    -------
+    OrderedDict
+        column name to numpy dtype
+    '''
+    rules = DTYPE_RULES if rules is None else rules
+    names, exprs, left_aliases = read_unload_select(sql_path, sql_file)
+    dtypes = collections.OrderedDict()
+    for name, expr in zip(names, exprs):
+        dtype = DEFAULT_DTYPE
+        for pattern, rule_dtype in rules:
+            if re.search(pattern, name):
+                dtype = rule_dtype
+                break
+        if np.issubdtype(dtype, np.integer) and _nullable(expr, left_aliases):
+            dtype = DEFAULT_DTYPE
+        dtypes[name] = np.dtype(dtype)
+    return dtypes
+
+
+def is_header_line(line, names):
+    ''' Returns whether line (bytes or str, as read from a file of the UNLOAD) is its header row
+
+    The UNLOAD sorts its rows by persona descending as text, where 'persona' comes after every
+    number, so a shard of a parallel UNLOAD that holds the header row holds it first: reading
+    that line tells whether to skip it and parse the rest straight into the dtypes.
+    '''
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    return line.rstrip('\r\n').split('|') == list(names)
+
+
+def has_header(filename, names):
+    ''' Returns whether the gzipped file of the UNLOAD starts with its header row (is_header_line) '''
+    with gzip.open(filename, 'rb') as f:
+        return is_header_line(f.readline(), names)
+
+
+def apply_dtypes(df, dtypes):
+    ''' Casts the columns of df that dtypes declares, e.g., after dropping a shard's header row '''
+    cast = dict((col, dtype) for col, dtype in dtypes.items() if col in df.columns and df[col].dtype != dtype)
+    return df.astype(cast) if cast else df
@@ -0,0 +1,249 @@
+''' Scores the full unloaded extract with the per-persona models
+
+The extract ('ep_*_000.gz' or the shards of a parallel UNLOAD) is read as
+blocks of raw lines, so the parent process only decompresses while a pool of
+workers parses, transforms and scores the blocks.  Each worker loads the
+models (or a bundle from bundle_utils) and the scaler once, applies the same
+transforms as prepare_sample (log_features with log_fn, then the
+scaler of the training sample) and routes every row to the model of
+its persona.  At most a few blocks per worker are in flight, so memory does
+not grow with the size of the extract.
+
+Scores are written as they come back; deciles (1 = highest propensity) need
+the cut points of all scores, so they are added in a second pass over the
+written scores.
+
+Example use
+===========
+stats = score_extract(['temp/downloads/ep_annpub_2017_20180417_000.gz'],
+                      '../data/ep_annpub17_gradboost_model.pkl',
+                      '../data/ep_annpub17_gradboost_scores.csv.gz',
+                      log_features=['fl_total_spend', 'fl_total_trips'], log_fn=logm1)
+'''
+
+import os
+import io
+import gzip
+import time
+import pickle
+import logging
+import itertools
+import collections
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import bundle_utils as bdu
+import tree_utils as tu
+import schema_utils as sch
+import trace_utils as tr
+
+
+logger = logging.getLogger('events_logger')
+
+# Worker state, set by _init_worker in each pool process
+_worker = {}
+
+
+def load_pickle(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def _model_features(models, features):
+    # Features by persona: given, or the columns each model was fit on
+    if isinstance(features, (dict, pd.Series)):
+        return dict((key, list(features[key])) for key in models)
+    if features is not None:
+        return dict((key, list(features)) for key in models)
+    missing = [key for key, mdl in models.items() if not hasattr(mdl, 'feature_names_in_')]
+    if missing:
+        raise ValueError('Models for {0} do not record their features, pass features'.format(missing))
+    return dict((key, list(mdl.feature_names_in_)) for key, mdl in models.items())
+
+
+def _init_worker(models, features, scaler, names, options):
+    if isinstance(models, bdu.ModelBundle) or (not isinstance(models, dict) and os.path.isdir(models)):
+        # A bundle brings its own features and transforms
+        bundle = models if isinstance(models, bdu.ModelBundle) else bdu.load_bundle(models)
+        models = bundle.models
+        features = bundle.features
+        scaler = bundle.scaler
+        options = dict(options, log_features=bundle.log_features, log_fn=bundle.log_fn,
+                       transform_fn=bundle.transform_fn)
+    if not isinstance(models, dict):
+        models = load_pickle(models)
+    if scaler is not None and not isinstance(scaler, dict):
+        scaler = load_pickle(scaler)
+    if options['compile_trees']:
+        models = tu.flatten_models(models)
+    _worker['models'] = models
+    _worker['features'] = _model_features(models, features)
+    _worker['scaler'] = scaler
+    _worker['names'] = names
+    _worker['options'] = options
+
+
+def _parse_block(block, names, dtypes=None):
+    # Blocks hold data rows only (_iter_blocks drops the header lines), so they are parsed
+    # straight into dtypes
+    return pd.read_csv(io.BytesIO(block), header=None, names=names, sep='|', dtype=dtypes)
+
+
+def _score_block(block):
+    opts = _worker['options']
+    id_col = opts['id_col']
+    group_col = opts['group_col']
+    df = _parse_block(block, _worker['names'], opts['dtypes'])
+    df = bdu.transform_chunk(df, opts['log_features'], opts['log_fn'], _worker['scaler'], opts['transform_fn'])
+    scores = bdu.predict_by_group(df, _worker['models'], _worker['features'], group_col)
+    return pd.DataFrame({id_col: df[id_col].values, group_col: df[group_col].values, 'score': scores},
+                        columns=[id_col, group_col, 'score'])
+
+
+def _iter_blocks(filenames, chunksize, names):
+    # Yields blocks of at most chunksize raw lines, without the header row: the first line of a
+    # headed file, or of the shard of a parallel UNLOAD that holds it (schema_utils.is_header_line)
+    for filename in filenames:
+        with gzip.open(filename, 'rb') as f:
+            first = f.readline()
+            if first and not sch.is_header_line(first, names):
+                f = itertools.chain([first], f)
+            while True:
+                lines = list(itertools.islice(f, chunksize))
+                if not lines:
+                    break
+                yield b''.join(lines)
+
+
+def _read_header(filename):
+    with gzip.open(filename, 'rb') as f:
+        return f.readline().decode('utf-8').strip().split('|')
+
+
+def _assign_deciles(scores_file, out_filename, cuts, group_col, by_group, chunksize):
+    # Second pass: reads the written scores back in chunks and adds their deciles
+    first = True
+    with gzip.open(out_filename, 'wb') as out:
+        for chunk in pd.read_csv(scores_file, sep='|', compression='gzip', chunksize=chunksize):
+            decile = np.zeros(len(chunk), dtype=np.int8)
+            if by_group:
+                for key, key_cuts in cuts.items():
+                    rows = np.flatnonzero(chunk[group_col].values == key)
+                    decile[rows] = 10 - np.searchsorted(key_cuts, chunk['score'].values[rows], side='right')
+            else:
+                decile[:] = 10 - np.searchsorted(cuts, chunk['score'].values, side='right')
+            chunk['decile'] = np.where(chunk['score'].isnull(), 0, decile)
+            out.write(chunk.to_csv(sep='|', index=False, header=first).encode('utf-8'))
+            first = False
+
+
+def score_extract(filenames, models, out_filename, features=None, scaler=None, log_features=None, log_fn=np.log,
+                  transform_fn=None, names=None, id_col='cust_key', group_col='persona', deciles=True,
+                  decile_by_group=False, chunksize=100000, n_jobs=None, compile_trees=False, dtypes=None):
+    ''' Scores every row of the extract with its persona's model and writes the scores
+
+    Parameters
+    ----------
+    filenames : list of str
+        the gzipped extract, or its shards in order
+    models : dict, str or ModelBundle
+        fitted classifiers by persona, a pickle of them, or a bundle (or its directory) from
+        bundle_utils, whose features and transforms are then used
+    out_filename : str
+        pipe-delimited gzip with id_col, group_col, score and decile
+    features : list of str or dict, optional
+        model features (by persona), by default each model's feature_names_in_
+    scaler : dict or str, optional
+        scaler saved by prepare_sample (or its pickle), for models fit on scaled data
+    log_features, log_fn
+        as passed to prepare_sample
+    transform_fn : function, optional
+        applied to each chunk after the other transforms (module level, so it can be pickled)
+    names : list of str, optional
+        column names of headerless shards, by default the header of the first file
+    deciles : bool
+        add deciles of the scores, 1 being the highest
+    decile_by_group : bool
+        cut deciles within each persona rather than over everyone
+    chunksize : int
+        lines per block
+    n_jobs : int, optional
+        worker processes, by default the number of cores
+    compile_trees : bool
+        score tree ensembles with their flat arrays (tree_utils.FlatEnsemble) rather than sklearn
+    dtypes : dict, optional
+        column dtypes to parse the extract into (schema_utils.unload_dtypes)
+
+    Returns
+    -------
+    dict
+        rows, seconds and rows_per_sec
+    '''
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+    if names is None:
+        names = _read_header(filenames[0])
+    options = {'id_col': id_col, 'group_col': group_col, 'log_features': log_features,
+               'log_fn': log_fn, 'transform_fn': transform_fn, 'compile_trees': compile_trees,
+               'dtypes': dtypes}
+    scores_file = out_filename + '.scores.tmp' if deciles else out_filename
+
+    start = time.time()
+    logger.info('Scoring {0} files on {1} processes...'.format(len(filenames), n_jobs))
+    with tr.span('score_extract', files=len(filenames), n_jobs=n_jobs) as sp:
+        n_rows = 0
+        all_scores = []
+        all_groups = []
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(models, features, scaler, names, options))
+        try:
+            pending = collections.deque()
+            first = True
+            with gzip.open(scores_file, 'wb') as out:
+                blocks = _iter_blocks(filenames, chunksize, names)
+                while True:
+                    # Keep two blocks per worker in flight and write results in file order
+                    while len(pending) < 2 * n_jobs:
+                        block = next(blocks, None)
+                        if block is None:
+                            break
+                        pending.append(pool.apply_async(_score_block, (block,)))
+                    if not pending:
+                        break
+                    scored = pending.popleft().get()
+                    out.write(scored.to_csv(sep='|', index=False, header=first).encode('utf-8'))
+                    first = False
+                    n_rows += len(scored)
+                    if deciles:
+                        all_scores.append(scored['score'].values.astype(np.float32))
+                        all_groups.append(scored[group_col].values)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if deciles:
+            # Only the scores (and personas) are kept in memory for the cut points
+            scores = np.concatenate(all_scores) if all_scores else np.zeros(0, dtype=np.float32)
+            groups = np.concatenate(all_groups) if all_groups else np.zeros(0)
+            pcts = np.arange(10, 100, 10)
+            if decile_by_group:
+                cuts = {}
+                for key in np.unique(groups):
+                    key_scores = scores[(groups == key) & ~np.isnan(scores)]
+                    if len(key_scores):
+                        cuts[key] = np.percentile(key_scores, pcts)
+            else:
+                cuts = np.percentile(scores[~np.isnan(scores)], pcts) if len(scores) else np.zeros(9)
+            del scores, groups, all_scores, all_groups
+            _assign_deciles(scores_file, out_filename, cuts, group_col, decile_by_group, chunksize)
+            os.remove(scores_file)
+        sp.add(rows=n_rows, bytes=sum(os.path.getsize(filename) for filename in filenames))
+
+    seconds = time.time() - start
+    stats = {'rows': n_rows, 'seconds': round(seconds, 3),
+             'rows_per_sec': round(n_rows / seconds, 1) if seconds > 0 else None}
+    logger.info('Scored {rows} rows in {seconds}s, {rows_per_sec} rows/s'.format(**stats))
+    return stats
@@ -0,0 +1,291 @@
+''' Feature screening by partition: high correlations and low variances in one pass
+
+GroupCovariance keeps, for every group of a partition (e.g., persona), the
+count, mean and sums of products of deviations (co-moments) of the features,
+updated chunk by chunk and merged with the matrix form of the formulas of
+StreamingScaler.  A chunk is sorted by group once, its group means come from a
+single reduceat and each group adds one matrix product, so the statistics of
+all groups are found in one pass over the full extract instead of a df.corr()
+per group of the sample.
+
+From them, high_correlations and low_variances list what get_high_corr and
+get_low_variance found per group in the feature selection notebook, and
+remove_features / keep_features pick the features to drop by thresholds:
+first the low variance ones, then, while a pair of the remaining features is
+correlated past the bound, the one of the pair with the higher mean absolute
+correlation to the others.
+
+Variances are of the features as they are, or standardized by the variance of
+all groups pooled, which is the variance by group of the scaled sample (see
+transform_utils.StreamingScaler), so the unscaled data screens both.
+
+Example use
+===========
+screen = GroupCovariance(features, 'persona').fit(udf_train)
+screen.high_correlations(0.8)
+keep_features = screen.keep_features(corr_bound=0.8, var_bound=0.05)
+screen = screen_extract(extract_files, features, names=names, dtypes=dtypes,
+                        log_features=log_features, log_fn=logm1)
+'''
+
+import os
+import json
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import schema_utils as sch
+import transform_utils as tfu
+import trace_utils as tr
+
+
+class GroupCovariance(object):
+    ''' Covariances of features by group, gathered in one pass over chunks
+
+    Parameters
+    ----------
+    features : list of str
+        columns to screen, in order
+    group_col : str
+        the partition column
+    '''
+
+    def __init__(self, features, group_col='persona'):
+        self.features = list(features)
+        self.group_col = group_col
+        self.n_ = {}
+        self.mean_ = {}
+        self.comoment_ = {}
+
+    @property
+    def groups(self):
+        return sorted(self.n_)
+
+    def _update(self, grp, n, mean, comoment):
+        # Chan et al.'s update of the count, mean and co-moment matrix of a group
+        if grp not in self.n_:
+            self.n_[grp] = n
+            self.mean_[grp] = mean
+            self.comoment_[grp] = comoment
+            return
+        total = self.n_[grp] + n
+        delta = mean - self.mean_[grp]
+        self.comoment_[grp] = self.comoment_[grp] + comoment + np.outer(delta, delta) * self.n_[grp] * n / total
+        self.mean_[grp] = self.mean_[grp] + delta * n / total
+        self.n_[grp] = total
+
+    def partial_fit(self, df):
+        ''' Updates the statistics with a chunk holding group_col and the features; rows missing
+        a feature are skipped '''
+        X = df[self.features].values.astype(np.float64)
+        keep = ~np.isnan(X).any(axis=1)
+        codes, uniques = pd.factorize(df[self.group_col].values[keep], sort=True)
+        if not len(codes):
+            return self
+        order = np.argsort(codes, kind='mergesort')
+        X = X[keep][order]
+        counts = np.bincount(codes, minlength=len(uniques))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        means = np.add.reduceat(X, starts, axis=0) / counts[:, None]
+        X -= np.repeat(means, counts, axis=0)
+        for i, grp in enumerate(uniques):
+            block = X[starts[i]:starts[i] + counts[i]]
+            self._update(grp.item() if hasattr(grp, 'item') else grp, int(counts[i]), means[i], block.T.dot(block))
+        return self
+
+    def fit(self, df, chunksize=100000):
+        ''' Fits on df in chunks of rows '''
+        self.__init__(self.features, self.group_col)
+        for start in range(0, len(df), chunksize):
+            self.partial_fit(df.iloc[start:start + chunksize])
+        return self
+
+    def merge(self, other):
+        ''' Adds the statistics of a GroupCovariance of the same features fit on other chunks '''
+        if other.features != self.features or other.group_col != self.group_col:
+            raise ValueError('Only statistics of the same features and groups can be merged')
+        for grp in other.groups:
+            self._update(grp, other.n_[grp], other.mean_[grp], other.comoment_[grp])
+        return self
+
+    def _pooled_variance(self):
+        # The population variance of all groups together
+        pooled = GroupCovariance(self.features, self.group_col)
+        for grp in self.groups:
+            pooled._update(None, self.n_[grp], self.mean_[grp], self.comoment_[grp])
+        return np.diag(pooled.comoment_[None]) / pooled.n_[None]
+
+    def covariance(self, grp, ddof=1):
+        ''' Returns the covariance matrix of the features in group grp, as a DataFrame '''
+        cov = self.comoment_[grp] / max(self.n_[grp] - ddof, 1)
+        return pd.DataFrame(cov, index=self.features, columns=self.features)
+
+    def correlation(self, grp):
+        ''' Returns the correlation matrix of the features in group grp (NaN for a feature
+        without variance), as a DataFrame '''
+        comoment = self.comoment_[grp]
+        scale = np.sqrt(np.diag(comoment))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = comoment / np.outer(scale, scale)
+        corr[np.outer(scale, scale) == 0] = np.nan
+        return pd.DataFrame(np.clip(corr, -1, 1), index=self.features, columns=self.features)
+
+    def variances(self, ddof=1, standardized=False):
+        ''' Returns the variance of every feature (rows) in every group (columns); standardized
+        divides them by the pooled variance, as for the scaled sample '''
+        var = pd.DataFrame(dict((grp, np.diag(self.comoment_[grp]) / max(self.n_[grp] - ddof, 1))
+                                for grp in self.groups), index=self.features, columns=self.groups)
+        if standardized:
+            pooled = self._pooled_variance()
+            var = var.div(np.where(pooled > 0, pooled, 1.0), axis=0)
+        var.index.name = 'feature'
+        var.columns.name = self.group_col
+        return var
+
+    def high_correlations(self, lower_bound=0.8):
+        ''' Returns the pairs of features whose absolute correlation in a group is over
+        lower_bound: group_col, feature_1, feature_2, corr and its dense rank in the group '''
+        frames = []
+        upper = np.triu_indices(len(self.features), 1)
+        for grp in self.groups:
+            corr = np.abs(self.correlation(grp).values)[upper]
+            high = np.flatnonzero(corr > lower_bound)
+            df = pd.DataFrame({self.group_col: grp,
+                               'feature_1': np.array(self.features)[upper[0][high]],
+                               'feature_2': np.array(self.features)[upper[1][high]],
+                               'corr': corr[high]},
+                              columns=[self.group_col, 'feature_1', 'feature_2', 'corr'])
+            df = df.sort_values('corr', ascending=False, kind='mergesort')
+            df['rank'] = df['corr'].rank(method='dense', ascending=False)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True) if frames else None
+
+    def low_variances(self, upper_bound=0.05, standardized=True):
+        ''' Returns the features whose variance in a group is under upper_bound: group_col,
+        feature, variance and its dense rank in the group '''
+        var = self.variances(standardized=standardized).stack().rename('variance').reset_index()
+        var = var.loc[var['variance'] < upper_bound, [self.group_col, 'feature', 'variance']]
+        var = var.sort_values([self.group_col, 'variance'], kind='mergesort').reset_index(drop=True)
+        var['rank'] = var.groupby(self.group_col)['variance'].rank(method='dense')
+        return var
+
+    def remove_features(self, corr_bound=0.8, var_bound=0.05, standardized=True):
+        ''' Returns the features to remove in every group, {group: [feature, ...]}
+
+        The features with a variance under var_bound go first.  Then, while two of the
+        remaining features are correlated past corr_bound, the one of the pair with the higher
+        mean absolute correlation to the remaining features goes.
+        '''
+        var = self.variances(standardized=standardized)
+        remove = {}
+        for grp in self.groups:
+            low = var[grp].values < var_bound
+            corr = np.abs(self.correlation(grp).values)
+            np.fill_diagonal(corr, 0)
+            corr[np.isnan(corr)] = 0
+            alive = ~low
+            while alive.sum() > 1:
+                sub = np.where(np.outer(alive, alive), corr, 0)
+                i, j = np.unravel_index(np.argmax(sub), sub.shape)
+                if sub[i, j] <= corr_bound:
+                    break
+                mean_corr = sub.sum(axis=1) / (alive.sum() - 1)
+                alive[i if mean_corr[i] >= mean_corr[j] else j] = False
+            remove[grp] = [col for col, keep in zip(self.features, alive) if not keep]
+        return remove
+
+    def keep_features(self, corr_bound=0.8, var_bound=0.05, standardized=True):
+        ''' Returns the features left in every group by remove_features, in order, as the
+        features of partition_grid_search take them '''
+        remove = self.remove_features(corr_bound, var_bound, standardized)
+        return dict((grp, [col for col in self.features if col not in remove[grp]]) for grp in self.groups)
+
+    def to_dict(self):
+        return {'features': self.features, 'group_col': self.group_col,
+                'groups': [[grp, int(self.n_[grp]), self.mean_[grp].tolist(), self.comoment_[grp].tolist()]
+                           for grp in self.groups]}
+
+    @classmethod
+    def from_dict(cls, stats):
+        screen = cls(stats['features'], stats['group_col'])
+        for grp, n, mean, comoment in stats['groups']:
+            screen._update(grp, n, np.array(mean, dtype=np.float64), np.array(comoment, dtype=np.float64))
+        return screen
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+
+def _screen_file(args):
+    # The statistics of one extract file (or parallel UNLOAD shard, given names)
+    filename, features, group_col, names, dtypes, chunksize, log_features, log_fn = args
+    screen = GroupCovariance(features, group_col)
+    if names is None:
+        reader = pd.read_csv(filename, header=0, sep='|', compression='gzip', chunksize=chunksize, dtype=dtypes)
+    else:
+        reader = pd.read_csv(filename, header=None, names=names, sep='|', compression='gzip', chunksize=chunksize)
+    for chunk in reader:
+        if names is not None and not pd.api.types.is_numeric_dtype(chunk[names[0]]):
+            chunk = chunk.loc[chunk[names[0]] != names[0]].apply(pd.to_numeric)
+        if names is not None and dtypes is not None:
+            chunk = sch.apply_dtypes(chunk, dtypes)
+        screen.partial_fit(tfu.log_transform(chunk, log_features, log_fn))
+    return screen
+
+
+def screen_extract(filenames, features, group_col='persona', names=None, dtypes=None, chunksize=500000,
+                   log_features=None, log_fn=np.log, n_jobs=None):
+    ''' Returns the GroupCovariance of features over the full extract
+
+    Parameters
+    ----------
+    filenames : list of str
+        the gzipped extract, or its parallel UNLOAD shards
+    features : list of str
+        as in the sample, log features named log_<col>
+    group_col : str
+    names : list of str, optional
+        the columns of headerless shards (schema_utils.read_unload_select)
+    dtypes : dict, optional
+        column dtypes (schema_utils.unload_dtypes)
+    chunksize : int
+        rows per chunk
+    log_features, log_fn
+        the log transform of the sample (transform_utils.log_transform)
+    n_jobs : int, optional
+        processes screening files at once, by default one per CPU
+
+    Returns
+    -------
+    GroupCovariance
+    '''
+    n_jobs = min(n_jobs or multiprocessing.cpu_count(), len(filenames)) or 1
+    tasks = [(filename, features, group_col, names, dtypes, chunksize, log_features, log_fn)
+             for filename in filenames]
+    with tr.span('screen', 'Screening {0} features in {1} files on {2} processes'.format(
+            len(features), len(filenames), n_jobs), files=len(filenames)) as sp:
+        if n_jobs == 1:
+            results = [_screen_file(task) for task in tasks]
+        else:
+            pool = multiprocessing.Pool(n_jobs)
+            try:
+                results = pool.map(_screen_file, tasks)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        # Merged in file order, so the result does not depend on n_jobs
+        screen = GroupCovariance(features, group_col)
+        for result in results:
+            screen.merge(result)
+        sp.add(rows=sum(screen.n_.values()), bytes=sum(os.path.getsize(filename) for filename in filenames))
+    return screen
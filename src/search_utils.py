@@ -0,0 +1,453 @@
+''' Per-partition (e.g., per persona) hyperparameter searches across a process pool
+
+GridSearchCV parallelises the folds and parameters of one search, so
+fitting one search per persona leaves cores idle between personas.
+partition_grid_search instead queues every (partition, params, fold) fit of
+every persona in one flat task list and runs it on a single process pool.
+
+Each partition's feature matrix, target and fold indices are written once to
+numpy memmaps in a temporary directory; workers map them read-only instead of
+receiving a pickled copy with every task.  The result has the rows and
+columns of GridSearchCV.cv_results_ for every partition, indexed by
+(partition, candidate) as the old slow_apply(groupby, part_grid_search) was.
+
+partition_halving_search is the successive halving version: every round fits
+the surviving candidates on a larger share of a resource, either the rows of
+each training fold or the trees of an ensemble, and keeps the best
+1/factor of them for the next round, so only the last few candidates are fit
+on all of it.  Ensembles that support warm_start (random forests, gradient
+boosting) keep their fitted trees between rounds and only grow the new ones,
+so a boosting candidate dropped early has only paid for its first stages.
+With early_stopping, a boosting candidate also stops growing in a fold once
+the loss on its held-out fold (by staged predictions) has not improved for
+that many stages: it is cut back to its best stage, scored there, and kept as
+is in later rounds, and the results report the stage it stopped at.
+
+Folds from make_folds can be passed to both searches, so every model family
+is compared on the same folds.
+
+Example use
+===========
+cv_rf = partition_grid_search(udf_train, 'persona', keep_features, 'target_shopped_ind',
+                              RandomForestClassifier, {'max_depth': range(6, 15)},
+                              scoring='neg_log_loss', cv=5, n_estimators=200)
+best_params = cv_rf.loc[cv_rf['rank_test_score']==1,'params'].reset_index(level=1, drop=True).to_dict()
+
+folds = make_folds(rf_train_df, 'persona', 'target_shopped_ind', cv=5)
+cv_gb = partition_halving_search(rf_train_df, 'persona', rf_features, 'target_shopped_ind',
+                                 GradientBoostingClassifier, {'max_depth': range(2, 7)},
+                                 resource='n_estimators', scoring='neg_log_loss', folds=folds,
+                                 early_stopping=50, n_estimators=500, learning_rate=0.02)
+'''
+
+import os
+import math
+import time
+import pickle
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from scipy.stats import rankdata
+from sklearn.base import clone, is_classifier
+from sklearn.metrics import check_scoring, log_loss, mean_squared_error
+from sklearn.model_selection import ParameterGrid, check_cv
+
+import trace_utils as tr
+
+
+logger = logging.getLogger('events_logger')
+
+# Worker state, set by _init_worker in each pool process
+_worker = {}
+
+
+def _partition_features(features, key):
+    if isinstance(features, (dict, pd.Series)):
+        return list(features[key])
+    return list(features)
+
+
+def _write_memmap(filename, arr):
+    mm = np.lib.format.open_memmap(filename, mode='w+', dtype=arr.dtype, shape=arr.shape)
+    mm[...] = arr
+    mm.flush()
+    del mm
+    return filename
+
+
+def make_folds(df, partition, target, cv=None, classifier=True):
+    ''' Returns the (train, test) positions of every cross validation fold of every partition
+
+    The positions are within each partition of df in its current row order, so the folds can be
+    reused by searches over other frames (e.g., scaled and unscaled) holding the same rows.
+    '''
+    folds = {}
+    for key, g in df.groupby(partition):
+        y = g[target].values
+        folds[key] = list(check_cv(cv, y, classifier=classifier).split(np.zeros((len(y), 1)), y))
+    return folds
+
+
+def _share_partitions(df, partition, features, target, cv, estimator, drop_empty, mm_dir, folds=None):
+    # Writes every partition's X, y and fold indices to memmaps and returns what the tasks need
+    if folds is None:
+        folds = make_folds(df, partition, target, cv, is_classifier(estimator))
+    shared = {}
+    for i, (key, g) in enumerate(df.groupby(partition)):
+        cols = _partition_features(features, key)
+        X = g[cols]
+        if drop_empty:
+            X = X.dropna(axis=1, how='all')
+        y = g[target].values
+        prefix = os.path.join(mm_dir, 'p{0}_'.format(i))
+        shared[key] = {
+            'X': _write_memmap(prefix + 'X.npy', np.ascontiguousarray(X.values, dtype=np.float64)),
+            'y': _write_memmap(prefix + 'y.npy', y),
+            'folds': [(_write_memmap(prefix + 'train{0}.npy'.format(k), train),
+                       _write_memmap(prefix + 'test{0}.npy'.format(k), test))
+                      for k, (train, test) in enumerate(folds[key])],
+            'n_rows': len(g),
+            'n_features': X.shape[1],
+        }
+    return shared
+
+
+def _init_worker(estimator, scoring, shared):
+    _worker['estimator'] = estimator
+    _worker['scoring'] = scoring
+    _worker['shared'] = shared
+    _worker['arrays'] = {}
+
+
+def _load(filename):
+    # Maps a shared array once per worker process
+    if filename not in _worker['arrays']:
+        _worker['arrays'][filename] = np.load(filename, mmap_mode='r')
+    return _worker['arrays'][filename]
+
+
+def _staged_losses(est, X, y):
+    # The held-out loss after every stage of a boosting ensemble: log loss of a classifier,
+    # squared error of a regressor
+    if is_classifier(est):
+        return np.array([log_loss(y, proba, labels=est.classes_) for proba in est.staged_predict_proba(X)])
+    return np.array([mean_squared_error(y, pred) for pred in est.staged_predict(X)])
+
+
+def _truncate(est, n_stages):
+    # Keeps the first n_stages of a boosting ensemble (gradient boosting or histogram gradient
+    # boosting), so it predicts and warm starts as if it had been fit with that many
+    if hasattr(est, '_predictors'):
+        est._predictors = est._predictors[:n_stages]
+        return est
+    est.estimators_ = est.estimators_[:n_stages]
+    est.train_score_ = est.train_score_[:n_stages]
+    if getattr(est, 'oob_improvement_', None) is not None:
+        est.oob_improvement_ = est.oob_improvement_[:n_stages]
+    est.n_estimators_ = n_stages
+    return est
+
+
+def _fit_task(task):
+    # n_train, if given, fits on the first n_train rows of the (shuffled) training fold.  A state
+    # file warm starts the fit from the candidate's estimator of the previous round and keeps it
+    # for the next one.  With early_stopping, a fit whose held-out loss has not improved for
+    # that many stages is cut back to its best stage, which is returned as stopped.
+    key, cand, fold, params, return_train_score, n_train, state, early_stopping = task
+    part = _worker['shared'][key]
+    X = _load(part['X'])
+    y = _load(part['y'])
+    train = _load(part['folds'][fold][0])
+    test = _load(part['folds'][fold][1])
+    if n_train is not None:
+        train = train[:n_train]
+
+    if state is not None and os.path.exists(state):
+        with open(state, 'rb') as f:
+            est = pickle.load(f)
+        est.set_params(**params)
+    else:
+        est = clone(_worker['estimator']).set_params(**params)
+        if state is not None:
+            est.set_params(warm_start=True)
+    start = time.time()
+    est.fit(X[train], y[train])
+    stopped = None
+    if early_stopping:
+        losses = _staged_losses(est, X[test], y[test])
+        best = int(np.argmin(losses)) + 1
+        if len(losses) - best >= early_stopping:
+            stopped = best
+            _truncate(est, best)
+    fit_time = time.time() - start
+    if state is not None:
+        with open(state, 'wb') as f:
+            pickle.dump(est, f, pickle.HIGHEST_PROTOCOL)
+    scorer = check_scoring(est, scoring=_worker['scoring'])
+    start = time.time()
+    test_score = scorer(est, X[test], y[test])
+    score_time = time.time() - start
+    train_score = scorer(est, X[train], y[train]) if return_train_score else np.nan
+    return key, cand, fold, test_score, train_score, fit_time, score_time, stopped
+
+
+def _run_tasks(pool, tasks, scores):
+    # Runs (key, cand, fold, ...) tasks on the pool and stores their scores in scores[key][(cand, fold)]
+    for key, cand, fold, test_score, train_score, fit_time, score_time, stopped in pool.imap_unordered(_fit_task, tasks):
+        scores[key][(cand, fold)] = {'test': test_score, 'train': train_score,
+                                     'fit_time': fit_time, 'score_time': score_time, 'stopped': stopped}
+
+
+def _start_pool(n_jobs, estimator, scoring, shared):
+    return multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(estimator, scoring, shared))
+
+
+def _cv_results(candidates, scores, n_folds, return_train_score):
+    # Builds one partition's GridSearchCV.cv_results_ from its (candidate, fold) scores
+    results = {}
+    for name in ['fit_time', 'score_time']:
+        arr = np.array([[scores[(c, k)][name] for k in range(n_folds)] for c in range(len(candidates))])
+        results['mean_' + name] = arr.mean(axis=1)
+        results['std_' + name] = arr.std(axis=1)
+    for name in sorted(set(p for params in candidates for p in params)):
+        results['param_' + name] = [params.get(name) for params in candidates]
+    results['params'] = candidates
+    splits = ['test'] + (['train'] if return_train_score else [])
+    for split in splits:
+        arr = np.array([[scores[(c, k)][split] for k in range(n_folds)] for c in range(len(candidates))])
+        for k in range(n_folds):
+            results['split{0}_{1}_score'.format(k, split)] = arr[:, k]
+        results['mean_{0}_score'.format(split)] = arr.mean(axis=1)
+        results['std_{0}_score'.format(split)] = arr.std(axis=1)
+        if split == 'test':
+            results['rank_test_score'] = rankdata(-arr.mean(axis=1), method='min').astype(np.int32)
+    return pd.DataFrame(results)
+
+
+def partition_grid_search(df, partition, features, target, model, param_grid, scoring=None, cv=None,
+                          n_jobs=None, drop_empty=True, return_train_score=False, folds=None, **model_kwargs):
+    ''' Grid searches model on every partition of df in one process pool
+
+    Parameters
+    ----------
+    df : DataFrame
+    partition : str
+        column to fit a separate search for each value of (e.g., 'persona')
+    features : list of str, dict or Series
+        feature columns, or feature columns by partition value
+    target : str
+        target column
+    model : estimator class
+    param_grid : dict or list of dict
+        as for GridSearchCV
+    scoring : str or callable, optional
+        as for GridSearchCV
+    cv : int or cross-validation generator, optional
+        as for GridSearchCV, folds are drawn per partition
+    n_jobs : int, optional
+        worker processes, by default the number of cores
+    drop_empty : bool
+        drop feature columns that are all missing within a partition
+    return_train_score : bool
+    folds : dict, optional
+        folds by partition from make_folds, used instead of cv
+    **model_kwargs
+        fixed arguments of model
+
+    Returns
+    -------
+    DataFrame
+        the cv_results_ of every partition, indexed by (partition, candidate)
+    '''
+    estimator = model(**model_kwargs)
+    candidates = list(ParameterGrid(param_grid))
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+
+    mm_dir = tempfile.mkdtemp(prefix='ep_search_')
+    try:
+        shared = _share_partitions(df, partition, features, target, cv, estimator, drop_empty, mm_dir, folds)
+
+        # Largest partitions first, so the last tasks to finish are short ones
+        keys = sorted(shared, key=lambda k: -shared[k]['n_rows'] * shared[k]['n_features'])
+        tasks = [(key, c, k, params, return_train_score, None, None, None)
+                 for key in keys for c, params in enumerate(candidates) for k in range(len(shared[key]['folds']))]
+
+        message = 'Fitting {0} tasks for {1} partitions on {2} processes'.format(len(tasks), len(keys), n_jobs)
+        with tr.span('grid_search', message, tasks=len(tasks), n_jobs=n_jobs) as sp:
+            scores = dict([(key, {}) for key in keys])
+            pool = _start_pool(n_jobs, estimator, scoring, shared)
+            try:
+                _run_tasks(pool, tasks, scores)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            sp.add(rows=len(df))
+    finally:
+        shutil.rmtree(mm_dir, ignore_errors=True)
+
+    results = []
+    for key in sorted(shared):
+        cv_df = _cv_results(candidates, scores[key], len(shared[key]['folds']), return_train_score)
+        logger.info('{0} {1}: best params {2}'.format(partition, key, cv_df.loc[cv_df['rank_test_score'].idxmin(), 'params']))
+        results.append(cv_df)
+    return pd.concat(results, keys=sorted(shared), names=[partition, None])
+
+
+def _halving_results(candidates, scores, n_folds, last_iter, n_resources):
+    # One row per candidate with the scores of the last round it was fit in.  Candidates that
+    # reached later rounds rank first, as in HalvingGridSearchCV.  stopped_iter is the mean stage
+    # the folds that stopped early were cut back to (NaN if none did).
+    rows = []
+    for c in range(len(candidates)):
+        it = last_iter[c]
+        cand_scores = dict([(k, scores[it][(c, k)]) for k in range(n_folds)])
+        row = _cv_results([candidates[c]], dict([((0, k), v) for k, v in cand_scores.items()]), n_folds, False)
+        row['iter'] = it
+        row['n_resources'] = n_resources[it]
+        stopped = [v['stopped'] for v in cand_scores.values() if v['stopped'] is not None]
+        row['stopped_iter'] = np.mean(stopped) if stopped else np.nan
+        rows.append(row)
+    cv_df = pd.concat(rows, ignore_index=True)
+    order = np.lexsort((-cv_df['mean_test_score'].fillna(-np.inf).values, -cv_df['iter'].values))
+    cv_df['rank_test_score'] = np.empty(len(cv_df), dtype=np.int32)
+    cv_df.loc[order, 'rank_test_score'] = np.arange(1, len(cv_df) + 1, dtype=np.int32)
+    return cv_df
+
+
+def partition_halving_search(df, partition, features, target, model, param_grid, resource='n_samples',
+                             factor=3, min_fraction=None, scoring=None, cv=None, n_jobs=None, drop_empty=True,
+                             folds=None, random_state=0, early_stopping=None, **model_kwargs):
+    ''' Successive halving search of model on every partition of df in one process pool
+
+    Parameters
+    ----------
+    df, partition, features, target, model, param_grid, scoring, cv, n_jobs, drop_empty, folds
+        as for partition_grid_search
+    resource : str
+        'n_samples' to grow the share of each training fold used, or an integer parameter of
+        model (e.g., 'n_estimators') to grow up to its value in model_kwargs.  Estimators with a
+        warm_start parameter keep their fit between rounds.
+    factor : int
+        each round keeps the best 1/factor candidates and multiplies the resource by factor
+    min_fraction : float, optional
+        share of the resource in the first round, by default enough rounds to narrow the grid
+        down to factor or fewer candidates in the last
+    random_state : int
+        shuffles the training folds subsampled by resource='n_samples'
+    early_stopping : int, optional
+        with a warm started boosting model (resource the number of its stages), stop growing a
+        candidate in a fold once the loss on the held-out fold has not improved for this many
+        stages; it is cut back to its best stage and kept, not refit, in later rounds
+    **model_kwargs
+        fixed arguments of model
+
+    Returns
+    -------
+    DataFrame
+        the cv_results_ of every partition, indexed by (partition, candidate), with the scores of
+        the last round each candidate was fit in and the iter and n_resources of that round, and
+        the stage early stopping cut it back to, averaged over the folds that stopped
+        (stopped_iter, NaN if none did).  rank_test_score 1 is the best candidate of the last round, which is fit on all of the
+        resource, so params (without the resource) can be passed on as they are
+    '''
+    estimator = model(**model_kwargs)
+    candidates = list(ParameterGrid(param_grid))
+    n_jobs = n_jobs or multiprocessing.cpu_count()
+
+    n_iter = 1 + int(math.floor(math.log(len(candidates)) / math.log(factor)))
+    if min_fraction is not None:
+        n_iter = min(n_iter, 1 + int(math.floor(math.log(1.0 / min_fraction) / math.log(factor))))
+    fractions = [float(factor) ** -(n_iter - 1 - i) for i in range(n_iter)]
+    warm_start = resource != 'n_samples' and 'warm_start' in estimator.get_params()
+    if resource != 'n_samples':
+        max_resources = estimator.get_params()[resource]
+        resources = [max(1, int(round(max_resources * f))) for f in fractions]
+    if early_stopping and not (warm_start and hasattr(estimator, 'staged_predict')):
+        raise ValueError('early_stopping needs a warm started boosting model (staged_predict) and its '
+                         'number of stages as the resource')
+
+    if folds is None:
+        folds = make_folds(df, partition, target, cv, is_classifier(estimator))
+    if resource == 'n_samples':
+        # Rounds fit on prefixes of the training folds, so shuffle them once
+        rng = np.random.RandomState(random_state)
+        folds = dict([(key, [(rng.permutation(train), test) for train, test in key_folds])
+                      for key, key_folds in sorted(folds.items())])
+
+    mm_dir = tempfile.mkdtemp(prefix='ep_search_')
+    try:
+        shared = _share_partitions(df, partition, features, target, cv, estimator, drop_empty, mm_dir, folds)
+        keys = sorted(shared, key=lambda k: -shared[k]['n_rows'] * shared[k]['n_features'])
+        n_folds = dict([(key, len(shared[key]['folds'])) for key in keys])
+        alive = dict([(key, list(range(len(candidates)))) for key in keys])
+        last_iter = dict([(key, {}) for key in keys])
+        scores = dict([(key, []) for key in keys])
+        n_resources = dict([(key, []) for key in keys])
+        # (candidate, fold) pairs that stopped early, by partition; they are not fit again
+        stopped = dict([(key, set()) for key in keys])
+
+        with tr.span('halving_search', 'Partition halving search', rounds=n_iter, n_jobs=n_jobs) as sp:
+            pool = _start_pool(n_jobs, estimator, scoring, shared)
+            try:
+                for it, fraction in enumerate(fractions):
+                    tasks = []
+                    round_scores = dict([(key, {}) for key in keys])
+                    for key in keys:
+                        for c in alive[key]:
+                            params = dict(candidates[c])
+                            for k in range(n_folds[key]):
+                                if (c, k) in stopped[key]:
+                                    round_scores[key][(c, k)] = dict(scores[key][-1][(c, k)], fit_time=0.0, score_time=0.0)
+                                    continue
+                                n_train = None
+                                state = None
+                                if resource == 'n_samples':
+                                    n_train = max(1, int(len(folds[key][k][0]) * fraction))
+                                else:
+                                    params[resource] = resources[it]
+                                if warm_start:
+                                    state = os.path.join(mm_dir, 'state_{0}_{1}_{2}.pkl'.format(keys.index(key), c, k))
+                                tasks.append((key, c, k, params, False, n_train, state, early_stopping))
+                        if resource == 'n_samples':
+                            n_resources[key].append(int(np.mean([max(1, int(len(train) * fraction))
+                                                                 for train, test in folds[key]])))
+                        else:
+                            n_resources[key].append(resources[it])
+
+                    logger.info('Halving round {0} of {1}: fitting {2} tasks at {3} of {4}...'.format(
+                        it + 1, n_iter, len(tasks), round(fraction, 4), resource))
+                    _run_tasks(pool, tasks, round_scores)
+
+                    for key in keys:
+                        scores[key].append(round_scores[key])
+                        stopped[key].update(ck for ck, v in round_scores[key].items() if v['stopped'] is not None)
+                        means = {}
+                        for c in alive[key]:
+                            last_iter[key][c] = it
+                            means[c] = np.mean([round_scores[key][(c, k)]['test'] for k in range(n_folds[key])])
+                        n_keep = max(1, int(math.ceil(len(alive[key]) / float(factor))))
+                        alive[key] = sorted(alive[key], key=lambda c: np.inf if np.isnan(means[c]) else -means[c])[:n_keep]
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+            sp.add(rows=len(df))
+    finally:
+        shutil.rmtree(mm_dir, ignore_errors=True)
+
+    results = []
+    for key in sorted(shared):
+        cv_df = _halving_results(candidates, scores[key], n_folds[key], last_iter[key], n_resources[key])
+        logger.info('{0} {1}: best params {2}'.format(partition, key, cv_df.loc[cv_df['rank_test_score'].idxmin(), 'params']))
+        results.append(cv_df)
+    return pd.concat(results, keys=sorted(shared), names=[partition, None])
@@ -0,0 +1,416 @@
+''' Online scoring of customers with the per-persona model bundles
+
+ScoringService serves the bundles of bundle_utils over HTTP, one bundle per
+(event, year) and model family, each under a name (e.g., 'annpub17_gradboost').
+
+    POST /score/<name>  a JSON object (one customer) or a list of them, with the
+                        columns of 01_unload_data.sql (cust_key, persona and the
+                        raw features), and returns their scores in order; a
+                        customer without a column its model or the scaler reads
+                        is rejected (400) before it is batched
+    GET  /metrics       requests, rows, batches, p50/p99 latency and throughput
+                        of every bundle
+    GET  /health        the names being served
+
+Requests are handled on their own threads, but not scored there: each bundle
+has a MicroBatcher thread that takes all requests waiting for it (up to
+max_batch_rows, waiting at most max_wait_ms for more once it has one) and
+scores them with one transform and one predict_proba per persona.  Under
+concurrent load this turns many single-row predictions into few vectorized
+ones.  Nothing touches Redshift, so the service and load_test run locally on
+a bundle and a downloaded extract.
+
+Example use
+===========
+service = ScoringService({'annpub17_gradboost': '../data/ep_annpub17_gradboost_bundle'})
+server = service.serve(port=8080, background=True)
+print(load_test('http://localhost:8080/score/annpub17_gradboost', rows_df, n_requests=2000, concurrency=16))
+print(service.metrics())
+'''
+
+import time
+import json
+import logging
+import threading
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen, HTTPError
+
+import numpy as np
+import pandas as pd
+
+import bundle_utils as bdu
+import schema_utils as sch
+
+
+logger = logging.getLogger('events_logger')
+
+
+class LatencyStats(object):
+    ''' Counts and a window of the latest latencies, for percentiles and throughput '''
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.start = time.time()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+
+    def add_request(self, seconds, n_rows, error=False):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.rows += n_rows
+            self.errors += int(error)
+
+    def add_batch(self):
+        with self.lock:
+            self.batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            elapsed = time.time() - self.start
+            out = {'requests': self.requests, 'rows': self.rows, 'batches': self.batches, 'errors': self.errors,
+                   'rows_per_batch': round(float(self.rows) / self.batches, 2) if self.batches else None,
+                   'requests_per_sec': round(self.requests / elapsed, 1),
+                   'rows_per_sec': round(self.rows / elapsed, 1)}
+        for pct in [50, 90, 99]:
+            out['p{0}_ms'.format(pct)] = round(float(np.percentile(latencies, pct)) * 1000, 3) if len(latencies) else None
+        return out
+
+
+class _Pending(object):
+    # One request waiting for its scores
+    def __init__(self, df):
+        self.df = df
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    ''' Scores the requests for one bundle in batches on a background thread
+
+    Parameters
+    ----------
+    bundle : ModelBundle
+    max_batch_rows : int
+        rows scored together at most (a larger request is still scored whole)
+    max_wait_ms : float
+        time to wait for more requests once one is waiting
+    group_col : str
+    '''
+
+    def __init__(self, bundle, max_batch_rows=2048, max_wait_ms=2.0, group_col='persona'):
+        self.bundle = bundle
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000.0
+        self.group_col = group_col
+        self.stats = LatencyStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def score(self, df):
+        ''' Returns the scores of the rows of df, blocking until their batch has been scored '''
+        pending = _Pending(df)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.scores
+
+    def _predict(self, df):
+        return self.bundle.predict_proba(self.bundle.transform(df), self.group_col)
+
+    def _take_batch(self):
+        batch = [self.queue.get()]
+        n_rows = len(batch[0].df)
+        deadline = time.time() + self.max_wait
+        while n_rows < self.max_batch_rows:
+            try:
+                pending = self.queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            batch.append(pending)
+            n_rows += len(pending.df)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                if len(batch) == 1:
+                    batch[0].scores = self._predict(batch[0].df.copy())
+                else:
+                    scores = self._predict(pd.concat([p.df for p in batch], ignore_index=True))
+                    bounds = np.cumsum([0] + [len(p.df) for p in batch])
+                    for p, lo, hi in zip(batch, bounds[:-1], bounds[1:]):
+                        p.scores = scores[lo:hi]
+            except Exception:
+                # Score the requests of a failed batch one by one, so a bad payload only fails itself
+                for p in batch:
+                    try:
+                        p.scores = self._predict(p.df.copy())
+                    except Exception as e:
+                        p.error = e
+            self.stats.add_batch()
+            for p in batch:
+                p.done.set()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under concurrent load
+    request_queue_size = 128
+
+
+def _handler(service):
+    # Request handler class bound to a service
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, service.metrics())
+            elif self.path == '/health':
+                self._reply(200, {'status': 'ok', 'models': sorted(service.batchers)})
+            else:
+                self._reply(404, {'error': 'Unknown path {0}'.format(self.path)})
+
+        def do_POST(self):
+            name = self.path[len('/score/'):] if self.path.startswith('/score/') else None
+            if name not in service.batchers:
+                self._reply(404, {'error': 'Unknown model {0}'.format(name)})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                payload = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError as e:
+                self._reply(400, {'error': 'Invalid JSON: {0}'.format(e)})
+                return
+            code, body = service.score(name, payload)
+            self._reply(code, body)
+
+    return Handler
+
+
+class ScoringService(object):
+    ''' Scores JSON payloads of customers with model bundles, micro-batching concurrent requests
+
+    Parameters
+    ----------
+    bundles : dict
+        ModelBundles, or bundle directories for load_bundle, by name
+    id_col, group_col : str
+        returned with every score; group_col routes rows to the persona models
+    dtypes : dict, optional
+        the columns a payload may have and their dtypes (schema_utils.unload_dtypes); other
+        columns are rejected
+    **batch_kwargs
+        max_batch_rows and max_wait_ms of MicroBatcher
+    '''
+
+    def __init__(self, bundles, id_col='cust_key', group_col='persona', dtypes=None, **batch_kwargs):
+        self.id_col = id_col
+        self.group_col = group_col
+        self.dtypes = dtypes
+        self.batchers = {}
+        for name, bundle in bundles.items():
+            if not isinstance(bundle, bdu.ModelBundle):
+                bundle = bdu.load_bundle(bundle)
+            # Load the models now rather than on the first request
+            bundle.models
+            bundle.scaler
+            self.batchers[name] = MicroBatcher(bundle, group_col=group_col, **batch_kwargs)
+        logger.info('Serving {0}'.format(sorted(self.batchers)))
+
+    def _frame(self, payload, bundle):
+        if isinstance(payload, dict) and 'rows' in payload:
+            payload = payload['rows']
+        rows = [payload] if isinstance(payload, dict) else payload
+        if not isinstance(rows, list) or not rows or not all(isinstance(row, dict) for row in rows):
+            raise ValueError('Expected a customer object, a list of them or {"rows": [...]}')
+        df = pd.DataFrame(rows)
+        missing = [col for col in [self.id_col, self.group_col] if col not in df.columns]
+        unknown = [col for col in df.columns if self.dtypes is not None and col not in self.dtypes]
+        if missing or unknown:
+            raise ValueError('Missing columns {0}, unknown columns {1}'.format(missing, unknown))
+        # Every row must carry the columns of its persona's model: once batched, a missing one
+        # would be NaN, which some models score without complaint
+        inputs = {}
+        for i, row in enumerate(rows):
+            group = row.get(self.group_col)
+            if group not in inputs:
+                inputs[group] = bundle.input_columns(pd.to_numeric(group)) or []
+            missing = [col for col in inputs[group] if col not in row]
+            if missing:
+                raise ValueError('Row {0} is missing columns {1}'.format(i, missing))
+        df = df.apply(pd.to_numeric)
+        return df if self.dtypes is None else sch.apply_dtypes(df, self.dtypes)
+
+    def score(self, name, payload):
+        ''' Returns the HTTP status and body for a payload of customers to score with bundle name '''
+        batcher = self.batchers[name]
+        start = time.time()
+        n_rows = 0
+        try:
+            df = self._frame(payload, batcher.bundle)
+            n_rows = len(df)
+            scores = batcher.score(df)
+        except (ValueError, KeyError) as e:
+            batcher.stats.add_request(time.time() - start, n_rows, error=True)
+            return 400, {'error': '{0}: {1}'.format(type(e).__name__, e)}
+        except Exception as e:
+            logger.exception('Scoring with {0} failed'.format(name))
+            batcher.stats.add_request(time.time() - start, n_rows, error=True)
+            return 500, {'error': '{0}: {1}'.format(type(e).__name__, e)}
+        batcher.stats.add_request(time.time() - start, n_rows)
+        results = [{self.id_col: key, self.group_col: group, 'score': None if np.isnan(score) else float(score)}
+                   for key, group, score in zip(df[self.id_col].tolist(), df[self.group_col].tolist(), scores)]
+        return 200, {'model': name, 'scores': results}
+
+    def metrics(self):
+        return dict((name, batcher.stats.summary()) for name, batcher in self.batchers.items())
+
+    def serve(self, host='127.0.0.1', port=8080, background=False):
+        ''' Starts the HTTP server; returns it at once if background, else serves until interrupted '''
+        server = _ThreadingHTTPServer((host, port), _handler(self))
+        logger.info('Scoring service listening on {0}:{1}'.format(host, server.server_port))
+        if not background:
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+            return server
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+def _post(url, body):
+    request = Request(url, json.dumps(body).encode('utf-8'), {'Content-Type': 'application/json'})
+    try:
+        response = urlopen(request)
+        code = response.getcode()
+    except HTTPError as e:
+        response = e
+        code = e.code
+    response.read()
+    return code
+
+
+def load_test(url, rows_df, n_requests=1000, concurrency=8, rows_per_request=1, seed=0):
+    ''' Posts n_requests payloads of rows drawn from rows_df to url from concurrency threads
+
+    Parameters
+    ----------
+    url : str
+        e.g., 'http://localhost:8080/score/annpub17_gradboost'
+    rows_df : DataFrame
+        rows of the extract (raw unload columns) to draw payloads from
+    rows_per_request : int
+        1 sends single customer objects, more sends lists
+    seed : int
+
+    Returns
+    -------
+    dict
+        requests, errors, seconds, requests_per_sec, rows_per_sec and client side p50/p90/p99_ms
+    '''
+    rng = np.random.RandomState(seed)
+    records = rows_df.to_dict('records')
+    picks = rng.randint(0, len(records), (n_requests, rows_per_request))
+    payloads = [records[i[0]] if rows_per_request == 1 else [records[j] for j in i] for i in picks]
+    latencies = [None] * n_requests
+    codes = [None] * n_requests
+    counter = iter(range(n_requests))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.time()
+            codes[i] = _post(url, payloads[i])
+            latencies[i] = time.time() - start
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    latencies = np.array(latencies)
+    out = {'requests': n_requests, 'errors': sum(code != 200 for code in codes), 'seconds': round(seconds, 3),
+           'requests_per_sec': round(n_requests / seconds, 1),
+           'rows_per_sec': round(n_requests * rows_per_request / seconds, 1)}
+    for pct in [50, 90, 99]:
+        out['p{0}_ms'.format(pct)] = round(float(np.percentile(latencies, pct)) * 1000, 3)
+    return out
+
+
+if __name__ == '__main__':
+
+    import os
+
+    # Serves the bundles saved by the model selection notebook and load tests them with rows of
+    # the downloaded extract; needs neither Redshift nor S3
+    params = {
+        "sql_path": os.path.join('..','sql'),
+        "data_path": os.path.join('..','data'),
+        "extract_file": os.path.join('temp','downloads','ep_annpub_2017_20180417_000.gz'),
+        "bundles": ['annpub17_gradboost', 'annpub17_randforest'],
+        "port": 8080,
+        "max_batch_rows": 2048,
+        "max_wait_ms": 2.0,
+        "load_rows": 10000,
+    }
+
+    bundles = dict((name, os.path.join(params['data_path'], 'ep_{0}_bundle'.format(name)))
+                   for name in params['bundles'])
+    dtypes = sch.unload_dtypes(params['sql_path'])
+    service = ScoringService(bundles, dtypes=dtypes,
+                             max_batch_rows=params['max_batch_rows'], max_wait_ms=params['max_wait_ms'])
+    server = service.serve(port=params['port'], background=True)
+    rows_df = pd.read_csv(params['extract_file'], sep='|', nrows=params['load_rows'], dtype=dtypes)
+    for name in params['bundles']:
+        url = 'http://127.0.0.1:{0}/score/{1}'.format(server.server_port, name)
+        for concurrency, rows_per_request in [(1, 1), (16, 1), (16, 100)]:
+            print(name, concurrency, rows_per_request,
+                  load_test(url, rows_df, 2000, concurrency, rows_per_request))
+    print(json.dumps(service.metrics(), indent=1))
+    server.shutdown()
@@ -0,0 +1,177 @@
+''' Synthetic extracts with the columns of the UNLOAD, to run the pipeline offline
+
+generate_extract writes gzipped, pipe-delimited files laid out as the UNLOAD
+of 01_unload_data.sql writes them: the columns of its header select, in
+order, sorted by persona then target_shopped_ind, both descending, as a single
+headed file (parallel off) or as headerless shards of a parallel UNLOAD with
+the header row in the first one.
+
+Every column is drawn by the dtype rule its name matches (schema_utils):
+flags, shares in [0, 1], trip and division counts, months, and spend from a
+lognormal.  The columns of a row share a latent engagement that is raised by
+signal for the customers who shopped the target, so the features are
+correlated with each other and predictive of the target, and columns the
+UNLOAD may leave null are null at null_rate.  The sizes of the personas and
+their positive rates are set, and everything is reproducible from seed.
+
+Blocks are written with the CSV writer of pyarrow when it is installed (several
+times faster than pandas, which is used otherwise), at a low gzip level by
+default.
+
+Example use
+===========
+filenames = generate_extract('temp/bench/ep_synth_1m_', 1000000, pos_rate=0.1, seed=1)
+filenames = generate_extract('temp/bench/ep_synth_1m_', 1000000, pos_rate={1: 0.05, 2: 0.2}, n_shards=4)
+'''
+
+import os
+import gzip
+
+import numpy as np
+import pandas as pd
+
+import schema_utils as sch
+import trace_utils as tr
+
+
+def _persona_sizes(n_rows, personas, weights, rng):
+    if weights is None:
+        weights = rng.dirichlet(5 * np.ones(len(personas)))
+    weights = np.asarray(weights, dtype=np.float64)
+    return rng.multinomial(n_rows, weights / weights.sum())
+
+
+def _column_params(names, rng):
+    # The loading of every column on the latent engagement and its base level
+    return dict((name, {'weight': rng.uniform(0.3, 1.0) * rng.choice([-1, 1], p=[0.2, 0.8]),
+                        'level': rng.uniform(-2.5, 0.5)}) for name in names)
+
+
+def _column_values(name, latent, params, rng):
+    # Draws one column for the rows of latent, by the dtype rule its name matches
+    n = len(latent)
+    z = params['weight'] * latent + params['level'] + rng.standard_normal(n)
+    if name.endswith('_ind'):
+        return (rng.random_sample(n) < 1 / (1 + np.exp(-z))).astype(np.uint8)
+    if '_pct_' in name:
+        share = 1 / (1 + np.exp(-z))
+        share[rng.random_sample(n) < 0.3] = 0
+        return share.astype(np.float32)
+    if name.endswith('_trips'):
+        return np.minimum(rng.poisson(np.exp(1 + 0.5 * z)), np.iinfo(np.uint32).max).astype(np.uint32)
+    if name.endswith('_divs') or name.endswith('_channels'):
+        return np.minimum(1 + rng.poisson(np.exp(0.5 * z)), 20).astype(np.uint8)
+    if 'months' in name:
+        return np.round(rng.exponential(24 * np.exp(0.3 * z))).astype(np.float32)
+    spend = np.exp(4 + z)
+    spend[rng.random_sample(n) < 0.1] = 0
+    return np.round(spend, 2).astype(np.float32)
+
+
+def _csv_writer():
+    # The pyarrow CSV writer if pyarrow is installed, else pandas
+    try:
+        import pyarrow
+        import pyarrow.csv
+    except ImportError:
+        return lambda df: df.to_csv(sep='|', header=False, index=False, float_format='%.6g').encode('utf-8')
+    options = pyarrow.csv.WriteOptions(include_header=False, delimiter='|')
+
+    def write(df):
+        sink = pyarrow.BufferOutputStream()
+        pyarrow.csv.write_csv(pyarrow.Table.from_pandas(df, preserve_index=False), sink, options)
+        return sink.getvalue().to_pybytes()
+    return write
+
+
+def _frame(names, nullable, column_params, keys, persona, target, signal, null_rate, rng):
+    # A block of rows of one persona and target value
+    n = len(keys)
+    latent = rng.standard_normal(n) + signal * target
+    columns = {'cust_key': keys, 'persona': np.full(n, persona, dtype=np.uint8),
+               'target_shopped_ind': np.full(n, target, dtype=np.uint8)}
+    for name in names:
+        if name in columns:
+            continue
+        values = _column_values(name, latent, column_params[name], rng)
+        if name in nullable and null_rate > 0:
+            values = values.astype(np.float32)
+            values[rng.random_sample(n) < null_rate] = np.nan
+        columns[name] = values
+    return pd.DataFrame(columns, columns=names)
+
+
+def generate_extract(out_handle, n_rows, pos_rate=0.1, n_personas=6, persona_weights=None, n_shards=None,
+                     seed=None, signal=0.5, null_rate=0.01, chunksize=1000000, compresslevel=1,
+                     sql_path=os.path.join('..','sql'), sql_file='01_unload_data.sql'):
+    ''' Writes a synthetic extract of n_rows and returns its file names
+
+    Parameters
+    ----------
+    out_handle : str
+        path and prefix of the files: <out_handle>000.gz, or <out_handle><nnnn>_part_00.gz
+        for shards
+    n_rows : int
+    pos_rate : float or dict
+        the share of target_shopped_ind, overall or by persona
+    n_personas : int
+        personas 1 to n_personas
+    persona_weights : list of float, optional
+        relative persona sizes, by default drawn from seed
+    n_shards : int, optional
+        write the headerless shards of a parallel UNLOAD rather than a single headed file
+    seed : int, optional
+    signal : float
+        how much shopping the target raises the latent engagement of a customer
+    null_rate : float
+        the share of nulls in the columns the UNLOAD may leave null
+    chunksize : int
+        rows generated and written at a time
+    compresslevel : int
+        gzip level of the files
+    sql_path, sql_file : str
+        the UNLOAD whose columns are written
+
+    Returns
+    -------
+    list of str
+    '''
+    rng = np.random.RandomState(seed)
+    names = sch.read_unload_select(sql_path, sql_file)[0]
+    nullable = set(sch.nullable_columns(sql_path, sql_file))
+    column_params = _column_params(names, rng)
+    personas = list(range(1, n_personas + 1))
+    sizes = _persona_sizes(n_rows, personas, persona_weights, rng)
+
+    directory = os.path.dirname(out_handle)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if n_shards is None:
+        filenames = [out_handle + '000.gz']
+    else:
+        filenames = [out_handle + '{0:04d}_part_00.gz'.format(i) for i in range(n_shards)]
+    outs = [gzip.open(filename, 'wb', compresslevel) for filename in filenames]
+    to_csv = _csv_writer()
+
+    with tr.span('generate', 'Generating {0} synthetic rows in {1} files'.format(n_rows, len(filenames)),
+                 files=len(filenames)) as sp:
+        try:
+            outs[0].write(('|'.join(names) + '\n').encode('utf-8'))
+            # Customer keys are unique and shuffled, rows come in the UNLOAD's order
+            keys = rng.permutation(n_rows).astype(np.int64) + 10000000
+            start = 0
+            for persona, size in sorted(zip(personas, sizes), reverse=True):
+                rate = pos_rate[persona] if isinstance(pos_rate, dict) else pos_rate
+                n_pos = rng.binomial(size, rate)
+                for target, count in [(1, n_pos), (0, size - n_pos)]:
+                    for offset in range(0, count, chunksize):
+                        block_keys = keys[start:start + min(chunksize, count - offset)]
+                        start += len(block_keys)
+                        df = _frame(names, nullable, column_params, block_keys, persona, target, signal, null_rate, rng)
+                        for i, out in enumerate(outs):
+                            out.write(to_csv(df.iloc[i::len(outs)]))
+        finally:
+            for out in outs:
+                out.close()
+        sp.add(rows=n_rows, bytes=sum(os.path.getsize(filename) for filename in filenames))
+    return filenames
@@ -0,0 +1,130 @@
+''' Shared extracts: the features of one feature_end_dt with the target columns of many events
+
+Every column of 01_unload_data.sql depends only on the feature_end_dt ({3}),
+except the ones of the target event: target_shopped_ind (an FL line in the
+target span, {1} to {2}) and months_since_last_sale (counted to {1}).  The
+events modelled from one feature_end_dt therefore share the base population
+and all the other features.  A shared extract holds them once, with the target
+columns repeated for every target event and prefixed by its slug:
+
+    cust_key, persona, valday18_target_shopped_ind, mothday18_target_shopped_ind,
+    tenure_total_months, ..., valday18_months_since_last_sale, mothday18_months_since_last_sale, ...
+
+shared_unload_sql turns the UNLOAD into the one of a shared extract, and
+target_frame cuts the columns of one event out of it, named and ordered as
+its own extract.
+
+Example use
+===========
+targets = [('valday18', '2018-02-01', '2018-02-14'), ('mothday18', '2018-04-29', '2018-05-13')]
+sql = shared_unload_sql(rs.read_sql_file('../sql/01_unload_data.sql'), targets)
+df = target_frame(shared_df, 'valday18', read_unload_select('../sql')[0], target_columns('../sql'))
+'''
+
+import os
+import re
+import collections
+
+import schema_utils as sch
+
+
+# The placeholders and the alias of the target span in the UNLOAD
+TARGET_REFS = [r"\\'\{1\}\\'", r"\\'\{2\}\\'", r'\btarget\.']
+
+
+def shared_name(slug, name):
+    return '{0}_{1}'.format(slug, name)
+
+
+def target_columns(sql_path=os.path.join('..','sql'), sql_file='01_unload_data.sql'):
+    ''' Returns the columns of the UNLOAD that depend on the target span '''
+    names, exprs, _ = sch.read_unload_select(sql_path, sql_file)
+    return [name for name, expr in zip(names, exprs) if any(re.search(ref, expr) for ref in TARGET_REFS)]
+
+
+def shared_columns(names, target_names, slugs):
+    ''' Returns the columns of the shared extract: names, with every target column repeated per slug '''
+    columns = []
+    for name in names:
+        if name in target_names:
+            columns.extend(shared_name(slug, name) for slug in slugs)
+        else:
+            columns.append(name)
+    return columns
+
+
+def shared_dtypes(dtypes, target_names, slugs):
+    ''' Returns the dtypes of the shared extract from those of the UNLOAD (schema_utils.unload_dtypes) '''
+    shared = collections.OrderedDict()
+    for name, dtype in dtypes.items():
+        for column in shared_columns([name], target_names, slugs):
+            shared[column] = dtype
+    return shared
+
+
+def _target_sql(sql, slug, start_dt, end_dt):
+    # An UNLOAD fragment for one target: its dates in place of the placeholders, its own alias
+    sql = sql.replace("\\'{1}\\'", "\\'{0}\\'".format(start_dt)).replace("\\'{2}\\'", "\\'{0}\\'".format(end_dt))
+    sql = re.sub(r'\btarget\.', 'target_{0}.'.format(slug), sql)
+    return re.sub(r'\) as target\n', ') as target_{0}\n'.format(slug), sql)
+
+
+def shared_unload_sql(sql, targets):
+    ''' Returns the UNLOAD of a shared extract from the (unformatted) text of 01_unload_data.sql
+
+    The temp tables of the features are left as they are.  In the UNLOAD, every target column
+    and the subquery of the target span are repeated for every target, with its dates.
+
+    Parameters
+    ----------
+    sql : str
+        the text of 01_unload_data.sql, before format
+    targets : list of (slug, start_dt, end_dt)
+
+    Returns
+    -------
+    str
+        the text to format as 01_unload_data.sql, where {1} and {2} are no longer used
+    '''
+    # rs.read_sql_file indents every line after the first by a space
+    head, unload = sql.split("unload('", 1)
+    header, union, data = re.split(r'(\n\s*union\s*\n)', unload, 1)
+    select, from_sep, from_clause = re.split(r'(\n\s*from )', data, 1)
+
+    # The target columns, by their header line and their select expression
+    names = re.findall(r"\\'(\w+)\\'", header)
+    exprs = sch._split_select(select[select.index('select') + len('select'):])
+    for name, expr in zip(names, exprs):
+        if not any(re.search(ref, expr) for ref in TARGET_REFS):
+            continue
+        line = re.search(r"\n(\s*)\\'{0}\\'(,?)\n".format(name), header)
+        header = header.replace(line.group(0), '\n' + ',\n'.join(
+            "{0}\\'{1}\\'".format(line.group(1), shared_name(slug, name)) for slug, _, _ in targets) +
+            line.group(2) + '\n', 1)
+        select = select.replace(expr, ',\n  '.join(_target_sql(expr, slug, start_dt, end_dt)
+                                                   for slug, start_dt, end_dt in targets), 1)
+
+    join = re.search(r'left join \((?:(?!\n\s*left join ).)*?\) as target\n[^\n]*\n', from_clause, re.DOTALL)
+    if join is None:
+        raise ValueError('The UNLOAD has no subquery of the target span')
+    from_clause = from_clause.replace(join.group(0), ''.join(_target_sql(join.group(0), slug, start_dt, end_dt)
+                                                             for slug, start_dt, end_dt in targets))
+    return head + "unload('" + header + union + select + from_sep + from_clause
+
+
+def target_frame(df, slug, names, target_names):
+    ''' Returns the columns of the extract of one target from a shared extract
+
+    Parameters
+    ----------
+    df : DataFrame
+        a shared extract, or a sample of it
+    slug : str
+        the target's slug
+    names : list of str
+        the columns of the UNLOAD, in order (schema_utils.read_unload_select)
+    target_names : list of str
+        the target columns of the UNLOAD (target_columns)
+    '''
+    df = df.rename(columns=dict((shared_name(slug, name), name) for name in target_names))
+    return df[names]
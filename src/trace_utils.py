@@ -0,0 +1,310 @@
+''' Nested timing spans of the pipeline, exported as JSON lines and a per-run summary table
+
+span times a block of work and records, when it ends:
+
+    wall_s, cpu_s       wall and CPU seconds (CPU of the thread where the platform has a
+                        thread clock, of the process otherwise)
+    child_cpu_s         CPU seconds of the child processes (pools) waited for in the span
+    rows, bytes         what the block reports with Span.add, and their rates rows_per_s
+                        and mb_per_s
+    peak_rss_mb         the high-water mark of the process' resident memory at the end of
+                        the span, rss_growth_mb how much the span raised it, and
+                        child_peak_rss_mb the largest of the child processes'
+
+Spans nest per thread: a span opened inside another is its child, and its path
+is the chain of names from its root (e.g., main/prepare/sample).  Spans of a
+worker process are brought back with records and attached under the open
+span of the parent with adopt, and the spans of a worker thread go under a
+span of the thread that started it with attach.  A span given a message also logs
+'<message>...' when it opens and '<message> required <wall>s' when it closes.
+
+summary aggregates the records of a run by path, and regressions compares it
+with the summary of an earlier run; save does both, writes the records and
+drops them (pop).  A long-lived process (the scoring service, a pipeline run
+after run) keeps at most MAX_RECORDS records of spans it never saves.
+
+Example use
+===========
+with span('main', event=event, year=year) as root:
+    with span('download', 'Downloading features locally') as sp:
+        s3.download_file_from_s3(...)
+        sp.add(bytes=os.path.getsize(filename))
+save(root.id, 'temp/ep_valday18_', baseline='temp/ep_valday17_trace_summary.csv')
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import itertools
+import threading
+import contextlib
+import collections
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger('events_logger')
+
+SUMMARY_COLUMNS = ['calls', 'wall_s', 'pct_wall', 'cpu_s', 'child_cpu_s', 'rows', 'bytes', 'rows_per_s',
+                   'mb_per_s', 'peak_rss_mb', 'rss_growth_mb', 'child_peak_rss_mb', 'errors']
+
+# The most records kept; the oldest go first
+MAX_RECORDS = 100000
+
+_local = threading.local()
+_lock = threading.Lock()
+_records = collections.deque(maxlen=MAX_RECORDS)
+_ids = itertools.count(1)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _cpu_times():
+    # CPU seconds of this thread (or process) and of the child processes waited for
+    times = os.times()
+    cpu = time.thread_time() if hasattr(time, 'thread_time') else times[0] + times[1]
+    return cpu, times[2] + times[3]
+
+
+def _peak_rss_mb(who='self'):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss / (2.0**20 if sys.platform == 'darwin' else 2.0**10)
+
+
+def _rate(amount, seconds, scale=1.0):
+    return round(amount / scale / seconds, 3) if seconds > 0 and amount else None
+
+
+class Span(object):
+    ''' An open span: add the rows and bytes it processes, set attributes to record with it '''
+
+    def __init__(self, name, parent, attrs):
+        self.id = '{0}-{1}'.format(os.getpid(), next(_ids))
+        self.name = name
+        self.parent = parent
+        self.root = self.id if parent is None else parent.root
+        self.path = name if parent is None else parent.path + '/' + name
+        self.attrs = attrs
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, rows=0, bytes=0):
+        self.rows += int(rows)
+        self.bytes += int(bytes)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+@contextlib.contextmanager
+def span(name, message=None, **attrs):
+    ''' Times the block in a span named name, child of the span open in this thread
+
+    Parameters
+    ----------
+    name : str
+        the span's name, the last part of its path
+    message : str, optional
+        logged when the span opens and, with its wall time, when it closes
+    **attrs
+        recorded with the span (e.g., event, year)
+
+    Yields
+    ------
+    Span
+    '''
+    stack = _stack()
+    sp = Span(name, stack[-1] if stack else None, attrs)
+    if message is not None:
+        logger.info('{0}...'.format(message))
+    stack.append(sp)
+    start = time.time()
+    cpu_start, child_cpu_start = _cpu_times()
+    rss_start = _peak_rss_mb()
+    error = None
+    try:
+        yield sp
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        wall = time.time() - start
+        cpu, child_cpu = _cpu_times()
+        rss = _peak_rss_mb()
+        record = {'id': sp.id, 'parent': None if sp.parent is None else sp.parent.id, 'root': sp.root,
+                  'name': name, 'path': sp.path, 'pid': os.getpid(), 'thread': threading.current_thread().name,
+                  'start': round(start, 6), 'wall_s': round(wall, 6), 'cpu_s': round(cpu - cpu_start, 6),
+                  'child_cpu_s': round(child_cpu - child_cpu_start, 6), 'rows': sp.rows, 'bytes': sp.bytes,
+                  'rows_per_s': _rate(sp.rows, wall), 'mb_per_s': _rate(sp.bytes, wall, 2.0**20),
+                  'peak_rss_mb': None if rss is None else round(rss, 3),
+                  'rss_growth_mb': None if rss is None else round(rss - rss_start, 3),
+                  'child_peak_rss_mb': None if rss is None else round(_peak_rss_mb('children'), 3),
+                  'error': error, 'attrs': sp.attrs}
+        with _lock:
+            _records.append(record)
+        if message is not None and error is None:
+            logger.info('{0} required {1}s'.format(message, round(wall, 3)))
+
+
+@contextlib.contextmanager
+def attach(parent):
+    ''' Opens the spans of the block, in this thread, as children of parent (a span open in
+    another thread, e.g., the one that started this thread) '''
+    stack = _stack()
+    stack.append(parent)
+    try:
+        yield parent
+    finally:
+        stack.remove(parent)
+
+
+def current():
+    ''' Returns the span open in this thread, or None '''
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def records(root=None):
+    ''' Returns the records of the closed spans, or only those of the span with id root and
+    its descendants, in the order they closed '''
+    with _lock:
+        return [dict(record) for record in _records if root is None or record['root'] == root]
+
+
+def reset():
+    ''' Drops the records and the open spans of this thread, e.g., in a forked worker process '''
+    with _lock:
+        _records.clear()
+    _local.stack = []
+
+
+def pop(root):
+    ''' Returns the records of the span with id root and its descendants, in the order they
+    closed, and drops them '''
+    with _lock:
+        taken = [record for record in _records if record['root'] == root]
+        kept = [record for record in _records if record['root'] != root]
+        _records.clear()
+        _records.extend(kept)
+    return taken
+
+
+def adopt(worker_records):
+    ''' Attaches the records of a worker process under the span open in this thread '''
+    parent = current()
+    adopted = []
+    for record in worker_records:
+        record = dict(record)
+        if parent is not None:
+            if record['parent'] is None:
+                record['parent'] = parent.id
+            record['root'] = parent.root
+            record['path'] = parent.path + '/' + record['path']
+        adopted.append(record)
+    with _lock:
+        _records.extend(adopted)
+
+
+def write_jsonl(filename, span_records=None):
+    ''' Writes span records (by default all of them) to filename, one JSON object per line '''
+    span_records = records() if span_records is None else span_records
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as f:
+        for record in span_records:
+            f.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+
+
+def read_jsonl(filename):
+    with open(filename, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summary(span_records=None):
+    ''' Returns the span records (by default all of them) aggregated by path
+
+    Returns
+    -------
+    DataFrame
+        indexed by path in the order the paths first opened: calls, the sums of wall_s,
+        cpu_s, child_cpu_s, rows and bytes, pct_wall (of the wall time of the roots), the
+        rates of the sums, the largest peak_rss_mb, rss_growth_mb and child_peak_rss_mb
+        and the number of errors
+    '''
+    import pandas as pd
+    span_records = records() if span_records is None else span_records
+    if not span_records:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS, index=pd.Index([], name='path'))
+    df = pd.DataFrame(span_records)
+    df['errors'] = df['error'].notnull().astype(int)
+    grouped = df.groupby('path')
+    out = grouped[['wall_s', 'cpu_s', 'child_cpu_s', 'rows', 'bytes', 'errors']].sum()
+    out = out.join(grouped[['peak_rss_mb', 'rss_growth_mb', 'child_peak_rss_mb']].max())
+    out['calls'] = grouped.size()
+    total = df.loc[df['parent'].isnull(), 'wall_s'].sum()
+    out['pct_wall'] = 100 * out['wall_s'] / total if total > 0 else None
+    out['rows_per_s'] = [_rate(rows, wall) for rows, wall in zip(out['rows'], out['wall_s'])]
+    out['mb_per_s'] = [_rate(nbytes, wall, 2.0**20) for nbytes, wall in zip(out['bytes'], out['wall_s'])]
+    out = out.loc[grouped['start'].min().sort_values().index, SUMMARY_COLUMNS]
+    out.index.name = 'path'
+    return out
+
+
+def save(root, prefix, baseline=None):
+    ''' Writes the records of the span with id root to <prefix>trace.jsonl and their summary to
+    <prefix>trace_summary.csv, logs the paths slower than in baseline (see regressions) and
+    returns the summary.  The records are dropped once written. '''
+    span_records = pop(root)
+    write_jsonl(prefix + 'trace.jsonl', span_records)
+    run_summary = summary(span_records)
+    run_summary.to_csv(prefix + 'trace_summary.csv')
+    if baseline is not None:
+        for path, row in regressions(run_summary, baseline).iterrows():
+            logger.warning('{0} required {1}s per call, {2}x the baseline'.format(
+                path, round(row['wall_s_per_call'], 3), round(row['ratio'], 2)))
+    return run_summary
+
+
+def regressions(run_summary, baseline, tolerance=0.25, min_seconds=1.0):
+    ''' Returns the paths whose wall time per call grew past the baseline's
+
+    Parameters
+    ----------
+    run_summary : DataFrame
+        see summary
+    baseline : DataFrame or str
+        the summary of an earlier run, or the CSV file it was saved to
+    tolerance : float
+        the relative growth allowed
+    min_seconds : float
+        the growth (per call) below which a path is never reported
+
+    Returns
+    -------
+    DataFrame
+        indexed by path: wall_s_per_call, baseline_s_per_call and their ratio
+    '''
+    import pandas as pd
+    if not isinstance(baseline, pd.DataFrame):
+        baseline = pd.read_csv(baseline, index_col='path')
+    both = run_summary[['wall_s', 'calls']].join(baseline[['wall_s', 'calls']], rsuffix='_baseline', how='inner')
+    per_call = both['wall_s'] / both['calls']
+    baseline_per_call = both['wall_s_baseline'] / both['calls_baseline']
+    slower = (per_call > (1 + tolerance) * baseline_per_call) & (per_call - baseline_per_call >= min_seconds)
+    return pd.DataFrame({'wall_s_per_call': per_call, 'baseline_s_per_call': baseline_per_call,
+                         'ratio': per_call / baseline_per_call},
+                        columns=['wall_s_per_call', 'baseline_s_per_call', 'ratio']).loc[slower]
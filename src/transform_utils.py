@@ -0,0 +1,145 @@
+''' One-pass log transforms and standardization of the sample and the extract
+
+StreamingScaler keeps the count, mean and sum of squared deviations of every
+feature, skipping missing values as StandardScaler does, updated chunk by
+chunk with Welford's and Chan et al.'s formulas, so the statistics of data
+that does not fit in memory are found in one pass and scalers fit on
+separate chunks (e.g., shards) merge exactly.  It scales like StandardScaler
+(population variance, features without variance left unscaled, missing
+values left missing), but in place, one column at a time into float32, so a
+chunk is never copied as a whole.  The statistics are saved as JSON, and the
+scaler pickles too, so the same transform runs on the full extract when
+scoring.
+
+log_transform applies log_fn to the log_features of a chunk, as float32, and
+renames them log_<col>.
+
+Example use
+===========
+scaler = StreamingScaler(features)
+for chunk in pd.read_csv(filename, sep='|', chunksize=500000, dtype=dtypes):
+    scaler.partial_fit(log_transform(chunk, log_features, logm1))
+scaler.save('../data/ep_annpub17_scaler.json')
+scaled = scaler.transform(log_transform(chunk, log_features, logm1))
+'''
+
+import json
+
+import numpy as np
+import pandas as pd
+
+
+def log_transform(df, log_features=None, log_fn=np.log):
+    ''' Replaces each of log_features in df by log_fn of it as float32, renamed to log_<col>;
+    returns df '''
+    if log_features is None:
+        return df
+    renames = {}
+    for col in log_features:
+        if col in df.columns:
+            df[col] = log_fn(df[col].values.astype(np.float32))
+            renames[col] = 'log_' + col
+    if renames:
+        df.rename(columns=renames, inplace=True)
+    return df
+
+
+class StreamingScaler(object):
+    ''' Standardizes features with statistics gathered in one pass over chunks
+
+    Parameters
+    ----------
+    features : list of str
+        columns to scale, in order
+    '''
+
+    def __init__(self, features):
+        self.features = list(features)
+        # Counts are by feature, as every feature skips its own missing values
+        self.n_ = np.zeros(len(self.features), dtype=np.int64)
+        self.mean_ = np.zeros(len(self.features))
+        self.m2_ = np.zeros(len(self.features))
+
+    @property
+    def var_(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n_ > 0, self.m2_ / np.maximum(self.n_, 1), np.nan)
+
+    @property
+    def scale_(self):
+        # Like StandardScaler, features without variance are only centered
+        scale = np.sqrt(self.var_)
+        scale[~(scale > 10 * np.finfo(np.float64).eps)] = 1.0
+        return scale
+
+    def _values(self, X):
+        return X[self.features].values if isinstance(X, pd.DataFrame) else np.asarray(X)
+
+    def _update(self, n, mean, m2):
+        # Chan et al.'s update, by feature; features without values in either side keep the other's
+        total = self.n_ + n
+        safe_total = np.maximum(total, 1)
+        delta = mean - self.mean_
+        self.m2_ = self.m2_ + m2 + delta ** 2 * self.n_ * n / safe_total
+        self.mean_ = self.mean_ + delta * n / safe_total
+        self.n_ = total
+
+    def partial_fit(self, X):
+        ''' Updates the statistics with a chunk (DataFrame holding the features, or array);
+        missing values are skipped '''
+        X = self._values(X).astype(np.float64)
+        if X.shape[0] == 0:
+            return self
+        n = (~np.isnan(X)).sum(axis=0)
+        mean = np.nansum(X, axis=0) / np.maximum(n, 1)
+        m2 = np.nansum((X - mean) ** 2, axis=0)
+        self._update(n, mean, m2)
+        return self
+
+    def fit(self, X, chunksize=100000):
+        ''' Fits on X in chunks of rows '''
+        self.__init__(self.features)
+        rows = X.iloc if isinstance(X, pd.DataFrame) else X
+        for start in range(0, len(X), chunksize):
+            self.partial_fit(rows[start:start + chunksize])
+        return self
+
+    def merge(self, other):
+        ''' Adds the statistics of a scaler of the same features fit on other chunks '''
+        if other.features != self.features:
+            raise ValueError('Only scalers of the same features can be merged')
+        self._update(other.n_, other.mean_, other.m2_)
+        return self
+
+    def transform(self, X, copy=True):
+        ''' Returns X standardized as float32, missing values left missing: a DataFrame has its
+        feature columns replaced (in place unless copy), an array is returned scaled '''
+        # Centered in float64, so features with a large mean and small variance keep their digits
+        scale = self.scale_
+        if not isinstance(X, pd.DataFrame):
+            return ((np.asarray(X) - self.mean_) / scale).astype(np.float32)
+        if copy:
+            X = X.copy()
+        for i, col in enumerate(self.features):
+            X[col] = ((X[col].values - self.mean_[i]) / scale[i]).astype(np.float32)
+        return X
+
+    def to_dict(self):
+        return {'features': self.features, 'n': self.n_.tolist(), 'mean': self.mean_.tolist(), 'm2': self.m2_.tolist()}
+
+    @classmethod
+    def from_dict(cls, stats):
+        scaler = cls(stats['features'])
+        scaler.n_ = np.array(stats['n'], dtype=np.int64)
+        scaler.mean_ = np.array(stats['mean'], dtype=np.float64)
+        scaler.m2_ = np.array(stats['m2'], dtype=np.float64)
+        return scaler
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,257 @@
+''' Flat-array inference for the random forest and gradient boosting persona models
+
+FlatEnsemble copies the nodes of every tree of a fitted binary
+RandomForestClassifier or GradientBoostingClassifier into a few contiguous
+arrays (feature, threshold, left, right, value).  Leaves point to themselves
+with an infinite threshold.  The arrays are evaluated by one of two engines:
+
+    numba  a compiled kernel, parallel over rows, that walks every tree of a
+           row and sums its leaves (numba is only imported when used)
+    numpy  vectorized over a batch of rows and all trees at once: every step
+           moves each (tree, row) pair one level down with a few gathers, for
+           the depth of the deepest tree; no compiler needed, but slower than
+           sklearn's own Cython traversal
+
+Inputs are compared as float32, as sklearn does.  With dtype=np.float32 the
+thresholds and leaf values are stored as float32 too (half the memory); the
+thresholds are rounded down, which keeps every split decision identical for
+float32 inputs, and only the leaf values lose precision.
+
+Example use
+===========
+flat = FlatEnsemble(rfgs[3])
+proba = flat.predict_proba(X)[:, 1]
+print(benchmark(rfgs[3], X))
+'''
+
+import time
+
+import numpy as np
+
+
+def _walk_trees(X, roots, feature, threshold, left, right, value, missing_left, out):
+    # Compiled by _numba_kernel; sums the leaf values of all trees for every row of X.  Rows are
+    # taken in blocks that walk one tree at a time, so the block and the tree stay in cache.
+    n_rows = X.shape[0]
+    n_blocks = (n_rows + 127) // 128
+    for b in _prange(n_blocks):
+        lo = b * 128
+        hi = min(lo + 128, n_rows)
+        for i in range(lo, hi):
+            out[i] = 0.0
+        for t in range(roots.shape[0]):
+            for i in range(lo, hi):
+                node = roots[t]
+                while left[node] != node:
+                    x = X[i, feature[node]]
+                    if x <= threshold[node] or (x != x and missing_left[node]):
+                        node = left[node]
+                    else:
+                        node = right[node]
+                out[i] += value[node]
+
+
+_prange = range
+_kernel = {}
+
+
+def _numba_kernel():
+    global _prange
+    if 'walk' not in _kernel:
+        try:
+            import numba
+        except ImportError:
+            raise ImportError('The numba engine of FlatEnsemble requires numba (pip install numba)')
+        _prange = numba.prange
+        _kernel['walk'] = numba.njit(parallel=True, nogil=True)(_walk_trees)
+    return _kernel['walk']
+
+
+def _default_engine():
+    try:
+        _numba_kernel()
+        return 'numba'
+    except ImportError:
+        return 'numpy'
+
+
+class FlatEnsemble(object):
+    ''' Contiguous node arrays of a fitted binary tree ensemble
+
+    Parameters
+    ----------
+    model : RandomForestClassifier, ExtraTreesClassifier or GradientBoostingClassifier
+        fitted on two classes
+    dtype : numpy dtype
+        of the thresholds and leaf values, np.float64 (exact) or np.float32
+    engine : str, optional
+        'numba' or 'numpy', by default numba when it is installed
+    batch_size : int
+        (tree, row) pairs evaluated per step of the numpy engine, bounds its working memory
+    '''
+
+    def __init__(self, model, dtype=np.float64, engine=None, batch_size=2000000):
+        self.engine = engine or _default_engine()
+        if len(getattr(model, 'classes_', [])) != 2:
+            raise ValueError('Only binary classifiers can be flattened')
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.n_features = model.n_features_in_ if hasattr(model, 'n_features_in_') else model.n_features_
+        if hasattr(model, 'feature_names_in_'):
+            self.feature_names_in_ = model.feature_names_in_
+        self.classes_ = model.classes_
+
+        if hasattr(model, 'estimators_') and hasattr(model, 'learning_rate'):
+            self.kind = 'boosting'
+            loss = getattr(model, 'loss', 'log_loss')
+            if loss not in ('log_loss', 'deviance'):
+                raise ValueError('Only the log loss of gradient boosting is supported, not {0}'.format(loss))
+            if model.init not in (None, 'zero'):
+                raise ValueError('Only the default init of gradient boosting is supported')
+            trees = [est.tree_ for est in model.estimators_[:, 0]]
+            scale = model.learning_rate
+        else:
+            self.kind = 'forest'
+            trees = [est.tree_ for est in model.estimators_]
+            scale = 1.0 / len(trees)
+        self._flatten(trees, scale)
+
+        if self.kind == 'boosting':
+            # The init prediction is a constant, recovered from one row
+            x0 = np.zeros((1, self.n_features))
+            self.offset = float(model.decision_function(x0).ravel()[0]) - float(self._sum_leaves(x0)[0])
+        else:
+            self.offset = 0.0
+
+    def _flatten(self, trees, scale):
+        sizes = np.array([t.node_count for t in trees])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        self.roots = starts.astype(np.int64)
+        self.max_depth = max(t.max_depth for t in trees)
+
+        feature = []
+        threshold = []
+        left = []
+        right = []
+        value = []
+        missing_left = []
+        for t, start in zip(trees, starts):
+            leaf = t.children_left == -1
+            own = np.arange(t.node_count) + start
+            feature.append(np.where(leaf, 0, t.feature))
+            threshold.append(np.where(leaf, np.inf, t.threshold))
+            left.append(np.where(leaf, own, t.children_left + start))
+            right.append(np.where(leaf, own, t.children_right + start))
+            if self.kind == 'forest':
+                counts = t.value[:, 0, :]
+                value.append(counts[:, 1] / counts.sum(axis=1) * scale)
+            else:
+                value.append(t.value[:, 0, 0] * scale)
+            mgl = getattr(t, 'missing_go_to_left', None)
+            missing_left.append(np.zeros(t.node_count, dtype=bool) if mgl is None else np.asarray(mgl, dtype=bool))
+
+        threshold = np.concatenate(threshold)
+        if self.dtype == np.float32:
+            # Round down, so x <= threshold holds for exactly the same float32 x
+            t32 = threshold.astype(np.float32)
+            over = t32.astype(np.float64) > threshold
+            t32[over] = np.nextafter(t32[over], np.float32(-np.inf))
+            threshold = t32
+        self.feature = np.concatenate(feature).astype(np.int32)
+        self.threshold = threshold
+        self.left = np.concatenate(left).astype(np.int32)
+        self.right = np.concatenate(right).astype(np.int32)
+        self.value = np.concatenate(value).astype(self.dtype)
+        self.missing_left = np.concatenate(missing_left)
+        self.has_missing = bool(self.missing_left.any())
+
+    def _leaves(self, X):
+        # Walks all trees for the rows of X and returns the leaf of every (tree, row)
+        n_rows = X.shape[0]
+        flat_X = X.ravel()
+        offsets = (np.arange(n_rows) * self.n_features)[np.newaxis, :]
+        node = np.repeat(self.roots[:, np.newaxis], n_rows, axis=1)
+        for depth in range(self.max_depth):
+            x = flat_X[offsets + self.feature[node]]
+            go_left = x <= self.threshold[node]
+            if self.has_missing:
+                go_left |= np.isnan(x) & self.missing_left[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        return node
+
+    def _sum_leaves(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        out = np.empty(X.shape[0])
+        if self.engine == 'numba':
+            _numba_kernel()(X, self.roots, self.feature, self.threshold, self.left, self.right, self.value,
+                            self.missing_left, out)
+            return out
+        rows_per_batch = max(1, self.batch_size // len(self.roots))
+        for start in range(0, X.shape[0], rows_per_batch):
+            batch = X[start:start + rows_per_batch]
+            out[start:start + len(batch)] = self.value[self._leaves(batch)].sum(axis=0, dtype=np.float64)
+        return out
+
+    def decision_function(self, X):
+        return self._sum_leaves(np.asarray(X)) + self.offset
+
+    def predict_proba(self, X):
+        ''' Returns the class probabilities of the rows of X (array or DataFrame in fit column order) '''
+        raw = self.decision_function(X)
+        pos = raw if self.kind == 'forest' else 1.0 / (1.0 + np.exp(-raw))
+        return np.column_stack([1.0 - pos, pos])
+
+
+def flatten_models(models, dtype=np.float64, engine=None):
+    ''' Returns models (by persona) with every supported tree ensemble replaced by its FlatEnsemble '''
+    flat = {}
+    for key, mdl in models.items():
+        try:
+            flat[key] = FlatEnsemble(mdl, dtype, engine)
+        except (ValueError, AttributeError):
+            flat[key] = mdl
+    return flat
+
+
+def benchmark(model, X, dtype=np.float64, engine=None, repeats=3):
+    ''' Times sklearn's predict_proba against FlatEnsemble on X and compares their probabilities
+
+    Returns
+    -------
+    dict
+        engine, rows, sklearn_s, flat_s (best of repeats, after compiling), speedup and max_abs_diff
+    '''
+    X = np.asarray(X)
+    flat = FlatEnsemble(model, dtype, engine)
+    flat.predict_proba(X[:1])
+
+    def best(fn):
+        times = []
+        for i in range(repeats):
+            start = time.time()
+            result = fn(X)
+            times.append(time.time() - start)
+        return min(times), result[:, 1]
+
+    sk_s, sk_p = best(model.predict_proba)
+    flat_s, flat_p = best(flat.predict_proba)
+    return {'engine': flat.engine, 'rows': X.shape[0], 'sklearn_s': round(sk_s, 4), 'flat_s': round(flat_s, 4),
+            'speedup': round(sk_s / flat_s, 2) if flat_s > 0 else None,
+            'max_abs_diff': float(np.max(np.abs(sk_p - flat_p)))}
+
+
+if __name__ == '__main__':
+
+    from sklearn.datasets import make_classification
+    from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+
+    # Sizes of the persona models in the README: 200 trees of depth ~9-12, GBM with 500 trees
+    X, y = make_classification(n_samples=50000, n_features=70, n_informative=20, random_state=0)
+    X_score = np.tile(X, (4, 1))
+    models = [('rf', RandomForestClassifier(n_estimators=200, max_depth=11, random_state=0, n_jobs=-1)),
+              ('gbm', GradientBoostingClassifier(n_estimators=500, max_depth=3, learning_rate=0.02, random_state=0))]
+    for name, model in models:
+        model.fit(X, y)
+        for engine in ['numba', 'numpy']:
+            for dtype in [np.float64, np.float32]:
+                print(name, np.dtype(dtype).name, benchmark(model, X_score, dtype, engine))
@@ -0,0 +1,9 @@
+''' Puts the modules of src/ and lib/ on the path, as setup.py installs them: top-level modules '''
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for path in (os.path.join(HERE, '..', 'lib'), os.path.join(HERE, '..', 'src')):
+    if path not in sys.path:
+        sys.path.insert(0, os.path.abspath(path))
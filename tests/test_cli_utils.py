@@ -0,0 +1,6 @@
+import cli_utils as cu
+
+
+def test_import_budgets():
+    failed = [result for result in cu.check_import_budgets() if not result['ok']]
+    assert failed == []
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from sklearn.metrics import average_precision_score, log_loss, roc_auc_score
+
+import evaluation_utils as evu
+
+
+@pytest.fixture(scope='module')
+def scores():
+    rng = np.random.RandomState(0)
+    y = rng.randint(0, 2, 500)
+    prob = np.clip(0.3 * y + rng.rand(500) * 0.7, 0, 1)
+    prob[:5] = [0.0, 1.0, 0.0, 1.0, 0.5]
+    return y, prob
+
+
+# sklearn sums the log loss of float32 probabilities in float32
+@pytest.mark.parametrize('dtype, rel', [(np.float64, 1e-9), (np.float32, 1e-6)])
+def test_metrics_match_sklearn(scores, dtype, rel):
+    y, prob = scores
+    prob = prob.astype(dtype)
+    row = evu.Evaluation(y, {'m': prob}).metrics().loc[('m', 0)]
+    assert row['log_loss'] == pytest.approx(log_loss(y, prob), rel=rel)
+    assert row['roc_auc'] == pytest.approx(roc_auc_score(y, prob), rel=1e-12)
+    assert row['avg_precision'] == pytest.approx(average_precision_score(y, prob), rel=1e-12)
+
+
+def test_metrics_by_group_skip_missing(scores):
+    y, prob = scores
+    prob = prob.copy()
+    prob[10:20] = np.nan
+    groups = np.arange(len(y)) % 2
+    metrics = evu.Evaluation(y, {'m': prob}, groups=groups).metrics()
+    for grp in (0, 1):
+        rows = (groups == grp) & ~np.isnan(prob)
+        assert metrics.loc[('m', grp), 'n'] == rows.sum()
+        assert metrics.loc[('m', grp), 'roc_auc'] == pytest.approx(roc_auc_score(y[rows], prob[rows]), rel=1e-12)
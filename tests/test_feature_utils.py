@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_utils as fu
+
+# Redshift's months_between of the documentation and its rules: whole months for the same day or
+# two month ends, else the difference of the days over 31
+CASES = [('1969-03-18', '1969-01-28', 1.6774193548),
+         ('2000-02-29', '2000-01-31', 1.0),
+         ('2017-06-15', '2016-06-15', 12.0),
+         ('2017-06-30', '2017-05-31', 1.0),
+         ('2017-06-30', '2017-05-30', 1.0),
+         ('2017-05-31', '2017-04-30', 1.0),
+         ('2017-01-01', '2017-02-15', -1.4516129032)]
+
+
+def test_months_between():
+    for later, earlier, expected in CASES:
+        assert fu.months_between(later, [earlier])[0] == pytest.approx(expected, abs=1e-9), (later, earlier)
+
+
+def test_months_between_of_nulls():
+    result = fu.months_between('2017-06-15', pd.Series([pd.Timestamp('2017-01-15'), pd.NaT]))
+    assert result[0] == 5.0
+    assert np.isnan(result[1])
+
+
+def test_months_between_matches_macro(tmp_path):
+    pytest.importorskip('duckdb')
+    import redshift_utils as rs
+    backend = rs.EmbeddedBackend(str(tmp_path))
+    for later, earlier, expected in CASES:
+        rows, _ = backend.execute("select months_between('{0}', '{1}')".format(later, earlier), return_data=True)
+        assert rows[0][0] == pytest.approx(fu.months_between(later, [earlier])[0], abs=1e-9), (later, earlier)
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+import transform_utils as tfu
+
+
+def _frame(seed=0, n=1000):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({'a': rng.normal(5.0, 2.0, n), 'b': rng.exponential(3.0, n) + 1e6, 'c': np.ones(n)})
+    df.loc[rng.rand(n) < 0.1, 'a'] = np.nan
+    return df
+
+
+def test_chunked_fit_matches_standard_scaler():
+    df = _frame()
+    scaler = tfu.StreamingScaler(['a', 'b', 'c']).fit(df, chunksize=97)
+    ref = StandardScaler().fit(df.values)
+    np.testing.assert_allclose(scaler.mean_, ref.mean_, rtol=1e-12)
+    np.testing.assert_allclose(scaler.var_, ref.var_, rtol=1e-9)
+    np.testing.assert_allclose(scaler.scale_, ref.scale_, rtol=1e-9)
+    np.testing.assert_allclose(scaler.transform(df)[['a', 'b', 'c']].values, ref.transform(df.values), rtol=1e-5,
+                               atol=1e-6)
+
+
+def test_merge_matches_one_fit():
+    df = _frame()
+    parts = [df.iloc[:10], df.iloc[10:600], df.iloc[600:]]
+    merged = tfu.StreamingScaler(['a', 'b', 'c'])
+    for part in parts:
+        merged.merge(tfu.StreamingScaler(['a', 'b', 'c']).fit(part))
+    whole = tfu.StreamingScaler(['a', 'b', 'c']).fit(df)
+    np.testing.assert_array_equal(merged.n_, whole.n_)
+    np.testing.assert_allclose(merged.mean_, whole.mean_, rtol=1e-12)
+    np.testing.assert_allclose(merged.m2_, whole.m2_, rtol=1e-9)
+
+
+def test_merge_of_chunk_without_values():
+    df = _frame()
+    empty = pd.DataFrame({'a': [np.nan, np.nan], 'b': [1e6, 1e6 + 1], 'c': [1.0, 1.0]})
+    scaler = tfu.StreamingScaler(['a', 'b', 'c']).fit(df).merge(tfu.StreamingScaler(['a', 'b', 'c']).fit(empty))
+    ref = tfu.StreamingScaler(['a', 'b', 'c']).fit(pd.concat([df, empty]))
+    assert scaler.n_[0] == df['a'].notnull().sum()
+    np.testing.assert_allclose(scaler.mean_, ref.mean_, rtol=1e-12)
+    np.testing.assert_allclose(scaler.var_, ref.var_, rtol=1e-9)
+
+
+def test_save_and_load(tmp_path):
+    scaler = tfu.StreamingScaler(['a', 'b', 'c']).fit(_frame())
+    filename = str(tmp_path / 'scaler.json')
+    scaler.save(filename)
+    loaded = tfu.StreamingScaler.load(filename)
+    assert loaded.features == scaler.features
+    assert loaded.n_.dtype == np.int64
+    np.testing.assert_array_equal(loaded.mean_, scaler.mean_)
+    np.testing.assert_array_equal(loaded.m2_, scaler.m2_)
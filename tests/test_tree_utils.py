@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_classification
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+
+import tree_utils as tu
+
+ENGINES = ['numpy', pytest.param('numba', marks=pytest.mark.skipif(tu._default_engine() != 'numba',
+                                                                   reason='numba is not installed'))]
+
+
+@pytest.fixture(scope='module')
+def data():
+    X, y = make_classification(n_samples=600, n_features=8, random_state=0)
+    return X, y
+
+
+@pytest.fixture(scope='module')
+def models(data):
+    X, y = data
+    return [RandomForestClassifier(n_estimators=20, max_depth=6, random_state=0).fit(X, y),
+            GradientBoostingClassifier(n_estimators=30, max_depth=3, random_state=0).fit(X, y)]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_matches_sklearn(data, models, engine):
+    X, _ = data
+    for model in models:
+        flat = tu.FlatEnsemble(model, engine=engine)
+        np.testing.assert_allclose(flat.predict_proba(X), model.predict_proba(X), rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_float32_keeps_every_split(data, models, engine):
+    X, _ = data
+    for model in models:
+        flat = tu.FlatEnsemble(model, dtype=np.float32, engine=engine)
+        np.testing.assert_allclose(flat.predict_proba(X), model.predict_proba(X), atol=1e-5)
+
+
+def test_numpy_batches(data, models):
+    X, _ = data
+    flat = tu.FlatEnsemble(models[0], engine='numpy', batch_size=100)
+    np.testing.assert_allclose(flat.predict_proba(X), models[0].predict_proba(X), rtol=1e-9, atol=1e-12)
+
+
+def test_rejects_multiclass():
+    X, y = make_classification(n_samples=200, n_features=6, n_informative=4, n_classes=3, random_state=0)
+    with pytest.raises(ValueError):
+        tu.FlatEnsemble(RandomForestClassifier(n_estimators=3, random_state=0).fit(X, y))